@@ -2,10 +2,24 @@
 
 import numpy as np
 from scipy.linalg import lapack
-from arches.matrix import diagonalize, AMatrix
+from arches.matrix import diagonalize
+from functools import cached_property
 from arches.chunking import JChunk
-from arches.fundamental_types import Determinant
-from typing import Tuple, Iterable, Callable
+from arches.fundamental_types import Determinant, DetArray
+from arches.integral_indexing_utils import compound_idx2_reverse, compound_idx4_reverse
+from arches.drivers import (
+    Hamiltonian_generator,
+    Hamiltonian_two_electrons_integral_driven,
+    H_indices_generator,
+    Powerplant_manager,
+    H_triplets_integral_chunk,
+    batch_apply_single_excitation,
+    batch_single_phase,
+    excitation_masks,
+    idk_lib,
+    triplet_constraint_keys,
+)
+from typing import Tuple, Iterable, Callable, Optional
 from mpi4py import MPI
 
 
@@ -235,79 +249,297 @@ def davidson_par_0(
         V_k, R_k, T_k = bmgs_h(np.hstack([V_k, V_kk]), l // 2, V_k, R_k, T_k)
 
 
+# Integral-driven PT2 engine: J chunks are streamed through per-category kernels,
+# which accumulate into arrays indexed by a fixed set of external determinants.
+
+
+def chunk_idx4(chunk: JChunk) -> np.ndarray:
+    """Canonical (i, j, k, l) indices of the two-electron integrals of a chunk, as an (M, 4) array"""
+    return np.array(
+        [compound_idx4_reverse(ijkl) for ijkl in chunk.idx.tolist()], dtype=np.int64
+    ).reshape(-1, 4)
+
+
+def chunk_triplets(
+    chunk: JChunk, psi_i: DetArray, psi_j: DetArray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """(row, col, value) triplets of <psi_i|H_chunk|psi_j>, where H_chunk is the part of the Hamiltonian
+    made of the integrals of the chunk. Repeated (row, col) pairs are to be summed."""
+    if chunk.category == "OE":
+        return one_electron_triplets(chunk, psi_i, psi_j)
+    c = np.ascontiguousarray(chunk.J, dtype="float")
+    if idk_lib is not None:
+        return H_triplets_integral_chunk(chunk_idx4(chunk), c, psi_i, psi_j)
+    # Python generators of the integral-driven driver
+    driver = Hamiltonian_two_electrons_integral_driven({}, use_compiled_kernels=False)
+    spindet_a_occ_i, spindet_b_occ_i = H_indices_generator.get_spindet_a_occ_spindet_b_occ(psi_i)
+    rows, cols, vals = [], [], []
+    for idx, value in zip(chunk_idx4(chunk).tolist(), c.tolist()):
+        for (I, J), phase in driver.H_indices_idx(
+            tuple(idx), psi_i, psi_j, spindet_a_occ_i, spindet_b_occ_i
+        ):
+            rows.append(I)
+            cols.append(J)
+            vals.append(phase * value)
+    return np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64), np.array(vals)
+
+
+def one_electron_triplets(
+    chunk: JChunk, psi_i: DetArray, psi_j: DetArray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """(row, col, value) triplets of <psi_i|h|psi_j> for a chunk of one-electron integrals h_pq,
+    indexed by compound_idx2(p, q). The diagonal h_pp counts the occupation of p."""
+    occupation = psi_i.occupation
+    triplets = []
+    for pq, h in zip(chunk.idx.tolist(), chunk.J.tolist()):
+        p, q = compound_idx2_reverse(pq)
+        for spin, s in DetArray.spin_index.items():
+            for hole, particle in ((p, q),) if p == q else ((p, q), (q, p)):
+                if hole == particle:
+                    I = np.flatnonzero(occupation[:, s, hole])
+                    exc_batch, phase = psi_i[I], 1
+                else:
+                    I = np.flatnonzero(occupation[:, s, hole] & ~occupation[:, s, particle])
+                    exc_batch = batch_apply_single_excitation(psi_i[I], hole, particle, spin)
+                J = psi_j.index(exc_batch)
+                filtered = J >= 0
+                if hole != particle:
+                    phase = batch_single_phase(psi_i[I[filtered]], hole, particle, spin)
+                triplets.append((I[filtered], J[filtered], h * phase * np.ones(filtered.sum())))
+    if not triplets:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+    return tuple(np.concatenate(t) for t in zip(*triplets))
+
+
+def pt2_numerator_kernel(
+    chunk: JChunk, int_dets: DetArray, psi_coef: np.ndarray, ext_dets: DetArray, e_pt2_n
+):
+    """e_pt2_n[J] += <Psi|H_chunk|J>, for all external determinants |J>"""
+    I, J, v = chunk_triplets(chunk, int_dets, ext_dets)
+    e_pt2_n += np.bincount(J, weights=psi_coef[I] * v, minlength=len(ext_dets))
+
+
+def pt2_denominator_kernel(chunk: JChunk, ext_dets: DetArray, e_pt2_d):
+    """e_pt2_d[J] += <J|H_chunk|J>, for all external determinants |J>.
+    Only integrals of the form <ij|ij> (categories A, B) and <ij|ji> (category F), and the diagonal
+    one-electron integrals contribute; computed directly from the occupation numbers."""
+    occupation = ext_dets.occupation.astype("float")
+    n_a, n_b = occupation[:, 0], occupation[:, 1]
+    values = np.asarray(chunk.J, dtype="float")
+    if chunk.category == "OE":
+        p, q = np.array(
+            [compound_idx2_reverse(pq) for pq in chunk.idx.tolist()], dtype=np.int64
+        ).reshape(-1, 2).T
+        e_pt2_d += (n_a + n_b)[:, p[p == q]] @ values[p == q]
+        return
+    i, j, k, _ = chunk_idx4(chunk).T
+    match chunk.category:
+        case "A":  # <ii|ii>, alpha and beta electron in i
+            e_pt2_d += (n_a[:, i] * n_b[:, i]) @ values
+        case "B":  # <ij|ij>, Coulomb between any two electrons in i and j
+            e_pt2_d += ((n_a[:, i] + n_b[:, i]) * (n_a[:, j] + n_b[:, j])) @ values
+        case "F":  # <ii|kk> == <ik|ki>, exchange between same-spin electrons in i and k
+            e_pt2_d -= (n_a[:, i] * n_a[:, k] + n_b[:, i] * n_b[:, k]) @ values
+
+
 def dispatch_kernel(
-    chunk: JChunk
-) -> Tuple[
-    Callable[
-        JChunk,
-        Iterable[Determinant],
-        Iterable[float],
-        Iterable[Determinant],
-        Iterable[float],
-    ]
-]:  # TODO: annotate callable types to include denom. kerneland provide kernel interface
+    chunk: JChunk,
+) -> Tuple[Optional[Callable[..., None]], Optional[Callable[..., None]]]:
+    """Return the (numerator, denominator) PT2 kernels that chunk contributes to; None if it does not
+    contribute.
+    Numerator kernels have the signature kernel(chunk, int_dets, psi_coef, ext_dets, e_pt2_n),
+    denominator kernels kernel(chunk, ext_dets, e_pt2_d); both accumulate in place.
+    """
     match chunk.category:
-        case "OE":
-            raise NotImplementedError
-        case "A":
-            raise NotImplementedError
-        case "B":
-            raise NotImplementedError
-        case "C":
-            raise NotImplementedError
-        case "D":
-            raise NotImplementedError
-        case "E":
-            raise NotImplementedError
-        case "F":
-            raise NotImplementedError
-        case "G":
-            raise NotImplementedError
-
-
-def get_connected_dets(int_dets: Iterable[Determinant]) -> Iterable[Determinant]:
-    raise NotImplementedError
+        case "OE" | "F":  # Both off-diagonal and diagonal contributions
+            return pt2_numerator_kernel, pt2_denominator_kernel
+        case "A" | "B":  # Only diagonal
+            return None, pt2_denominator_kernel
+        case "C" | "D" | "E" | "G":  # Only off-diagonal
+            return pt2_numerator_kernel, None
+        case _:
+            raise NotImplementedError(f"Unknown integral category {chunk.category}")
+
+
+def get_connected_dets(int_dets, n_orb: int, exc_constraints=None, batch_size=2**20) -> DetArray:
+    """Determinants singly or doubly connected to int_dets, and not in int_dets, in sorted order.
+    Excitations are generated on the packed words of batches of generators, and duplicates are
+    removed by sort-and-accumulate (see `DetArray.accumulate').
+    :param int_dets:        |DetArray|, or list of |Determinant|
+    :param exc_constraints: If given, only generate connected determinants satisfying one of these
+                            (triplet) constraints
+    :param batch_size:      Approximate number of excitations generated at once
+    >>> int_dets = [Determinant((0,), (0,))]
+    >>> get_connected_dets(int_dets, 2)
+    DetArray([Determinant(alpha=(0,), beta=(1,)), Determinant(alpha=(1,), beta=(0,)),
+              Determinant(alpha=(1,), beta=(1,))], n_orb=2)
+    """
+    if not isinstance(int_dets, DetArray):
+        int_dets = DetArray.from_psi_det(list(int_dets), n_orb)
+    if exc_constraints is not None:
+        allowed = np.unique(
+            triplet_constraint_keys(
+                DetArray.from_psi_det([Determinant(tuple(C), ()) for C in exc_constraints], n_orb)
+            )
+        )
+    n_excitations = len(excitation_masks(int_dets[:1])[0]) if len(int_dets) else 1
+    step = max(1, batch_size // max(1, n_excitations))
+    connected = []
+    for start in range(0, len(int_dets), step):
+        batch = int_dets[start : start + step]
+        words = (batch.words[:, np.newaxis] ^ excitation_masks(batch)).reshape(-1, *batch.words.shape[1:])
+        excited = DetArray(words, n_orb)
+        if exc_constraints is not None:
+            keys = triplet_constraint_keys(excited)
+            pos = np.minimum(np.searchsorted(allowed, keys), len(allowed) - 1)
+            excited = excited[allowed[pos] == keys]
+        # Duplicates within the batch are removed right away, to bound the memory
+        connected.append(excited.accumulate(np.zeros(len(excited)))[0].words)
+    if not connected:
+        return DetArray(np.zeros((0, *int_dets.words.shape[1:]), dtype=np.uint64), n_orb)
+    ext_dets, _ = DetArray(np.concatenate(connected), n_orb).accumulate(
+        np.zeros(sum(map(len, connected)))
+    )
+    # Unique determinants come out in key order, which is kept
+    return ext_dets[int_dets.index(ext_dets) < 0]
 
 
 def cipsi(
-    E0,
+    E_var,
     int_dets,
     psi_coef,
     J_chunks: Iterable[JChunk],
     *args,
+    n_orb,
+    E0=0.0,
+    comm=None,
     pt2_threshold=1e-8,
     exc_constraints=None,
     **kwargs,
 ):
-    ext_dets = get_connected_dets(int_dets, exc_constraints)
+    """One CIPSI step; compute the PT2 contribution of every connected determinant by streaming
+    the integral chunks through the PT2 kernels, and select the external determinants whose
+    contribution is larger (in magnitude) than pt2_threshold.
 
-    e_pt2_n = np.array(len(ext_dets))  # TODO: convert these arrays to pointers
-    e_pt2_d = np.array(len(ext_dets))
+    :param E_var:    Variational energy of the wave function (int_dets, psi_coef)
+    :param J_chunks: Chunks of integrals (including a one-electron chunk, category "OE") local to this rank
+    :param E0:       Constant energy (nuclear repulsion), part of every diagonal element
+    :param comm:     If given, partial numerators and denominators are summed over its ranks
+
+    :return: Internal + selected determinants (as a |DetArray|), and the total PT2 energy
+    """
+    if not isinstance(int_dets, DetArray):
+        int_dets = DetArray.from_psi_det(list(int_dets), n_orb)
+    ext_dets = get_connected_dets(int_dets, n_orb, exc_constraints)
+    c = np.asarray(psi_coef, dtype="float")
+
+    e_pt2_n = np.zeros(len(ext_dets))  # <Psi|H|J>
+    e_pt2_d = np.zeros(len(ext_dets))  # <J|H|J> - E0
 
     for chunk in J_chunks:
-        kernels = dispatch_kernel(
-            chunk
-        )  # kernels[0] is numerator contrib., kernels[1] is denom. contrib.
+        # kernels[0] is numerator contrib., kernels[1] is denom. contrib.
+        kernels = dispatch_kernel(chunk)
         match chunk.category:
             case "OE" | "F":  # both num and denominator
-                kernels[0](chunk, int_dets, psi_coef, ext_dets, e_pt2_n)
-                kernels[1](chunk, ext_dets, e_pt2_d, E0)
+                kernels[0](chunk, int_dets, c, ext_dets, e_pt2_n)
+                kernels[1](chunk, ext_dets, e_pt2_d)
             case "A" | "B":  # only denominator
-                kernels[1](chunk, ext_dets, e_pt2_d, E0)
+                kernels[1](chunk, ext_dets, e_pt2_d)
             case _:  # only numerator
-                kernels[0](chunk, int_dets, psi_coef, ext_dets, e_pt2_n)
+                kernels[0](chunk, int_dets, c, ext_dets, e_pt2_n)
 
     # reduce e_pt2_n,d over processes
-    e_pt2 = e_pt2_n / e_pt2_d
-    pt2_filter = e_pt2 > pt2_threshold
+    if comm is not None:
+        comm.Allreduce(MPI.IN_PLACE, [e_pt2_n, MPI.DOUBLE])
+        comm.Allreduce(MPI.IN_PLACE, [e_pt2_d, MPI.DOUBLE])
+    e_pt2 = e_pt2_n**2 / (E_var - E0 - e_pt2_d)
+    pt2_filter = np.abs(e_pt2) > pt2_threshold
     e_pt2_total = np.sum(e_pt2)
 
     # TODO: sort ext dets so that they are in weight order? Or otherwise, pass in information if N_max_dets will be hit
-    return int_dets + ext_dets[pt2_filter], e_pt2_total
-
+    selected = np.concatenate((int_dets.words, ext_dets.words[pt2_filter]))
+    return DetArray(selected, n_orb), e_pt2_total
+
+
+class JChunk_Hamiltonian_generator(Hamiltonian_generator):
+    """|Hamiltonian_generator| whose rows are built from the integral chunks local to each rank,
+    instead of integral dictionaries; the Davidson and the matrix products of |Hamiltonian_generator|
+    work unchanged on it.
+    Chunks are distributed by integrals, so each rank generates the (row, col, value) triplets of its
+    chunks for all the rows, and sends them to the rank owning the rows (once, at construction, as all
+    the ranks take part in the exchange even without local rows). The non-zeros of the local rows are
+    then kept in memory, and blocks of H_i are slices of them.
+    """
 
-def prepare_hamiltonian(psi_dets, H_partial: AMatrix = None) -> AMatrix:
-    raise NotImplementedError
+    def __init__(self, comm, E0, psi_internal: DetArray, J_chunks: Iterable[JChunk], n_orb, **kwargs):
+        super().__init__(comm, E0, None, None, psi_internal, **kwargs)
+        self.J_chunks = J_chunks
+        self.N_orb = n_orb
+        self.H_i_local_matrix_elements
+
+    @cached_property
+    def H_i_local_matrix_elements(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Non-zeros of the local rows of H_i, as sorted row-major keys I * N + J (I local) and values"""
+        psi = self.psi_internal
+        triplets = [chunk_triplets(chunk, psi, psi) for chunk in self.J_chunks]
+        I, J, v = (
+            np.concatenate([t[n] for t in triplets] + [np.zeros(0, dtype=dtype)])
+            for n, dtype in enumerate((np.int64, np.int64, np.float64))
+        )
+        # Triplets are sent to the rank owning their row
+        owners = np.searchsorted(self.offsets, I, side="right") - 1
+        order = np.argsort(owners, kind="stable")
+        send_counts = np.bincount(owners, minlength=self.world_size).astype(np.int64)
+        recv_counts = np.zeros(self.world_size, dtype=np.int64)
+        self.comm.Alltoall([send_counts, MPI.INT64_T], [recv_counts, MPI.INT64_T])
+        received = []
+        for a, mpi_type in ((I, MPI.INT64_T), (J, MPI.INT64_T), (v, MPI.DOUBLE)):
+            recv = np.zeros(recv_counts.sum(), dtype=a.dtype)
+            self.comm.Alltoallv(
+                [a[order], send_counts, np.cumsum(send_counts) - send_counts, mpi_type],
+                [recv, recv_counts, np.cumsum(recv_counts) - recv_counts, mpi_type],
+            )
+            received.append(recv)
+        I, J, v = received
+        # Constant energy on the diagonal
+        start = self.offsets[self.rank]
+        local_rows = np.arange(self.local_size, dtype=np.int64)
+        I = np.concatenate((I - start, local_rows))
+        J = np.concatenate((J, local_rows + start))
+        v = np.concatenate((v, np.full(self.local_size, self.E0, dtype="float")))
+        keys, inverse = np.unique(I * self.full_problem_size + J, return_inverse=True)
+        data = np.bincount(inverse, weights=v, minlength=len(keys))
+        nonzero = data != 0
+        return keys[nonzero], data[nonzero]
+
+    def H_i_row_matrix_elements(self, start, stop):
+        keys, data = self.H_i_local_matrix_elements
+        N_j = self.full_problem_size
+        lo, hi = np.searchsorted(keys, [start * N_j, stop * N_j])
+        return keys[lo:hi] - start * N_j, data[lo:hi]
+
+    @cached_property
+    def D_i(self):
+        keys, data = self.H_i_local_matrix_elements
+        I, J = np.divmod(keys, self.full_problem_size)
+        diagonal = I + self.offsets[self.rank] == J
+        D_i = np.zeros(self.local_size, dtype="float")
+        D_i[I[diagonal]] = data[diagonal]
+        return D_i
+
+
+def prepare_hamiltonian(
+    psi_dets, J_chunks: Iterable[JChunk], n_orb, E0=0.0, comm=None, **kwargs
+) -> JChunk_Hamiltonian_generator:
+    """Hamiltonian in the basis psi_dets, built from the integral chunks, distributed by rows over comm
+    (see |JChunk_Hamiltonian_generator|).
+    :param psi_dets: |DetArray|, or list of |Determinant|
+    """
+    if not isinstance(psi_dets, DetArray):
+        psi_dets = DetArray.from_psi_det(list(psi_dets), n_orb)
+    return JChunk_Hamiltonian_generator(
+        MPI.COMM_SELF if comm is None else comm, E0, psi_dets, list(J_chunks), n_orb, **kwargs
+    )
 
 
 def s_CI(
@@ -316,19 +548,35 @@ def s_CI(
     psi_coef,
     J_chunks,
     *args,
-    N_states=1,
+    n_orb,
+    E_var=None,
     N_max_dets=1e6,
     pt2_conv=1e-4,
+    comm=None,
     **kwargs,
 ):
+    """Selected CI; alternate CIPSI selection steps and diagonalizations until N_max_dets is reached or
+    the PT2 correction is below pt2_conv.
+    :param E0:       Constant energy (nuclear repulsion)
+    :param J_chunks: Chunks of integrals local to this rank; re-used at each iteration
+    :param E_var:    Variational energy of the initial wave function, computed if not given
+    """
+    J_chunks = list(J_chunks)
+    if E_var is None:
+        lewis = prepare_hamiltonian(dets, J_chunks, n_orb, E0, comm=comm)
+        c = np.asarray(psi_coef, dtype="float")
+        E_var = Powerplant_manager(lewis.comm, lewis).E(c) / (c @ c)
     est_pt2_correction = np.inf
 
-    while len(dets) < N_max_dets and est_pt2_correction > pt2_conv:
+    while len(dets) < N_max_dets and abs(est_pt2_correction) > pt2_conv:
         # expand wavefunction in space of Slater determinants
-        dets, est_pt2_correction = cipsi(E0, dets, psi_coef, J_chunks)
+        dets, est_pt2_correction = cipsi(
+            E_var, dets, psi_coef, J_chunks, n_orb=n_orb, E0=E0, comm=comm, **kwargs
+        )
 
         # find wavefunctions and energies of first N states
-        H = prepare_hamiltonian(dets)
-        E0, psi_coef = davidson(H)
+        # H is distributed by rows and never formed; diagonalized with the parallel Davidson
+        lewis = prepare_hamiltonian(dets, J_chunks, n_orb, E0, comm=comm)
+        E_var, psi_coef = Powerplant_manager(lewis.comm, lewis).E_and_psi_coef
 
-    return E0, psi_coef, dets
+    return E_var, psi_coef, dets
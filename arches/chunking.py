@@ -4,6 +4,7 @@ from itertools import islice, combinations, product
 import numpy as np
 import numpy.typing as npt
 from arches.integral_indexing_utils import (
+    compound_idx2,
     compound_idx4,
     canonical_idx4,
 )
@@ -17,18 +18,20 @@ def batched(iterable, n):
 
 
 class IntegralReader:
-    def __init__(self, d=None):
+    def __init__(self, d=None, dtype=np.float32):
         self.d = d
+        self._dtype = dtype
 
     def __getitem__(self, idx):
         if self.d is None:
             return 0.0
         else:
-            return self.d[idx]
+            # Only non-zero integrals are stored
+            return self.d.get(idx, 0.0)
 
     @property
     def dtype(self):
-        return np.float32
+        return self._dtype
 
 
 @dataclass
@@ -65,14 +68,14 @@ class JChunkFactory:
 
     @category.setter
     def category(self, val):
-        if val not in "ABCDEFG":
-            raise ValueError
-        if len(val) != 1:
+        if val not in ("OE", *"ABCDEFG"):
             raise ValueError
 
         self._category = val
 
         match val:
+            case "OE":
+                f = JChunkFactory.OE_idx_iter
             case "A":
                 f = JChunkFactory.A_idx_iter
             case "B":
@@ -91,11 +94,11 @@ class JChunkFactory:
         # Yield indices in batches and distribute batches over communicator
         if self.chunk_size < 1:
             self.batched = False
-            self._idx_iter = islice(f(N_mo), self.comm_rank, None, self.comm_size)
+            self._idx_iter = islice(f(self.N_mo), self.comm_rank, None, self.comm_size)
         else:
             self.batched = True
             self._idx_iter = islice(
-                batched(f(N_mo), self.chunk_size), self.comm_rank, None, self.comm_size
+                batched(f(self.N_mo), self.chunk_size), self.comm_rank, None, self.comm_size
             )
             self._advance_batch()  # initialize first batch
 
@@ -114,6 +117,13 @@ class JChunkFactory:
         else:
             return self._idx_iter
 
+    @staticmethod
+    def OE_idx_iter(N_mo):
+        # One-electron integrals, indexed by compound_idx2
+        for i in range(N_mo):
+            for j in range(i, N_mo):
+                yield compound_idx2(i, j)
+
     @staticmethod
     def A_idx_iter(N_mo):
         for i in range(N_mo):
@@ -166,7 +176,7 @@ class JChunkFactory:
                 J_vals = np.fromiter(self.val_iter, count=-1, dtype=self.src_data.dtype)
                 chunk_size = J_ind.shape[0]
 
-                new_chunk = JChunk(chunk_size, J_vals, J_ind)
+                new_chunk = JChunk(chunk_size, J_vals, J_ind, self.category)
                 chunks.append(new_chunk)
                 self._advance_batch()
 
@@ -177,7 +187,29 @@ class JChunkFactory:
             J_vals = np.fromiter(self.val_iter, count=-1, dtype=self.src_data.dtype)
             chunk_size = J_ind.shape[0]
 
-            return JChunk(chunk_size, J_vals, J_ind)
+            return JChunk(chunk_size, J_vals, J_ind, self.category)
+
+
+def get_integral_chunks(
+    N_mo, d_one_e_integral, d_two_e_integral, chunk_size=-1, comm=None, dtype=np.float64
+):
+    """Chunks of all one-electron (category "OE") and two-electron (categories A-G) integrals
+    local to this rank, as consumed by the PT2 engine in arches.algorithms.
+
+    d_one_e_integral is keyed by (i, j), as returned by arches.io.load_integrals
+    """
+    d_one_e_compound = {compound_idx2(i, j): v for (i, j), v in d_one_e_integral.items()}
+    chunks = []
+    for category in ("OE", *"ABCDEFG"):
+        src_data = IntegralReader(
+            d_one_e_compound if category == "OE" else d_two_e_integral, dtype=dtype
+        )
+        factory = JChunkFactory(N_mo, category, src_data, chunk_size=chunk_size, comm=comm)
+        if factory.batched:
+            chunks.extend(factory.get_chunks())
+        else:
+            chunks.append(factory.get_chunks())
+    return chunks
 
 
 if __name__ == "__main__":
@@ -4,6 +4,8 @@ from dataclasses import dataclass
 from itertools import chain, product, combinations, permutations
 from functools import cached_property
 from collections import defaultdict
+import heapq
+import time
 import numpy as np
 
 # Import mpi4py and utilities
@@ -11,6 +13,7 @@ from mpi4py import MPI  # Note this initializes and finalizes MPI session automa
 
 from arches.fundamental_types import (
     Determinant,
+    DetArray,
     Psi_det,
     OrbitalIdx,
     Energy,
@@ -20,16 +23,19 @@ from arches.fundamental_types import (
     Two_electron_integral_index,
     Two_electron_integral_index_phase,
 )
-from typing import Iterator, Set, Tuple, List, Dict
+from typing import Callable, Iterator, Set, Tuple, List, Dict
 from arches.integral_indexing_utils import (
     compound_idx4_reverse,
     compound_idx4,
+    compound_idx4_batch,
     canonical_idx4,
 )
 
 import pathlib
-from ctypes import CDLL, c_char
+import tempfile
+from ctypes import CDLL, c_char, c_void_p
 from ctypes import c_longlong as idx_t
+from numpy.ctypeslib import ndpointer
 from arches.func_decorators import return_str, offload
 
 run_folder = pathlib.Path(__file__).parent.resolve()
@@ -48,6 +54,116 @@ it_lib = CDLL(run_folder.joinpath("build/libintegral_types.so"))
 it_lib.integral_category.restype = c_char
 it_lib.integral_category.argtypes = [idx_t, idx_t, idx_t, idx_t]
 
+# Compiled kernels of the integral-driven Hamiltonian build are optional;
+# without them the integral-driven driver uses the Python generators for every category
+try:
+    idk_lib = CDLL(run_folder.joinpath("build/libintegral_driven_kernels.so"))
+except OSError:
+    idk_lib = None
+else:
+    idk_lib.H_triplets_integral_chunk.restype = idx_t
+    idk_lib.H_triplets_integral_chunk.argtypes = [
+        ndpointer(np.int64, flags="C_CONTIGUOUS"),
+        ndpointer(np.float64, flags="C_CONTIGUOUS"),
+        idx_t,
+        ndpointer(np.uint64, flags="C_CONTIGUOUS"),
+        idx_t,
+        ndpointer(np.uint64, flags="C_CONTIGUOUS"),
+        ndpointer(np.int64, flags="C_CONTIGUOUS"),
+        idx_t,
+        idx_t,
+        ndpointer(np.int64, flags="C_CONTIGUOUS"),
+        ndpointer(np.int64, flags="C_CONTIGUOUS"),
+        ndpointer(np.float64, flags="C_CONTIGUOUS"),
+        idx_t,
+    ]
+    idk_lib.bloom_filter_insert.restype = None
+    idk_lib.bloom_filter_insert.argtypes = [
+        ndpointer(np.uint64, flags="C_CONTIGUOUS"),
+        idx_t,
+        idx_t,
+        ndpointer(np.uint64, flags="C_CONTIGUOUS"),
+        idx_t,
+        idx_t,
+    ]
+    idk_lib.bloom_filter_query.restype = None
+    idk_lib.bloom_filter_query.argtypes = [
+        ndpointer(np.uint64, flags="C_CONTIGUOUS"),
+        idx_t,
+        idx_t,
+        ndpointer(np.uint64, flags="C_CONTIGUOUS"),
+        idx_t,
+        idx_t,
+        ndpointer(np.uint8, flags="C_CONTIGUOUS"),
+    ]
+    idk_lib.csr_matrix_product.restype = None
+    idk_lib.csr_matrix_product.argtypes = [
+        ndpointer(np.int64, flags="C_CONTIGUOUS"),
+        ndpointer(np.int64, flags="C_CONTIGUOUS"),
+        ndpointer(np.float64, flags="C_CONTIGUOUS"),
+        idx_t,
+        ndpointer(np.float64, flags="C_CONTIGUOUS"),
+        idx_t,
+        ndpointer(np.float64, flags="C_CONTIGUOUS"),
+    ]
+
+# Compiled triplet-constrained excitation generators are optional as well;
+# without them the determinant-driven PT2 uses the Python generators of |Determinant|
+try:
+    det_lib = CDLL(run_folder.joinpath("build/libdeterminant.so"))
+except OSError:
+    det_lib = None
+else:
+    det_lib.triplet_constrained_excitations.restype = idx_t
+    det_lib.triplet_constrained_excitations.argtypes = [
+        ndpointer(np.uint64, flags="C_CONTIGUOUS"),
+        idx_t,
+        idx_t,
+        idx_t,
+        ndpointer(np.int64, flags="C_CONTIGUOUS"),
+        idx_t,
+        ndpointer(np.uint64, flags="C_CONTIGUOUS"),
+        idx_t,
+        ndpointer(np.uint64, flags="C_CONTIGUOUS"),
+        idx_t,
+        idx_t,
+        ndpointer(np.uint64, flags="C_CONTIGUOUS"),
+        ndpointer(np.int64, flags="C_CONTIGUOUS"),
+        ndpointer(np.int8, flags="C_CONTIGUOUS"),
+        idx_t,
+    ]
+
+# Compiled (hash map) accumulator of the external space is optional as well;
+# without it PT2 contributions are aggregated with `DetArray.accumulate'
+try:
+    es_lib = CDLL(run_folder.joinpath("build/libexternal_space.so"))
+except OSError:
+    es_lib = None
+else:
+    es_lib.external_space_create.restype = c_void_p
+    es_lib.external_space_create.argtypes = [idx_t, idx_t]
+    es_lib.external_space_destroy.restype = None
+    es_lib.external_space_destroy.argtypes = [c_void_p]
+    es_lib.external_space_add.restype = None
+    es_lib.external_space_add.argtypes = [
+        c_void_p,
+        ndpointer(np.uint64, flags="C_CONTIGUOUS"),
+        ndpointer(np.float64, flags="C_CONTIGUOUS"),
+        ndpointer(np.int64, flags="C_CONTIGUOUS"),
+        idx_t,
+    ]
+    es_lib.external_space_size.restype = idx_t
+    es_lib.external_space_size.argtypes = [c_void_p]
+    es_lib.external_space_extract.restype = None
+    es_lib.external_space_extract.argtypes = [
+        c_void_p,
+        ndpointer(np.uint64, flags="C_CONTIGUOUS"),
+        ndpointer(np.float64, flags="C_CONTIGUOUS"),
+        ndpointer(np.int64, flags="C_CONTIGUOUS"),
+    ]
+    es_lib.external_space_clear.restype = None
+    es_lib.external_space_clear.argtypes = [c_void_p]
+
 
 @offload(return_str(it_lib.integral_category))
 def integral_category(i, j, k, l):
@@ -110,122 +226,146 @@ def integral_category(i, j, k, l):
 # Drivers for `batched` operations
 
 
+def take_batch(psi: Psi_det, det_indices, n_orb: int) -> Tuple[np.ndarray, DetArray]:
+    """Indices, as a numpy array, and packed batch of the determinants of psi indicated by det_indices
+    :param psi:         |DetArray|, or list of |Determinant| (packed on the fly)
+    :param det_indices: Iterable of indices of determinants in psi
+    :param n_orb:       Lower bound on the number of orbitals the batch has to hold, if psi is a list
+
+    >>> take_batch([Determinant((0, 1), (0, 1)), Determinant((0, 2), (0, 2))], {1}, 4)
+    (array([1]), DetArray([Determinant(alpha=(0, 2), beta=(0, 2))], n_orb=4))
+    """
+    I = np.fromiter(det_indices, dtype=np.int64)
+    if isinstance(psi, DetArray):
+        return I, psi[I]
+    batch = [psi[i] for i in I]
+    n_orb = max(chain([n_orb - 1], chain.from_iterable(chain(*det) for det in batch))) + 1
+    return I, DetArray.from_psi_det(batch, n_orb)
+
+
+def batch_index(det_to_index: Dict[Determinant, int], batch: DetArray) -> np.ndarray:
+    """Index in psi_j of each determinant of the batch, -1 if absent
+    :param det_to_index: |DetArray| of psi_j, or hash map of determinants -> associated indices in psi_j
+    :param batch:        |DetArray| of determinants to look up
+
+    >>> psi_j = [Determinant((0, 1), (0, 1)), Determinant((0, 2), (0, 2))]
+    >>> batch = DetArray.from_psi_det([Determinant((0, 2), (0, 2)), Determinant((1, 2), (0, 2))], 4)
+    >>> batch_index(DetArray.from_psi_det(psi_j, 4), batch)
+    array([ 1, -1])
+    >>> batch_index({det: i for i, det in enumerate(psi_j)}, batch)
+    array([ 1, -1])
+    """
+    if isinstance(det_to_index, DetArray):
+        return det_to_index.index(batch)
+    return np.array([det_to_index.get(det, -1) for det in batch], dtype=np.int64)
+
+
 def batch_apply_single_excitation(
-    batch: List[Determinant], h: OrbitalIdx, p: OrbitalIdx, spin: str
-) -> List[Determinant]:
+    batch: DetArray, h: OrbitalIdx, p: OrbitalIdx, spin: str
+) -> DetArray:
     """Apply single excitation to a batch of determinants at a time
+    Holes are assumed occupied and particles empty, so the excitation is a XOR with a h, p mask.
     :param b:        Batch of Determinants to apply h->p excitation to
-    :param hash:     Hash map to check if excited determinant is present in the wave function
     :param h:        Hole in excitation
     :param p:        Particle in excitation
     :param spintype: Effectively a bool, is the excitation applied to alpha or beta spin determinants
 
-    >>> batch = [Determinant((0, 1), (0, 1)),
-    ...          Determinant((0, 2), (0, 2))]
+    >>> batch = DetArray.from_psi_det([Determinant((0, 1), (0, 1)),
+    ...                                Determinant((0, 2), (0, 2))], 4)
     >>> batch_apply_single_excitation(batch, 0, 3, "alpha")
-    [Determinant(alpha=(1, 3), beta=(0, 1)), Determinant(alpha=(2, 3), beta=(0, 2))]
-    >>> batch = [Determinant((0, 1), (0, 1)),
-    ...          Determinant((0, 2), (0, 2))]
+    DetArray([Determinant(alpha=(1, 3), beta=(0, 1)), Determinant(alpha=(2, 3), beta=(0, 2))], n_orb=4)
     >>> batch_apply_single_excitation(batch, 0, 3, "beta")
-    [Determinant(alpha=(0, 1), beta=(1, 3)), Determinant(alpha=(0, 2), beta=(2, 3))]
+    DetArray([Determinant(alpha=(0, 1), beta=(1, 3)), Determinant(alpha=(0, 2), beta=(2, 3))], n_orb=4)
     """
-
-    # TODO: Once in C, replace with allocation of space for new determinants...
-    # For now, we do list comprehension
-
-    return [det_I.apply_single_excitation(h, p, spin) for det_I in batch]
+    words = batch.words.copy()
+    words[:, DetArray.spin_index[spin]] ^= DetArray.mask((h, p), batch.n_orb)
+    return DetArray(words, batch.n_orb)
 
 
 def batch_apply_same_spin_double_excitation(
-    batch: List[Determinant],
+    batch: DetArray,
     h1: OrbitalIdx,
     p1: OrbitalIdx,
     h2: OrbitalIdx,
     p2: OrbitalIdx,
     spin: str,
-) -> List[Determinant]:
+) -> DetArray:
     """Apply double (same-spin) excitation to a batch of determinants at a time
     :param b:        Batch of Determinants to apply h->p excitation to
-    :param size:     Size of batch b
     :param h1, h2:   Hole in excitation
     :param p1, p2:   Particle in excitation
     :param spintype: Effectively a bool, is the excitation applied to alpha or beta spin determinants
-    >>> batch = [Determinant((0, 1, 2), (0, 1, 2)),
-    ...          Determinant((0, 2, 3), (0, 2, 3))]
+    >>> batch = DetArray.from_psi_det([Determinant((0, 1, 2), (0, 1, 2)),
+    ...                                Determinant((0, 2, 3), (0, 2, 3))], 6)
     >>> batch_apply_same_spin_double_excitation(batch, 0, 4, 2, 5, "alpha")
-    [Determinant(alpha=(1, 4, 5), beta=(0, 1, 2)), Determinant(alpha=(3, 4, 5), beta=(0, 2, 3))]
+    DetArray([Determinant(alpha=(1, 4, 5), beta=(0, 1, 2)), Determinant(alpha=(3, 4, 5), beta=(0, 2, 3))], n_orb=6)
     """
-
-    # TODO: Once in C, replace with allocation of space for new determinants...
-    # For now, we do list comprehension
-
-    return [det_I.apply_same_spin_double_excitation(h1, p1, h2, p2, spin) for det_I in batch]
+    words = batch.words.copy()
+    words[:, DetArray.spin_index[spin]] ^= DetArray.mask((h1, p1, h2, p2), batch.n_orb)
+    return DetArray(words, batch.n_orb)
 
 
 def batch_apply_opposite_spin_double_excitation(
-    batch: List[Determinant],
+    batch: DetArray,
     h1: OrbitalIdx,
     p1: OrbitalIdx,
     h2: OrbitalIdx,
     p2: OrbitalIdx,
-) -> List[Determinant]:
-    """Apply double (same-spin) excitation to a batch of determinants at a time
+) -> DetArray:
+    """Apply double (opposite-spin) excitation to a batch of determinants at a time
     :param b:        Batch of Determinants to apply h->p excitation to
-    :param size:     Size of batch b
-    :param h1, h2:   Hole in excitation
-    :param p1, p2:   Particle in excitation
-    :param spintype: Effectively a bool, is the excitation applied to alpha or beta spin determinants
-    >>> batch = [Determinant((0, 1, 2), (0, 1, 2)),
-    ...          Determinant((0, 2, 3), (0, 2, 3))]
+    :param h1, p1:   Hole, particle in alpha excitation
+    :param h2, p2:   Hole, particle in beta excitation
+    >>> batch = DetArray.from_psi_det([Determinant((0, 1, 2), (0, 1, 2)),
+    ...                                Determinant((0, 2, 3), (0, 2, 3))], 6)
     >>> batch_apply_opposite_spin_double_excitation(batch, 0, 4, 2, 5)
-    [Determinant(alpha=(1, 2, 4), beta=(0, 1, 5)), Determinant(alpha=(2, 3, 4), beta=(0, 3, 5))]
+    DetArray([Determinant(alpha=(1, 2, 4), beta=(0, 1, 5)), Determinant(alpha=(2, 3, 4), beta=(0, 3, 5))], n_orb=6)
     """
-
-    # TODO: Once in C, replace with allocation of space for new determinants...
-    # For now, we do list comprehension
-
-    return [det_I.apply_opposite_spin_double_excitation(h1, p1, h2, p2) for det_I in batch]
+    words = batch.words.copy()
+    words[:, 0] ^= DetArray.mask((h1, p1), batch.n_orb)
+    words[:, 1] ^= DetArray.mask((h2, p2), batch.n_orb)
+    return DetArray(words, batch.n_orb)
 
 
-def batch_single_phase(
-    batch: List[Determinant], h: OrbitalIdx, p: OrbitalIdx, spin: str
-) -> List[int]:
+def batch_single_phase(batch: DetArray, h: OrbitalIdx, p: OrbitalIdx, spin: str) -> np.ndarray:
     """Compute phase for batch of determinants related by excitation h <-> p
-    :param b:        Batch of Determinants to apply h->p excitation to
-    :param size:     Size of batch b
+    The phase is given by the parity of the number of occupied orbitals strictly between h and p;
+    computed for the whole batch at once by masking and popcounting the packed words.
+    :param batch:    Batch of Determinants to apply h->p excitation to
     :param h:        Hole in excitation
     :param p:        Particle in excitation
-    :param spintype: Effectively a bool, is the excitation applied to alpha or beta spin determinants
-    >>> batch = [Determinant((0, 1, 4, 7, 8), ()),
-    ...          Determinant((0, 1, 7, 11, 13), ())]
+    :param spin:     Is the excitation applied to alpha or beta spin determinants
+    :return:         Phases (+/-1) as an int8 array
+    >>> batch = DetArray.from_psi_det([Determinant((0, 1, 4, 7, 8), ()),
+    ...                                Determinant((0, 1, 7, 11, 13), ())], 14)
     >>> batch_single_phase(batch, 1, 12, "alpha")
-    array([-1, 1])
+    array([-1,  1], dtype=int8)
     """
-    return np.array([getattr(det, spin).single_phase(h, p) for det in batch], dtype="int")
+    parity = batch.count_occupied(DetArray.between_mask(h, p, batch.n_orb), spin) & 1
+    return 1 - 2 * parity.astype(np.int8)
 
 
 def batch_double_phase(
-    batch: List[Determinant],
+    batch: DetArray,
     h1: OrbitalIdx,
     p1: OrbitalIdx,
     h2: OrbitalIdx,
     p2: OrbitalIdx,
     spin: str,
-) -> List[int]:
+) -> np.ndarray:
     """Compute phase for batch of determinants related by double (same-spin) excitation h1, h2 <-> p1, p2
-    :param b:        Batch of Determinants to apply h->p excitation to
-    :param size:     Size of batch b
+    :param batch:    Batch of Determinants to apply h->p excitation to
     :param h1, h2:   Holes in excitation
     :param p1, p2:   Particles in excitation
-    :param spintype: Effectively a bool, is the excitation applied to alpha or beta spin determinants
-    >>> batch = [Determinant((0, 1, 2, 3, 4, 5, 6, 7, 8), ()),
-    ...          Determinant((0, 1, 2, 3, 4, 5, 6, 7, 13), ())]
+    :param spin:     Is the excitation applied to alpha or beta spin determinants
+    >>> batch = DetArray.from_psi_det([Determinant((0, 1, 2, 3, 4, 5, 6, 7, 8), ()),
+    ...                                Determinant((0, 1, 2, 3, 4, 5, 6, 7, 13), ())], 14)
     >>> batch_double_phase(batch, 2, 11, 3, 12, "alpha")
-    array([1, 1])
-    >>> batch = [Determinant((0, 1, 4, 5, 6, 7, 8), ()),
-    ...          Determinant((0, 1, 4, 5, 6, 7, 13), ())]
+    array([1, 1], dtype=int8)
+    >>> batch = DetArray.from_psi_det([Determinant((0, 1, 4, 5, 6, 7, 8), ()),
+    ...                                Determinant((0, 1, 4, 5, 6, 7, 13), ())], 14)
     >>> batch_double_phase(batch, 1, 11, 4, 3, "alpha")
-    array([ 1, -1])
+    array([ 1, -1], dtype=int8)
     """
     # batch_single_phase returns np.array; supports element-wise multiplication
     phase_of_batch = batch_single_phase(batch, h1, p1, spin) * batch_single_phase(
@@ -238,6 +378,415 @@ def batch_double_phase(
     return phase_of_batch
 
 
+def batch_opposite_spin_double_phase(
+    batch: DetArray,
+    h1: OrbitalIdx,
+    p1: OrbitalIdx,
+    h2: OrbitalIdx,
+    p2: OrbitalIdx,
+    spin: str,
+) -> np.ndarray:
+    """Compute phase for batch of determinants related by double (opposite-spin) excitation h1, h2 <-> p1, p2
+    :param batch:    Batch of Determinants to apply h->p excitation to
+    :param h1, p1:   Hole and particle of the excitation applied to `spin' determinants
+    :param h2, p2:   Hole and particle of the excitation applied to opposite-spin determinants
+    :param spin:     Spin of h1, p1
+    >>> batch = DetArray.from_psi_det([Determinant((0, 1, 4), (0, 4, 5)),
+    ...                                Determinant((0, 1, 2), (0, 1, 5))], 6)
+    >>> batch_opposite_spin_double_phase(batch, 1, 5, 0, 3, "alpha")
+    array([-1,  1], dtype=int8)
+    """
+    oppspin = "beta" if spin == "alpha" else "alpha"
+    return batch_single_phase(batch, h1, p1, spin) * batch_single_phase(batch, h2, p2, oppspin)
+
+
+def batch_excitation(
+    psi_i: DetArray, psi_j: DetArray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Excitation relating each pair psi_i[n], psi_j[n] of determinants, singly or doubly excited
+    from each other. Holes (occupied only in psi_i[n]) and particles (occupied only in psi_j[n]) are
+    sorted by spin, then orbital, so the k-th particle has the spin of the k-th hole; single
+    excitations are padded with a second hole and particle of -1.
+    Phases are the ones of `single_phase', `double_phase', for all the pairs at once.
+    :return: Spins (0 for alpha, 1 for beta) of the holes, holes, particles (all of shape (N, 2)),
+             and phases (+/-1) as an int8 array
+    >>> psi_i = DetArray.from_psi_det([Determinant((0, 1, 8), (0,)),
+    ...                                Determinant((0, 1, 2), (0, 2))], 18)
+    >>> psi_j = DetArray.from_psi_det([Determinant((0, 8, 17), (0,)),
+    ...                                Determinant((0, 1, 5), (0, 3))], 18)
+    >>> spins, h, p, phase = batch_excitation(psi_i, psi_j)
+    >>> spins.tolist(), h.tolist(), p.tolist(), phase.tolist()
+    ([[0, -1], [0, 1]], [[1, -1], [2, 2]], [[17, -1], [5, 3]], [-1, 1])
+    """
+    occupation = psi_i.occupation
+    delta = psi_j.occupation.astype(np.int8) - occupation.astype(np.int8)
+    N = len(psi_i)
+    spins, holes, particles = (np.full((N, 2), -1, dtype=np.int64) for _ in range(3))
+    for sign, orbitals in ((-1, holes), (1, particles)):
+        n, s, o = np.nonzero(delta == sign)  # Sorted by n, then s, then o
+        counts = np.bincount(n, minlength=N)
+        if N and (counts.min() < 1 or counts.max() > 2):
+            raise ValueError("Determinants are not singly or doubly excited from each other")
+        pos = np.arange(len(n)) - np.repeat(np.cumsum(counts) - counts, counts)
+        orbitals[n, pos] = o
+        if sign == -1:
+            spins[n, pos] = s
+    # Parity of the number of occupied orbitals strictly between h and p, from the running counts
+    running = np.cumsum(occupation, axis=2, dtype=np.int16)
+    rows = np.arange(N)
+
+    def parity_between(s, h, p):
+        lo, hi = np.minimum(h, p), np.maximum(h, p)
+        return (running[rows, s, np.maximum(hi - 1, 0)] - running[rows, s, lo]) & 1
+
+    double = holes[:, 1] >= 0
+    parity = parity_between(spins[:, 0], holes[:, 0], particles[:, 0])
+    second = np.maximum(spins[:, 1], 0), np.maximum(holes[:, 1], 0), np.maximum(particles[:, 1], 0)
+    parity += double * parity_between(*second)
+    # Same-spin doubles, as `double_phase'
+    same = double & (spins[:, 0] == spins[:, 1])
+    parity += same * ((holes[:, 1] < particles[:, 0]) + (particles[:, 1] < holes[:, 0]))
+    return spins, holes, particles, (1 - 2 * (parity & 1)).astype(np.int8)
+
+
+def H_triplets_integral_chunk(
+    idx: np.ndarray, values: np.ndarray, psi_i: DetArray, psi_j: DetArray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Compiled kernel; (row, col, value) triplets of <psi_i|H|psi_j> generated by a chunk of two-electron integrals.
+    Contributions are written into preallocated buffers (grown and re-run if too small), with no
+    Python object per matrix element; repeated (row, col) pairs are to be summed by the caller.
+    :param idx:    Canonical (i, j, k, l) indices of the integrals, as an (M, 4) array
+    :param values: Values of the integrals
+    :param psi_i:  Packed determinants, rows
+    :param psi_j:  Packed determinants, columns
+    """
+    if idk_lib is None:
+        raise NotImplementedError("Compiled integral-driven kernels are not built")
+    _, order = psi_j.sorted_keys
+    psi_j_sorted = np.ascontiguousarray(psi_j.words[order])
+    psi_i_words = np.ascontiguousarray(psi_i.words)
+    idx = np.ascontiguousarray(idx, dtype=np.int64)
+    values = np.ascontiguousarray(values, dtype=np.float64)
+    capacity = max(1024, 4 * len(idx))
+    while True:
+        rows = np.empty(capacity, dtype=np.int64)
+        cols = np.empty(capacity, dtype=np.int64)
+        vals = np.empty(capacity, dtype=np.float64)
+        n = idk_lib.H_triplets_integral_chunk(
+            idx,
+            values,
+            len(idx),
+            psi_i_words,
+            len(psi_i),
+            psi_j_sorted,
+            np.ascontiguousarray(order, dtype=np.int64),
+            len(psi_j),
+            psi_j.words.shape[2],
+            rows,
+            cols,
+            vals,
+            capacity,
+        )
+        if n <= capacity:
+            return rows[:n], cols[:n], vals[:n]
+        capacity = n
+
+
+class Bloom_filter:
+    """Compiled kernel; probabilistic membership prefilter over packed determinants.
+    No false negatives; about 0.1% false positives with the default of 16 bits per determinant.
+    The bits are plain uint64 words, so they can be passed as is to compiled kernels
+    (see `bloom_filter.h') to reject determinants at generation time.
+    >>> psi = DetArray.from_psi_det([Determinant((0, 1), (0, 2)), Determinant((0, 3), (1, 2))], 4)
+    >>> bloom = Bloom_filter(psi)
+    >>> bloom.may_contain(psi).tolist()
+    [True, True]
+    """
+
+    def __init__(self, psi: DetArray, bits_per_det: int = 16, n_hashes: int = 8):
+        if idk_lib is None:
+            raise NotImplementedError("Compiled integral-driven kernels are not built")
+        # Filter size is rounded up to a power of 2 (at least one word)
+        self.n_bits_log2 = max(6, int(np.ceil(np.log2(max(1, bits_per_det * len(psi))))))
+        self.n_hashes = n_hashes
+        self.bits = np.zeros(2 ** (self.n_bits_log2 - 6), dtype=np.uint64)
+        words = np.ascontiguousarray(psi.words)
+        idk_lib.bloom_filter_insert(
+            words, len(psi), psi.words.shape[2], self.bits, self.n_bits_log2, self.n_hashes
+        )
+
+    def may_contain(self, psi: DetArray) -> np.ndarray:
+        """False if the |Determinant| is certainly not in the filter, for each |Determinant| of psi"""
+        may_contain = np.zeros(len(psi), dtype=np.uint8)
+        words = np.ascontiguousarray(psi.words)
+        idk_lib.bloom_filter_query(
+            words,
+            len(psi),
+            psi.words.shape[2],
+            self.bits,
+            self.n_bits_log2,
+            self.n_hashes,
+            may_contain,
+        )
+        return may_contain.astype(bool)
+
+
+class External_space_accumulator:
+    """Compiled kernel; hash map (hopscotch, with a word-based hash) from packed |Determinant|
+    to the sum of its PT2 numerator contributions, and the generator (parent) of its first contribution.
+    Same result as `DetArray.accumulate', in one pass and without sorting; determinants are kept
+    in order of first insertion. With `n_states', each contribution is a row of n_states values
+    >>> psi = DetArray.from_psi_det([Determinant((0, 1), (0, 2)), Determinant((0, 3), (1, 2)),
+    ...                              Determinant((0, 1), (0, 2))], 4)
+    >>> accumulator = External_space_accumulator(4)
+    >>> accumulator.add(psi, np.array([1.0, 2.0, 4.0]), np.array([7, 8, 9]))
+    >>> unique, sums, parents = accumulator.result()
+    >>> unique
+    DetArray([Determinant(alpha=(0, 1), beta=(0, 2)), Determinant(alpha=(0, 3), beta=(1, 2))], n_orb=4)
+    >>> sums.tolist(), parents.tolist()
+    ([5.0, 2.0], [7, 8])
+    >>> accumulator = External_space_accumulator(4, n_states=2)
+    >>> accumulator.add(psi, np.array([[1.0, -1.0], [2.0, -2.0], [4.0, -4.0]]), np.array([7, 8, 9]))
+    >>> accumulator.result()[1].tolist()
+    [[5.0, -5.0], [2.0, -2.0]]
+    """
+
+    def __init__(self, n_orb: int, n_states: int = None):
+        if es_lib is None:
+            raise NotImplementedError("Compiled external space accumulator is not built")
+        self.n_orb = n_orb
+        self.n_words = DetArray.n_words(n_orb)
+        # Shape of the contribution of one determinant: a scalar, or a row of n_states values
+        self.value_shape = () if n_states is None else (n_states,)
+        self.handle = es_lib.external_space_create(self.n_words, n_states or 1)
+
+    def __del__(self):
+        if getattr(self, "handle", None):
+            es_lib.external_space_destroy(self.handle)
+            self.handle = None
+
+    def __len__(self):
+        return es_lib.external_space_size(self.handle)
+
+    def add(self, psi: DetArray, values: np.ndarray, parents: np.ndarray):
+        """Add contribution values[i], from generator parents[i], to |Determinant| psi[i]"""
+        es_lib.external_space_add(
+            self.handle,
+            np.ascontiguousarray(psi.words),
+            np.ascontiguousarray(values, dtype=np.float64),
+            np.ascontiguousarray(parents, dtype=np.int64),
+            len(psi),
+        )
+
+    def result(self) -> Tuple[DetArray, np.ndarray, np.ndarray]:
+        """Unique determinants, sums of their contributions, and their parents"""
+        n = len(self)
+        dets = np.empty((n, 2, self.n_words), dtype=np.uint64)
+        sums = np.empty((n, *self.value_shape), dtype=np.float64)
+        parents = np.empty(n, dtype=np.int64)
+        es_lib.external_space_extract(self.handle, dets, sums, parents)
+        return DetArray(dets, self.n_orb), sums, parents
+
+    def clear(self):
+        es_lib.external_space_clear(self.handle)
+
+
+def hole_particle_masks(psi: DetArray, s: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Masks of the occupied (holes) and empty (particles) orbitals of spin s of each determinant
+    of a batch, of shapes (N, n_occ, n_words) and (N, n_orb - n_occ, n_words).
+    All the determinants of the batch have the same number of electrons of spin s"""
+    N = len(psi)
+    orbital_masks = np.stack([DetArray.mask((o,), psi.n_orb) for o in range(psi.n_orb)])
+    occupation = psi.occupation[:, s]
+    n_occ = int(occupation[0].sum()) if N else 0
+    if np.any(occupation.sum(axis=1) != n_occ):
+        raise ValueError("Determinants have different numbers of electrons")
+    h = orbital_masks[np.nonzero(occupation)[1].reshape(N, n_occ)]
+    p = orbital_masks[np.nonzero(~occupation)[1].reshape(N, psi.n_orb - n_occ)]
+    return h, p
+
+
+def single_excitation_masks(psi: DetArray) -> np.ndarray:
+    """XOR masks of all the single excitations of a batch of determinants (alpha ones first), as an
+    array of shape (N, K, 2, n_words): psi.words[I] ^ masks[I, k] is the k-th single excitation of |I>
+    >>> psi = DetArray.from_psi_det([Determinant((0,), (0,))], 2)
+    >>> DetArray((psi.words[:, np.newaxis] ^ single_excitation_masks(psi))[0], 2)
+    DetArray([Determinant(alpha=(1,), beta=(0,)), Determinant(alpha=(0,), beta=(1,))], n_orb=2)
+    """
+    N, n_words = len(psi), psi.words.shape[2]
+    masks = []
+    for s in range(2):
+        h, p = hole_particle_masks(psi, s)
+        singles = (h[:, :, np.newaxis] ^ p[:, np.newaxis, :]).reshape(N, -1, n_words)
+        spin_masks = np.zeros((N, singles.shape[1], 2, n_words), dtype=np.uint64)
+        spin_masks[:, :, s] = singles
+        masks.append(spin_masks)
+    return np.concatenate(masks, axis=1)
+
+
+def excitation_masks(psi: DetArray) -> np.ndarray:
+    """XOR masks of all the single and double excitations of a batch of determinants, as an array of
+    shape (N, K, 2, n_words): psi.words[I] ^ masks[I, k] is the k-th excitation of |I>.
+    All the determinants of the batch have the same number of alpha and beta electrons.
+    >>> psi = DetArray.from_psi_det([Determinant((0,), (0,))], 2)
+    >>> DetArray((psi.words[:, np.newaxis] ^ excitation_masks(psi))[0], 2)
+    DetArray([Determinant(alpha=(1,), beta=(0,)), Determinant(alpha=(0,), beta=(1,)),
+              Determinant(alpha=(1,), beta=(1,))], n_orb=2)
+    """
+    N, n_words = len(psi), psi.words.shape[2]
+    singles, doubles = [], []
+    for s in range(2):
+        # Occupied (holes) and empty (particles) orbitals of each determinant, as masks
+        h, p = hole_particle_masks(psi, s)
+        singles.append((h[:, :, np.newaxis] ^ p[:, np.newaxis, :]).reshape(N, -1, n_words))
+        h1, h2 = np.triu_indices(h.shape[1], 1)
+        p1, p2 = np.triu_indices(p.shape[1], 1)
+        hh, pp = h[:, h1] ^ h[:, h2], p[:, p1] ^ p[:, p2]
+        doubles.append((hh[:, :, np.newaxis] ^ pp[:, np.newaxis, :]).reshape(N, -1, n_words))
+    # Opposite-spin doubles: one alpha and one beta single excitation
+    K_a, K_b = singles[0].shape[1], singles[1].shape[1]
+    shape = (N, K_a, K_b, n_words)
+    opposite = (
+        np.broadcast_to(singles[0][:, :, np.newaxis], shape).reshape(N, -1, n_words),
+        np.broadcast_to(singles[1][:, np.newaxis], shape).reshape(N, -1, n_words),
+    )
+    zeros = [np.zeros_like(m) for m in (singles[0], doubles[0], singles[1], doubles[1])]
+    alpha = [singles[0], doubles[0], zeros[2], zeros[3], opposite[0]]
+    beta = [zeros[0], zeros[1], singles[1], doubles[1], opposite[1]]
+    return np.stack([np.concatenate(alpha, axis=1), np.concatenate(beta, axis=1)], axis=2)
+
+
+def triplet_constraint_keys(psi: DetArray) -> np.ndarray:
+    """Triplet-constraint satisfied by each determinant (its three highest occupied alpha orbitals),
+    as one opaque key per determinant (see `DetArray.keys')"""
+    alpha = psi.occupation[:, 0]
+    # Number of occupied alpha orbitals at or above each orbital
+    above = np.cumsum(alpha[:, ::-1], axis=1)[:, ::-1]
+    C = np.packbits(alpha & (above <= 3), axis=-1, bitorder="little")
+    return np.ascontiguousarray(C).view(np.dtype((np.void, C.shape[1])))[:, 0]
+
+
+def triplet_constrained_excitations_masks(
+    psi: DetArray,
+    C: Tuple[OrbitalIdx, ...],
+    psi_internal: DetArray = None,
+    bloom: Bloom_filter = None,
+    max_degree: int = 2,
+    batch_size: int = 2**20,
+) -> Tuple[DetArray, np.ndarray, np.ndarray]:
+    """Same as `triplet_constrained_excitations', without the compiled kernel: all the excitations
+    of batches of generators are applied as XOR masks (see `excitation_masks', or
+    `single_excitation_masks' with max_degree = 1), and the ones that do not satisfy C are dropped
+    >>> psi = DetArray.from_psi_det([Determinant((0, 1, 2), (0,))], 5)
+    >>> dets, parents, degrees = triplet_constrained_excitations_masks(psi, (1, 2, 3))
+    >>> dets[0], parents.tolist(), degrees.tolist()
+    (Determinant(alpha=(1, 2, 3), beta=(0,)), [0, 0, 0, 0, 0], [1, 2, 2, 2, 2])
+    >>> len(triplet_constrained_excitations_masks(psi, (1, 2, 3), dets[:1])[0])
+    4
+    >>> triplet_constrained_excitations_masks(psi, (1, 2, 3), max_degree=1)[2].tolist()
+    [1]
+    """
+    key_C = triplet_constraint_keys(DetArray.from_psi_det([Determinant(tuple(C), ())], psi.n_orb))
+    # Only generators at most max_degree alpha excitations away from C can reach it: they have at
+    # most max_degree orbitals of C empty, and occupied orbitals above min(C) outside of C
+    mask_C = DetArray.mask(C, psi.n_orb)
+    mask_above = DetArray.between_mask(min(C), psi.n_orb, psi.n_orb) & ~mask_C
+    n_in = len(C) - psi.count_occupied(mask_C, "alpha").astype(np.int64)
+    n_out = psi.count_occupied(mask_above, "alpha").astype(np.int64)
+    reachable = np.flatnonzero((n_in <= max_degree) & (n_out <= max_degree))
+    masks_of = single_excitation_masks if max_degree == 1 else excitation_masks
+    n_excitations = masks_of(psi[:1]).shape[1] if len(psi) else 1
+    step = max(1, batch_size // n_excitations)
+    dets, parents, degrees = [np.zeros((0, *psi.words.shape[1:]), dtype=np.uint64)], [], []
+    for start in range(0, len(reachable), step):
+        generators = reachable[start : start + step]
+        batch = psi[generators]
+        masks = masks_of(batch)
+        excited = DetArray(
+            (batch.words[:, np.newaxis] ^ masks).reshape(-1, *batch.words.shape[1:]), psi.n_orb
+        )
+        keep = triplet_constraint_keys(excited) == key_C[0]
+        if psi_internal is not None:
+            candidates = np.flatnonzero(keep)
+            if bloom is not None:
+                candidates = candidates[bloom.may_contain(excited[candidates])]
+            keep[candidates[psi_internal.index(excited[candidates]) >= 0]] = False
+        dets.append(excited.words[keep])
+        parents.append(generators[np.flatnonzero(keep) // masks.shape[1]])
+        # Number of spin-orbitals changed, twice the excitation degree
+        n_changed = DetArray.popcount(masks).sum(axis=(2, 3)).reshape(-1)
+        degrees.append((n_changed[keep] // 2).astype(np.int8))
+    return (
+        DetArray(np.concatenate(dets), psi.n_orb),
+        np.concatenate(parents + [np.zeros(0, dtype=np.int64)]),
+        np.concatenate(degrees + [np.zeros(0, dtype=np.int8)]),
+    )
+
+
+def triplet_constrained_excitations(
+    psi: DetArray,
+    C: Tuple[OrbitalIdx, ...],
+    psi_internal: DetArray = None,
+    bloom: Bloom_filter = None,
+    max_degree: int = 2,
+) -> Tuple[DetArray, np.ndarray, np.ndarray]:
+    """Compiled kernel; all determinants singly or doubly (only singly, with max_degree = 1) connected
+    to a |Determinant| of psi (the generators), and satisfying triplet-constraint C.
+    Determinants of psi_internal are rejected at generation time,
+    after the `bloom' prefilter (if any). Without the compiled kernel, falls back to
+    `triplet_constrained_excitations_masks' (same determinants, in another order).
+    Return the packed determinants, the index in psi of their generator, and their excitation degree
+    >>> psi = DetArray.from_psi_det([Determinant((0, 1, 2), (0,))], 5)
+    >>> dets, parents, degrees = triplet_constrained_excitations(psi, (1, 2, 3))
+    >>> dets[0], parents.tolist(), degrees.tolist()
+    (Determinant(alpha=(1, 2, 3), beta=(0,)), [0, 0, 0, 0, 0], [1, 2, 2, 2, 2])
+    >>> len(triplet_constrained_excitations(psi, (1, 2, 3), dets[:1])[0])
+    4
+    >>> triplet_constrained_excitations(psi, (1, 2, 3), max_degree=1)[2].tolist()
+    [1]
+    """
+    if det_lib is None:
+        return triplet_constrained_excitations_masks(psi, C, psi_internal, bloom, max_degree)
+    n_words = psi.words.shape[2]
+    # No internal determinants, and no prefilter (0 hash functions) by default
+    internal_sorted, filter_bits = np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.uint64)
+    n_bits_log2, n_hashes = 0, 0
+    if psi_internal is not None:
+        _, order = psi_internal.sorted_keys
+        internal_sorted = np.ascontiguousarray(psi_internal.words[order])
+        if bloom is not None:
+            filter_bits, n_bits_log2, n_hashes = bloom.bits, bloom.n_bits_log2, bloom.n_hashes
+    psi_words = np.ascontiguousarray(psi.words)
+    constraint = np.array(C, dtype=np.int64)
+    # Number of connected determinants satisfying C, before rejecting the internal ones:
+    # buffers are large enough for a single call of the kernel
+    capacity = int(constraint_connections(C, psi, psi.n_orb, max_degree).sum())
+    while True:
+        dets = np.empty((capacity, 2, n_words), dtype=np.uint64)
+        parents = np.empty(capacity, dtype=np.int64)
+        degrees = np.empty(capacity, dtype=np.int8)
+        n = det_lib.triplet_constrained_excitations(
+            psi_words,
+            len(psi),
+            n_words,
+            psi.n_orb,
+            constraint,
+            max_degree,
+            internal_sorted,
+            len(internal_sorted),
+            filter_bits,
+            n_bits_log2,
+            n_hashes,
+            dets,
+            parents,
+            degrees,
+            capacity,
+        )
+        if n <= capacity:
+            return DetArray(dets[:n], psi.n_orb), parents[:n], degrees[:n]
+        capacity = n
+
+
 #   _   _                 _ _ _              _
 #  | | | |               (_) | |            (_)
 #  | |_| | __ _ _ __ ___  _| | |_ ___  _ __  _  __ _ _ __
@@ -272,6 +821,14 @@ class Hamiltonian_one_electron(object):
         res += sum(self.H_ij_orbital(i, i) for i in det_i.beta)
         return res
 
+    def orbital_diagonal(self, n_orb: int) -> np.ndarray:
+        """Diagonal one-electron integrals h_ii, as a vector"""
+        return np.array([self.integrals.get((i, i), 0.0) for i in range(n_orb)])
+
+    def H_ii_batch(self, psi: DetArray) -> np.ndarray:
+        """Diagonal elements <I|H|I> of a batch of |Determinant|, from occupation vectors"""
+        return self.E0 + psi.occupation.sum(axis=1) @ self.orbital_diagonal(psi.n_orb)
+
     def H_ij(self, det_i: Determinant, det_j: Determinant) -> Energy:
         """General function to dispatch the evaluation of H_ij"""
 
@@ -293,6 +850,19 @@ class Hamiltonian_one_electron(object):
         else:
             return 0.0
 
+    def matrix(self, n_orb: int) -> np.ndarray:
+        """One-electron integrals h_ij, as an n_orb x n_orb matrix"""
+        return np.array(
+            [[self.integrals.get((i, j), 0.0) for j in range(n_orb)] for i in range(n_orb)]
+        )
+
+    def H_ij_batch(self, psi_i: DetArray, psi_j: DetArray, excitation=None) -> np.ndarray:
+        """<I|H|J> for pairs of packed determinants, singly or doubly excited from each other
+        (0 for doubles). `excitation' is the result of `batch_excitation', if already computed"""
+        _, h, p, phase = batch_excitation(psi_i, psi_j) if excitation is None else excitation
+        single = h[:, 1] < 0
+        return np.where(single, phase * self.matrix(psi_i.n_orb)[h[:, 0], p[:, 0]], 0.0)
+
     def H(self, psi_i, psi_j) -> List[List[Energy]]:
         h = np.array([self.H_ij(det_i, det_j) for det_i, det_j in product(psi_i, psi_j)])
         return h.reshape(len(psi_i), len(psi_j))
@@ -354,6 +924,99 @@ class Hamiltonian_two_electrons(object):
     def H_ii(self, det_i: Determinant):
         return sum(phase * self.H_ijkl_orbital(*idx) for idx, phase in self.H_ii_indices(det_i))
 
+    @cached_property
+    def J_K_matrices(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Coulomb J_ij = <ij|ij> and exchange K_ij = <ij|ji> integrals, as N_orb x N_orb matrices"""
+        J = np.zeros((self.N_orb, self.N_orb))
+        K = np.zeros((self.N_orb, self.N_orb))
+        for i, j in product(range(self.N_orb), repeat=2):
+            J[i, j] = self.d_two_e_integral.get(compound_idx4(i, j, i, j), 0.0)
+            K[i, j] = self.d_two_e_integral.get(compound_idx4(i, j, j, i), 0.0)
+        return J, K
+
+    def H_ii_batch(self, psi: DetArray) -> np.ndarray:
+        r"""Diagonal elements <I|H|I> of a batch of |Determinant|, from occupation vectors:
+        1/2 \sum_s n_s^T (J - K) n_s + n_alpha^T J n_beta. (J_ii = K_ii, so i = j terms cancel.)"""
+        J, K = self.J_K_matrices
+        n_alpha, n_beta = (psi.occupation[:, s, : self.N_orb].astype(float) for s in (0, 1))
+        return 0.5 * (
+            np.einsum("ni,ij,nj->n", n_alpha, J - K, n_alpha)
+            + np.einsum("ni,ij,nj->n", n_beta, J - K, n_beta)
+        ) + np.einsum("ni,ij,nj->n", n_alpha, J, n_beta)
+
+    def orbital_energies(self, psi: DetArray) -> np.ndarray:
+        r"""Two-electron part of the derivative of <I|H|I> with respect to the occupation of each
+        spin-orbital, as an array of shape (N, 2, N_orb): \sum_j (J - K)_oj n_js + J_oj n_jt"""
+        J, K = self.J_K_matrices
+        n_alpha, n_beta = (psi.occupation[:, s, : self.N_orb].astype(float) for s in (0, 1))
+        return np.stack(
+            [n_alpha @ (J - K) + n_beta @ J, n_beta @ (J - K) + n_alpha @ J], axis=1
+        )
+
+    @cached_property
+    def integral_arrays(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Compound indices (sorted) and values of the two-electron integrals, for batch lookups"""
+        keys = np.fromiter(self.d_two_e_integral.keys(), dtype=np.int64)
+        values = np.fromiter(self.d_two_e_integral.values(), dtype="float")
+        order = np.argsort(keys)
+        return keys[order], values[order]
+
+    def H_ijkl_orbital_batch(self, i, j, k, l) -> np.ndarray:
+        """<ij|kl> for arrays of orbital indices, element-wise; absent integrals are 0"""
+        keys, values = self.integral_arrays
+        idx4 = compound_idx4_batch(i, j, k, l)
+        if len(keys) == 0:
+            return np.zeros(idx4.shape)
+        pos = np.minimum(np.searchsorted(keys, idx4), len(keys) - 1)
+        return np.where(keys[pos] == idx4, values[pos], 0.0)
+
+    @cached_property
+    def single_excitation_integrals(self) -> Tuple[np.ndarray, np.ndarray]:
+        """<hi|pi> and <hi|ip>, as N_orb x N_orb x N_orb arrays indexed by [h, p, i]"""
+        h, p, i = np.indices((self.N_orb,) * 3)
+        return self.H_ijkl_orbital_batch(h, i, p, i), self.H_ijkl_orbital_batch(h, i, i, p)
+
+    def H_ij_batch(self, psi_i: DetArray, psi_j: DetArray, excitation=None) -> np.ndarray:
+        r"""Two-electron part of <I|H|J> for pairs of packed determinants, singly or doubly excited
+        from each other (same integrals as `H_ij_indices'). For a single h -> p of spin s,
+            phase * \sum_i n_is (<hi|pi> - <hi|ip>) + n_it <hi|pi>,
+        for doubles, phase * (<h1h2|p1p2> - <h1h2|p2p1>) within a spin, phase * <h1h2|p1p2>
+        otherwise.
+        `excitation' is the result of `batch_excitation', if already computed"""
+        spins, h, p, phase = batch_excitation(psi_i, psi_j) if excitation is None else excitation
+        H_ij = np.zeros(len(psi_i))
+        single = h[:, 1] < 0
+        n = np.flatnonzero(single)
+        if len(n):
+            J, K = self.single_excitation_integrals
+            J_hp, K_hp = J[h[n, 0], p[n, 0]], K[h[n, 0], p[n, 0]]
+            occupation = psi_i[n].occupation[:, :, : self.N_orb]
+            rows, s = np.arange(len(n)), spins[n, 0]
+            H_ij[n] = np.einsum("ni,ni->n", occupation[rows, s], J_hp - K_hp) + np.einsum(
+                "ni,ni->n", occupation[rows, 1 - s], J_hp
+            )
+        n = np.flatnonzero(~single)
+        h1, h2, p1, p2 = h[n, 0], h[n, 1], p[n, 0], p[n, 1]
+        same_spin = spins[n, 0] == spins[n, 1]
+        H_ij[n] = self.H_ijkl_orbital_batch(h1, h2, p1, p2) - same_spin * self.H_ijkl_orbital_batch(
+            h1, h2, p2, p1
+        )
+        return phase * H_ij
+
+    def H_triplets(self, psi_i, psi_j) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """(row, col, value) arrays of the contributions to <psi_i|H|psi_j>.
+        Repeated (row, col) pairs are to be summed."""
+        rows, cols, vals = [], [], []
+        for (I, J), idx, phase in self.H_indices(psi_i, psi_j):
+            rows.append(I)
+            cols.append(J)
+            vals.append(phase * self.H_ijkl_orbital(*idx))
+        return (
+            np.array(rows, dtype=np.int64),
+            np.array(cols, dtype=np.int64),
+            np.array(vals, dtype="float"),
+        )
+
 
 #   ___            _
 #    |       _    |_ |  _   _ _|_ ._ _  ._   _
@@ -460,6 +1123,36 @@ class Hamiltonian_two_electrons_determinant_driven(Hamiltonian_two_electrons, ob
 @dataclass
 class Hamiltonian_two_electrons_integral_driven(Hamiltonian_two_electrons, object):
     d_two_e_integral: Two_electron_integral
+    # Build the matrix elements of categories C-G with the compiled kernels, if they are built
+    use_compiled_kernels: bool = idk_lib is not None
+    # Number of integrals of one category handed to a compiled kernel at once
+    integral_chunk_size: int = 4096
+
+    compiled_categories = ("C", "D", "E", "F", "G")
+
+    @cached_property
+    def integrals_by_category(self) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+        """Canonical indices (as an (M, 4) array) and values of the two-electron integrals, by category
+        >>> d_two_e_integral = {compound_idx4(0, 0, 0, 0): 1., compound_idx4(0, 1, 0, 2): 2.,
+        ...                     compound_idx4(0, 2, 1, 3): 3., compound_idx4(0, 1, 0, 3): 4.}
+        >>> d = Hamiltonian_two_electrons_integral_driven(d_two_e_integral).integrals_by_category
+        >>> sorted(d)
+        ['A', 'C', 'G']
+        >>> d["C"]
+        (array([[0, 1, 0, 2],
+               [0, 1, 0, 3]]), array([2., 4.]))
+        """
+        by_category = defaultdict(list)
+        for idx4, value in self.d_two_e_integral.items():
+            idx = compound_idx4_reverse(idx4)
+            by_category[integral_category(*idx)].append((idx, value))
+        return {
+            category: (
+                np.array([idx for idx, _ in l], dtype=np.int64).reshape(-1, 4),
+                np.array([value for _, value in l], dtype="float"),
+            )
+            for category, l in sorted(by_category.items())
+        }
 
     @staticmethod
     def get_dets_occ_in_orbitals(
@@ -521,18 +1214,13 @@ class Hamiltonian_two_electrons_integral_driven(Hamiltonian_two_electrons, objec
         phase: int,
     ):
         # contribution from integrals to diagonal elements
-        for a in det_indices:
-            # Handle PT2 case when psi_i != psi_j. In this case, psi_i[a] won't be in the external space and so error will be thrown
-            if psi_i[a] in det_to_index_j:
-                yield (
-                    (
-                        a,
-                        det_to_index_j[psi_i[a]],
-                    ),
-                    phase,
-                )  # Yield (a, J) v. (a, a) for MPI implementation
-            else:
-                pass
+        I, batch_of_dets = take_batch(psi_i, det_indices, 0)
+        if len(I) == 0:  # Nothing to excite
+            return
+        # Handle PT2 case when psi_i != psi_j. In this case, psi_i[a] won't be in the external space
+        J = batch_index(det_to_index_j, batch_of_dets)
+        for a, b in zip(I[J >= 0].tolist(), J[J >= 0].tolist()):
+            yield (a, b), phase  # Yield (a, J) v. (a, a) for MPI implementation
 
     @staticmethod
     def do_single(
@@ -550,27 +1238,21 @@ class Hamiltonian_two_electrons_integral_driven(Hamiltonian_two_electrons, objec
         Called by category functions corresponding to single excitations
 
         For use in building the Hamiltonian in the variational step"""
-        # TODO: Just for proof of concept, can do this outside the function later
-        # det_indices is from itertools, so it is de-allocated after one pass through it. So, yield (I, D_I) pairs
-        batch_of_dets = [(I, psi_internal[I]) for I in det_indices]
+        # det_indices is from itertools, so it is de-allocated after one pass through it. So, pack (I, D_I) pairs
+        I, batch_of_dets = take_batch(psi_internal, det_indices, max(h, p) + 1)
+        if len(I) == 0:  # Nothing to excite
+            return
         # In order
         #   1. Apply simultaneous single h -> p excitation to pre-filtered determinants in `batch_of_dets`
-        exc_batch = batch_apply_single_excitation(
-            [index_det_pair[1] for index_det_pair in batch_of_dets], h, p, spin
-        )
+        exc_batch = batch_apply_single_excitation(batch_of_dets, h, p, spin)
         #   2. Batch filter of excitation pairs based on whether excitation is \in psi_internal
-        filtered_pairs = [
-            (index_det_pair[0], det_to_index[exc_det_I])
-            for index_det_pair, exc_det_I in zip(batch_of_dets, exc_batch)
-            if (exc_det_I in det_to_index)
-        ]
+        J = batch_index(det_to_index, exc_batch)
+        filtered = J >= 0
         #   3. Compute phase for filtered pairs
         #      (phasemod is \pm 1; accounts for whether integral is coulomb or exchange)
-        phase_of_batch = phasemod * batch_single_phase(
-            [psi_internal[I] for (I, _) in filtered_pairs], h, p, spin
-        )
+        phase_of_batch = phasemod * batch_single_phase(batch_of_dets[filtered], h, p, spin)
         # Yield (I, J), phase pairs for computing <I|H|J>
-        for (I, J), phase in zip(filtered_pairs, phase_of_batch):
+        for I, J, phase in zip(I[filtered].tolist(), J[filtered].tolist(), phase_of_batch.tolist()):
             yield (I, J), phase
 
     @staticmethod
@@ -588,26 +1270,21 @@ class Hamiltonian_two_electrons_integral_driven(Hamiltonian_two_electrons, objec
         Excitations from pre-filtered list of candidate |Determinant|s indicated by `det_indices`
         Called by category functions corresponding to single excitations
 
-        For use in computing E_pt2 and subsequent selection"""
-        # det_indices is from itertools, so it is de-allocated after one pass through it. So, yield (I, D_I) pairs
-        batch_of_dets = [(I, psi_internal[I]) for I in det_indices]
+        For use in computing E_pt2 and subsequent selection
+        Yields one ((I, packed |J⟩), phases) batch, I and phases as arrays"""
+        # det_indices is from itertools, so it is de-allocated after one pass through it. So, pack (I, D_I) pairs
+        I, batch_of_dets = take_batch(psi_internal, det_indices, max(h, p) + 1)
+        if len(I) == 0:  # Nothing to excite
+            return
         # In order
         #   1. Apply simultaneous single h -> p excitation to pre-filtered determinants in `batch_of_dets`
-        exc_batch = batch_apply_single_excitation(
-            [index_det_pair[1] for index_det_pair in batch_of_dets], h, p, spin
-        )
+        exc_batch = batch_apply_single_excitation(batch_of_dets, h, p, spin)
         #   2. Organize excitation pairs of (I, det_J); I is index of det_I \in psi_internal, det_J in connected
-        int_ext_pairs = [
-            (int_index_det_pair[0], exc_det_I)
-            for int_index_det_pair, exc_det_I in zip(batch_of_dets, exc_batch)
-        ]
         #   3. Compute phase for batch excitation pairs
-        phase_of_batch = phasemod * batch_single_phase(
-            [det_I for (_, det_I) in batch_of_dets], h, p, spin
-        )
-        # Yield (I, J), phase pairs for computing <I|H|J>
-        for (I, det_J), phase in zip(int_ext_pairs, phase_of_batch):
-            yield (I, det_J), phase
+        phase_of_batch = phasemod * batch_single_phase(batch_of_dets, h, p, spin)
+        # Yield the whole batch of (I, J) pairs, and their phases, for computing <I|H|J>
+        # |J⟩ are kept packed; they are accumulated as such
+        yield (I, exc_batch), phase_of_batch
 
     @staticmethod
     def do_double_samespin(
@@ -631,32 +1308,22 @@ class Hamiltonian_two_electrons_integral_driven(Hamiltonian_two_electrons, objec
             spindet_occ_i, {}, {"same": {h1, h2}}, {"same": {p1, p2}}
         )
         # Get (I, D_I) pairs of dets indicaated by det_indices_AA
-        batch_of_dets = [(I, psi_internal[I]) for I in det_indices_AA]
+        I, batch_of_dets = take_batch(psi_internal, det_indices_AA, max(h1, p1, h2, p2) + 1)
+        if len(I) == 0:  # Nothing to excite
+            return
         # In order
         #   1. Apply simultaneous single h -> p excitation to pre-filtered determinants in `batch_of_dets`
-        exc_batch = batch_apply_same_spin_double_excitation(
-            [index_det_pair[1] for index_det_pair in batch_of_dets],
-            h1,
-            p1,
-            h2,
-            p2,
-            spin,
-        )
+        exc_batch = batch_apply_same_spin_double_excitation(batch_of_dets, h1, p1, h2, p2, spin)
         #   2. Batch filter of excitation pairs based on whether excitation is \in psi_internal
-        filtered_pairs = [
-            (index_det_pair[0], det_to_index[exc_det_I])
-            for index_det_pair, exc_det_I in zip(batch_of_dets, exc_batch)
-            if (exc_det_I in det_to_index)
-        ]
+        J = batch_index(det_to_index, exc_batch)
+        filtered = J >= 0
         #   3. Compute phase for filtered pairs
-        phase_of_batch = batch_double_phase(
-            [psi_internal[I] for (I, _) in filtered_pairs], h1, p1, h2, p2, spin
-        )
+        phase_of_batch = batch_double_phase(batch_of_dets[filtered], h1, p1, h2, p2, spin)
         # For exchange integrals;
         if np.sign(h2 - h1) != np.sign(p2 - p1):
             phase_of_batch *= -1
         # Yield (I, J), phase pairs for computing <I|H|J>
-        for (I, J), phase in zip(filtered_pairs, phase_of_batch):
+        for I, J, phase in zip(I[filtered].tolist(), J[filtered].tolist(), phase_of_batch.tolist()):
             yield (I, J), phase
 
     @staticmethod
@@ -673,7 +1340,8 @@ class Hamiltonian_two_electrons_integral_driven(Hamiltonian_two_electrons, objec
         """Do double excitations from i <-> j, k <-> l; hp1 = i, j or j, i, hp2 = k, l or l, k, particle-hole pairs
         Electrons involved are of the same spin
 
-        For use in computing E_pt2 and subsequent selection"""
+        For use in computing E_pt2 and subsequent selection
+        Yields one ((I, packed |J⟩), phases) batch, I and phases as arrays"""
         # Opposite-spin double excitations for category G
         a1 = min(C)  # `Lowest` constraint orbital
         # Unpack hole-particle pairs (both of input spin)
@@ -772,34 +1440,23 @@ class Hamiltonian_two_electrons_integral_driven(Hamiltonian_two_electrons, objec
             )
 
         # Organized filtered dets into index, determinant (I, D_I) pairs
-        batch_of_dets = [(I, psi[I]) for I in det_indices_AA]
+        I, batch_of_dets = take_batch(psi, det_indices_AA, n_orb)
+        if len(I) == 0:  # Nothing to excite
+            return
         # In order
         #   1. Apply simultaneous single h1, h2 -> p1, p2 (same-spin) excitation to pre-filtered determinants in `batch_of_dets`
-        exc_batch = batch_apply_same_spin_double_excitation(
-            [index_det_pair[1] for index_det_pair in batch_of_dets],
-            h1,
-            p1,
-            h2,
-            p2,
-            spin,
-        )
+        exc_batch = batch_apply_same_spin_double_excitation(batch_of_dets, h1, p1, h2, p2, spin)
         #   2. Organize excitation pairs of (I, det_J);
         #       a. I is index of det_I \in psi
         #       b. det_J is the determinant connected to det_I via h1, h2 -> p1, p2
-        int_ext_pairs = [
-            (int_index_det_pair[0], exc_det_I)
-            for int_index_det_pair, exc_det_I in zip(batch_of_dets, exc_batch)
-        ]
         #   3. Compute phase for filtered pairs
-        phase_of_batch = batch_double_phase(
-            [psi[I] for (I, _) in int_ext_pairs], h1, p1, h2, p2, spin
-        )
+        phase_of_batch = batch_double_phase(batch_of_dets, h1, p1, h2, p2, spin)
         # For exchange integrals;
         if np.sign(h2 - h1) != np.sign(p2 - p1):
             phase_of_batch *= -1
-        # Yield (I, J), phase pairs for computing <I|H|J>
-        for (I, det_J), phase in zip(int_ext_pairs, phase_of_batch):
-            yield (I, det_J), phase
+        # Yield the whole batch of (I, J) pairs, and their phases, for computing <I|H|J>
+        # |J⟩ are kept packed; they are accumulated as such
+        yield (I, exc_batch), phase_of_batch
 
     @staticmethod
     def do_double_oppspin(
@@ -826,36 +1483,24 @@ class Hamiltonian_two_electrons_integral_driven(Hamiltonian_two_electrons, objec
             {"same": {p1}, "opposite": {p2}},
         )
         # Get (I, D_I) pairs of dets indicaated by det_indices_AA
-        batch_of_dets = [(I, psi_internal[I]) for I in det_indices_AB]
+        I, batch_of_dets = take_batch(psi_internal, det_indices_AB, max(h1, p1, h2, p2) + 1)
+        if len(I) == 0:  # Nothing to excite
+            return
         # In order
         #   1. Apply simultaneous single ha, hb -> pa, pb excitation to pre-filtered determinants in `batch_of_dets`
         if spin == "alpha":
-            exc_batch = batch_apply_opposite_spin_double_excitation(
-                [index_det_pair[1] for index_det_pair in batch_of_dets], h1, p1, h2, p2
-            )
-            oppspin = "beta"
+            exc_batch = batch_apply_opposite_spin_double_excitation(batch_of_dets, h1, p1, h2, p2)
         else:  # Spin is `beta`
-            exc_batch = batch_apply_opposite_spin_double_excitation(
-                [index_det_pair[1] for index_det_pair in batch_of_dets], h2, p2, h1, p1
-            )
-            oppspin = "alpha"
+            exc_batch = batch_apply_opposite_spin_double_excitation(batch_of_dets, h2, p2, h1, p1)
         #   2. Batch filter of excitation pairs based on whether excitation is \in psi_internal
-        filtered_pairs = [
-            (index_det_pair[0], det_to_index[exc_det_I])
-            for index_det_pair, exc_det_I in zip(batch_of_dets, exc_batch)
-            if (exc_det_I in det_to_index)
-        ]
+        J = batch_index(det_to_index, exc_batch)
+        filtered = J >= 0
         #   3. Compute phase for filtered pairs
-        phaseA_of_batch = batch_single_phase(
-            [psi_internal[I] for (I, _) in filtered_pairs], h1, p1, spin
-        )
-        phaseB_of_batch = batch_single_phase(
-            [psi_internal[I] for (I, _) in filtered_pairs], h2, p2, oppspin
+        phase_of_batch = batch_opposite_spin_double_phase(
+            batch_of_dets[filtered], h1, p1, h2, p2, spin
         )
-        # Element-wise multiplication of phaseA, phaseB
-        phase_of_batch = phaseA_of_batch * phaseB_of_batch
         # Yield (I, J), phase pairs for computing <I|H|J>
-        for (I, J), phase in zip(filtered_pairs, phase_of_batch):
+        for I, J, phase in zip(I[filtered].tolist(), J[filtered].tolist(), phase_of_batch.tolist()):
             yield (I, J), phase
 
     @staticmethod
@@ -872,7 +1517,8 @@ class Hamiltonian_two_electrons_integral_driven(Hamiltonian_two_electrons, objec
         """Do double excitations from i <-> j, k <-> l; hp1 = i, j or j, i, hp2 = k, l or l, k, particle-hole pairs
         Electrons involved are of the opposite-spin
 
-        For use in computing E_pt2 energy and subsequent selection"""
+        For use in computing E_pt2 energy and subsequent selection
+        Yields one ((I, packed |J⟩), phases) batch, I and phases as arrays"""
         # Opposite-spin double excitations for category G only
         a1 = min(C)  # `Lowest` constraint orbital
         # Unpack hole-particle pairs
@@ -955,34 +1601,23 @@ class Hamiltonian_two_electrons_integral_driven(Hamiltonian_two_electrons, objec
                 )
 
         # Organized filtered dets into index, determinant (I, D_I) pairs
-        batch_of_dets = [(I, psi[I]) for I in det_indices_AB]
+        I, batch_of_dets = take_batch(psi, det_indices_AB, n_orb)
+        if len(I) == 0:  # Nothing to excite
+            return
         # In order
         #   1. Apply simultaneous single ha, hb -> pa, pb excitation to pre-filtered determinants in `batch_of_dets`
         if spin == "alpha":
-            exc_batch = batch_apply_opposite_spin_double_excitation(
-                [index_det_pair[1] for index_det_pair in batch_of_dets], h1, p1, h2, p2
-            )
-            oppspin = "beta"
+            exc_batch = batch_apply_opposite_spin_double_excitation(batch_of_dets, h1, p1, h2, p2)
         else:  # Spin is `beta`
-            exc_batch = batch_apply_opposite_spin_double_excitation(
-                [index_det_pair[1] for index_det_pair in batch_of_dets], h2, p2, h1, p1
-            )
-            oppspin = "alpha"
+            exc_batch = batch_apply_opposite_spin_double_excitation(batch_of_dets, h2, p2, h1, p1)
         #   2. Organize excitation pairs of (I, det_J);
         #       a. I is index of det_I \in psi
         #       b. det_J is the determinant connected to det_I via h1, h2 -> p1, p2
-        int_ext_pairs = [
-            (int_index_det_pair[0], exc_det_I)
-            for int_index_det_pair, exc_det_I in zip(batch_of_dets, exc_batch)
-        ]
         #   3. Compute phase for filtered pairs
-        phaseA_of_batch = batch_single_phase([psi[I] for (I, _) in int_ext_pairs], h1, p1, spin)
-        phaseB_of_batch = batch_single_phase([psi[I] for (I, _) in int_ext_pairs], h2, p2, oppspin)
-        # Element-wise multiplication of phaseA, phaseB
-        phase_of_batch = phaseA_of_batch * phaseB_of_batch
-        # Yield (I, J), phase pairs for computing <I|H|J>
-        for (I, det_J), phase in zip(int_ext_pairs, phase_of_batch):
-            yield (I, det_J), phase
+        phase_of_batch = batch_opposite_spin_double_phase(batch_of_dets, h1, p1, h2, p2, spin)
+        # Yield the whole batch of (I, J) pairs, and their phases, for computing <I|H|J>
+        # |J⟩ are kept packed; they are accumulated as such
+        yield (I, exc_batch), phase_of_batch
 
     @staticmethod
     def category_A(
@@ -2150,9 +2785,10 @@ class Hamiltonian_two_electrons_integral_driven(Hamiltonian_two_electrons, objec
         self, psi_i: Psi_det, psi_j: Psi_det
     ) -> Iterator[Two_electron_integral_index_phase]:
         # Returns H_indices, and idx of associated integral
-        generator = H_indices_generator(psi_i, psi_j)
+        generator = H_indices_generator(psi_i, psi_j, self.N_orb)
         spindet_a_occ_i, spindet_b_occ_i = generator.spindet_occ_int
-        det_to_index_j = generator.det_to_index
+        # Excitations are applied to packed batches of psi_i, and looked up in packed psi_j
+        psi_i, det_to_index_j = generator.psi_i_packed, generator.psi_j_packed
         for idx4, _ in self.d_two_e_integral.items():
             idx = compound_idx4_reverse(idx4)
             for (
@@ -2190,16 +2826,17 @@ class Hamiltonian_two_electrons_integral_driven(Hamiltonian_two_electrons, objec
         self, psi_i: Psi_det, C: Tuple[OrbitalIdx, ...]
     ) -> Iterator[Two_electron_integral_index_phase]:
         # Returns H_indices, and idx of associated integral
-        # For pt2 selection!
-        generator = H_indices_generator(psi_i)
+        # For pt2 selection! Pairs come in batches per integral: (I, packed |J⟩), idx, phases
+        generator = H_indices_generator(psi_i, n_orb=self.N_orb)
         spindet_a_occ_i, spindet_b_occ_i = generator.spindet_occ_int
+        psi_i = generator.psi_i_packed
         for idx4, _ in self.d_two_e_integral.items():
             idx = compound_idx4_reverse(idx4)
             for (
-                (I, det_J),
-                phase,
+                (I, psi_J),
+                phases,
             ) in self.H_indices_idx_pt2(idx, psi_i, C, spindet_a_occ_i, spindet_b_occ_i):
-                yield (I, det_J), idx, phase
+                yield (I, psi_J), idx, phases
 
     def H_indices_idx_pt2(
         self,
@@ -2236,19 +2873,49 @@ class Hamiltonian_two_electrons_integral_driven(Hamiltonian_two_electrons, objec
                 idx, psi_i, C, spindet_a_occ_i, spindet_b_occ_i, self.N_orb
             )
 
+    def H_triplets(self, psi_i, psi_j) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """(row, col, value) arrays of the contributions to <psi_i|H|psi_j>.
+        Repeated (row, col) pairs are to be summed.
+        Integrals are processed one category at a time; categories C-G go through the compiled
+        kernels chunk by chunk (if enabled), the others through the Python generators."""
+        generator = H_indices_generator(psi_i, psi_j, self.N_orb)
+        psi_i, det_to_index_j = generator.psi_i_packed, generator.psi_j_packed
+        triplets = []
+        for category, (idx, values) in self.integrals_by_category.items():
+            if self.use_compiled_kernels and category in self.compiled_categories:
+                for start in range(0, len(idx), self.integral_chunk_size):
+                    stop = start + self.integral_chunk_size
+                    triplets.append(
+                        H_triplets_integral_chunk(
+                            idx[start:stop], values[start:stop], psi_i, det_to_index_j
+                        )
+                    )
+                continue
+            spindet_a_occ_i, spindet_b_occ_i = generator.spindet_occ_int
+            rows, cols, vals = [], [], []
+            for ijkl, value in zip(idx.tolist(), values.tolist()):
+                for (a, b), phase in self.H_indices_idx(
+                    tuple(ijkl), psi_i, det_to_index_j, spindet_a_occ_i, spindet_b_occ_i
+                ):
+                    rows.append(a)
+                    cols.append(b)
+                    vals.append(phase * value)
+            triplets.append(
+                (
+                    np.array(rows, dtype=np.int64),
+                    np.array(cols, dtype=np.int64),
+                    np.array(vals, dtype="float"),
+                )
+            )
+        if not triplets:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+        return tuple(np.concatenate(t) for t in zip(*triplets))
+
     def H(self, psi_i, psi_j) -> List[List[Energy]]:
-        generator = H_indices_generator(psi_i, psi_j)
-        spindet_a_occ_i, spindet_b_occ_i = generator.spindet_occ_int
-        det_to_index_j = generator.det_to_index
         # This is the function who will take foreever
         h = np.zeros(shape=(len(psi_i), len(psi_j)))
-        for idx4, integral_values in self.d_two_e_integral.items():
-            idx = compound_idx4_reverse(idx4)
-            for (
-                (a, b),
-                phase,
-            ) in self.H_indices_idx(idx, psi_i, det_to_index_j, spindet_a_occ_i, spindet_b_occ_i):
-                h[a, b] += phase * integral_values
+        rows, cols, vals = self.H_triplets(psi_i, psi_j)
+        np.add.at(h, (rows, cols), vals)
         return h
 
 
@@ -2258,7 +2925,7 @@ class H_indices_generator(object):
     Re-created at each CIPSI iteration; i.e. for each new list of internal determinants.
     """
 
-    def __init__(self, psi_internal: Psi_det, psi_external: Psi_det = None):
+    def __init__(self, psi_internal: Psi_det, psi_external: Psi_det = None, n_orb: int = None):
         # Application dependent
         # If Davidson diagonalization, psi_i = psi_j
         # If PT2 selection, psi_i \neq psi_j
@@ -2266,6 +2933,8 @@ class H_indices_generator(object):
             psi_external = psi_internal
         self.psi_i = psi_internal
         self.psi_j = psi_external
+        # Needed to pack the determinants
+        self.n_orb = n_orb
 
     @staticmethod
     def get_spindet_a_occ_spindet_b_occ(
@@ -2296,6 +2965,18 @@ class H_indices_generator(object):
         # Create and cache dictionary mapping connected determinants \in psi_j to associated indices.
         return {det: i for i, det in enumerate(self.psi_j)}
 
+    @cached_property
+    def psi_i_packed(self):
+        # Create and cache packed determinants \in psi_i, used by the batched excitation kernels
+        if isinstance(self.psi_i, DetArray):
+            return self.psi_i
+        return DetArray.from_psi_det(self.psi_i, self.n_orb)
+
+    @cached_property
+    def psi_j_packed(self):
+        # Create and cache packed determinants \in psi_j; index lookups of excited batches are done with it
+        return DetArray.from_psi_det(self.psi_j, self.n_orb)
+
     @cached_property
     def spindet_occ_int(self):
         # Create and cache dictionaries mapping spin-orbital indices to determinants \in psi_i to associated indices
@@ -2349,6 +3030,29 @@ class Hamiltonian_generator(object):
       molecular orbitals.  So the number of non-zero elements scales linearly with
       the number of selected determinant.
     * Matrix elements of H are stored as a hash lookup.
+
+    ~
+    Caching of H_i
+    ~
+
+    Local rows of H_i are generated in blocks of `H_cache_block_size` rows and
+    stored in CSR format (8 bytes for the value, 8 bytes for the column index per
+    non-zero). Blocks are kept in memory until `max_H_cache_bytes` is exhausted.
+    The remaining blocks are either spilled to memory-mapped files in `H_cache_dir`
+    (`H_cache_spill="memmap"`) or recomputed on the fly at each matrix product
+    (`H_cache_spill="recompute"`). By default, everything is cached in memory.
+    Blocks are generated, sized and stored one at a time, so the peak memory is the cache budget
+    plus one block; only the non-zero matrix elements are built. `close` removes the spilled blocks.
+
+    ~
+    Distributed matrix products
+    ~
+
+    For H_i * V with V distributed by rows (as the trial vectors of Davidson), each rank
+    needs the rows of V for the columns of H_i it has non-zeros in. They are either
+    all gathered on every rank (`vector_exchange="allgather"`, O(N) traffic per rank),
+    or only the needed ones are exchanged with the ranks owning them, through a
+    precomputed halo pattern (`vector_exchange="halo"`, see `H_i_halo`).
     """
 
     # Only pass internal determinant, since we'll only want to cache the Hamiltonian matrix elts. for an iteration
@@ -2361,6 +3065,11 @@ class Hamiltonian_generator(object):
         d_two_e_integral: Two_electron_integral,
         psi_internal: Psi_det,
         driven_by="determinant",
+        max_H_cache_bytes=None,
+        H_cache_spill="recompute",
+        H_cache_dir=None,
+        H_cache_block_size=1024,
+        vector_exchange="allgather",
     ):
         self.comm = comm
         self.world_size = self.comm.Get_size()  # No. of processes running
@@ -2374,6 +3083,21 @@ class Hamiltonian_generator(object):
         self.d_one_e_integral = d_one_e_integral
         self.d_two_e_integral = d_two_e_integral
         self.driven_by = driven_by
+        # Memory budget (in bytes, per rank) for the cached matrix elements of H_i; None means no limit
+        if H_cache_spill not in ("recompute", "memmap"):
+            raise ValueError(f"Unknown H_cache_spill option: {H_cache_spill}")
+        self.max_H_cache_bytes = max_H_cache_bytes
+        self.H_cache_spill = H_cache_spill
+        self.H_cache_dir = H_cache_dir
+        self.H_cache_block_size = H_cache_block_size
+        # Blocks of H_i stored in memory or on disk, and where each generated block went
+        self.H_i_cache = {}
+        self.H_i_block_location = {}
+        self.H_i_cached_bytes = 0  # Bytes of the blocks stored in memory
+        # How rows of distributed vectors are exchanged for the products H_i * V
+        if vector_exchange not in ("allgather", "halo"):
+            raise ValueError(f"Unknown vector_exchange option: {vector_exchange}")
+        self.vector_exchange = vector_exchange
 
     @cached_property
     def distribution(self):
@@ -2449,16 +3173,58 @@ class Hamiltonian_generator(object):
         # Diagonal elements of local Hamiltonian
         return self.Hamiltonian_1e_driver.H_ii(det_i) + self.Hamiltonian_2e_driver.H_ii(det_i)
 
+    def H_ij_batch(self, psi_i: DetArray, psi_j: DetArray) -> np.ndarray:
+        """Off-diagonal <I|H|J> for pairs of packed determinants psi_i[n], psi_j[n], singly or
+        doubly excited from each other; the excitations are analyzed once for both parts"""
+        excitation = batch_excitation(psi_i, psi_j)
+        return self.Hamiltonian_1e_driver.H_ij_batch(
+            psi_i, psi_j, excitation
+        ) + self.Hamiltonian_2e_driver.H_ij_batch(psi_i, psi_j, excitation)
+
+    def H_ii_batch(self, psi: DetArray) -> np.ndarray:
+        # Diagonal elements of a batch of packed determinants
+        return self.Hamiltonian_1e_driver.H_ii_batch(psi) + self.Hamiltonian_2e_driver.H_ii_batch(
+            psi
+        )
+
+    def orbital_energies(self, psi: DetArray) -> np.ndarray:
+        r"""Fock-like orbital energies of a batch of packed determinants, shape (N, 2, N_orb):
+        F[I, s, o] = h_oo + \sum_j (J - K)_oj n_js + J_oj n_jt, with t the opposite spin of s"""
+        h_diag = self.Hamiltonian_1e_driver.orbital_diagonal(self.N_orb)
+        return h_diag + self.Hamiltonian_2e_driver.orbital_energies(psi)
+
+    def H_ii_incremental(
+        self, psi: DetArray, psi_parent: DetArray, H_ii_parent: np.ndarray, F_parent: np.ndarray
+    ) -> np.ndarray:
+        r"""Diagonal elements of a batch of packed determinants, from the diagonal elements and
+        orbital energies of parent determinants they are (at most doubly) excited from.
+        With d = n - n_parent, the diagonal is quadratic in the occupation numbers, so
+            <I|H|I> = <P|H|P> + F_P . d + \sum_{a < b} d_a d_b W_ab,
+        where W = J - K for spin-orbitals of the same spin, J otherwise.
+        d has at most 4 non-zero entries, so each diagonal is computed in O(1) from F_P."""
+        delta = psi.occupation.astype(np.int8) - psi_parent.occupation.astype(np.int8)
+        I, s, o = np.nonzero(delta)  # Sorted by I
+        sign = delta[I, s, o]
+        H_ii = H_ii_parent + np.bincount(I, weights=sign * F_parent[I, s, o], minlength=len(psi))
+        # Pad the (at most 4) changed spin-orbitals of each determinant
+        counts = np.bincount(I, minlength=len(psi))
+        if len(I) and counts.max() > 4:
+            raise ValueError("Determinants are not at most doubly excited from their parent")
+        pos = np.arange(len(I)) - np.repeat(np.cumsum(counts) - counts, counts)
+        S, O, D = (np.zeros((len(psi), 4), dtype=np.int64) for _ in range(3))
+        S[I, pos], O[I, pos], D[I, pos] = s, o, sign
+        J, K = self.Hamiltonian_2e_driver.J_K_matrices
+        for a, b in combinations(range(4), 2):
+            W_ab = J[O[:, a], O[:, b]] - (S[:, a] == S[:, b]) * K[O[:, a], O[:, b]]
+            H_ii += D[:, a] * D[:, b] * W_ab
+        return H_ii
+
     @cached_property
     def D_i(self):
         """Return `diagonal' of local H_i. (Diagonal meaning, entries of H_i
         corresponding to the diagonal part of H) as a numpy vector.
         Used for pre-conditioning step in Davidson's iteration."""
-        D_i = np.zeros(self.local_size, dtype="float")
-        # Iterate through local determinants m
-        for j, det in enumerate(self.psi_local):
-            D_i[j] = self.H_ii(det)
-        return D_i
+        return self.H_ii_batch(DetArray.from_psi_det(self.psi_local, self.N_orb))
 
     # ~ ~ ~
     # H
@@ -2491,70 +3257,327 @@ class Hamiltonian_generator(object):
 
         return H_full
 
+    # ~ ~ ~
+    # H_i, cached by blocks of rows
+    # ~ ~ ~
     @cached_property
-    def H_i_1e_matrix_elements(self):
-        """Generate elements of H_i_1e (local row-wise portion of one-electron Hamiltonian).
-        Elements are gathered `on-the-fly' at first iteration, and then cached in a dict to be re-used later.
+    def H_i_blocks(self):
+        """Blocks of local rows [start, stop) in which H_i is generated and cached.
+        >>> h = Hamiltonian_generator(MPI.COMM_WORLD, 0, None, None, [0]*5, H_cache_block_size=2)
+        >>> h.H_i_blocks
+        [(0, 2), (2, 4), (4, 5)]
         """
-        H_i_1e_matrix_elements = defaultdict(int)
-        for I, det_I in enumerate(self.psi_local):
-            for J, det_J in enumerate(self.psi_internal):
-                H_i_1e_matrix_elements[(I, J)] += self.Hamiltonian_1e_driver.H_ij(det_I, det_J)
-        # Remove the default dict
-        return dict(H_i_1e_matrix_elements)
+        block_size = max(1, self.H_cache_block_size)
+        local_size = int(self.local_size)
+        return [
+            (start, min(start + block_size, local_size)) for start in range(0, local_size, block_size)
+        ]
 
     @cached_property
-    def H_i_2e_matrix_elements(self):
-        """Generate elements of H_i_1e (local row-wise portion of one-electron Hamiltonian).
-        Elements are gathered `on-the-fly' at first iteration, and then cached in a dict to be re-used later.
+    def H_cache_tmpdir(self):
+        # Directory for the memory-mapped blocks of H_i; removed by `close'
+        return tempfile.TemporaryDirectory(
+            prefix=f"arches_H_i_rank{self.rank}_", dir=self.H_cache_dir
+        )
+
+    def close(self):
+        """Drop the cached blocks of H_i, remove the files of the spilled ones, and free the
+        neighbor communicator of the halo exchange (if any)"""
+        self.H_i_cache.clear()
+        self.H_i_block_location.clear()
+        self.H_i_cached_bytes = 0
+        if "H_cache_tmpdir" in self.__dict__:
+            self.__dict__.pop("H_cache_tmpdir").cleanup()
+        if "H_i_halo" in self.__dict__:
+            self.__dict__.pop("H_i_halo")[0].Free()
+
+    @cached_property
+    def psi_internal_packed(self) -> DetArray:
+        # Packed internal determinants, to look up the single excitations of the rows of H_i
+        if isinstance(self.psi_internal, DetArray):
+            return self.psi_internal
+        return DetArray.from_psi_det(self.psi_internal, self.N_orb)
+
+    def H_i_row_matrix_elements(self, start, stop):
+        """Generate the non-zero elements of rows [start, stop) of H_i (one- and two-electron parts).
         Works for integral-driven or determinant-driven implementation.
+        The one-electron part is only evaluated on the diagonal, and on the single excitations of
+        the rows found in psi_internal.
+
+        :return keys, data: row-major keys I * len(psi_internal) + J of the non-zeros, sorted,
+                            with I relative to `start', and their values
         """
-        H_i_2e_matrix_elements = defaultdict(int)
-        for (I, J), idx, phase in self.Hamiltonian_2e_driver.H_indices(
-            self.psi_local, self.psi_internal
-        ):
-            # Update (I, J)th 2e matrix element
-            H_i_2e_matrix_elements[(I, J)] += phase * self.Hamiltonian_2e_driver.H_ijkl_orbital(
-                *idx
-            )
-        # Remove the default dict
-        return dict(H_i_2e_matrix_elements)
-
-    # TODO:
-    # H * G
-    # ( \sum H_i) * G # We do that for now
-    # \sum (H_i * G) # H_i big enough to fit in memory
+        psi_rows = self.psi_local[start:stop]
+        N_j = len(self.psi_internal)
+        # One-electron part: diagonal, and single excitations of the rows found in psi_internal
+        first = self.offsets[self.rank] + start
+        rows = self.psi_internal_packed[first : first + len(psi_rows)]
+        masks = single_excitation_masks(rows)
+        excited = rows.words[:, np.newaxis] ^ masks
+        J_single = self.psi_internal_packed.index(
+            DetArray(excited.reshape(-1, *rows.words.shape[1:]), rows.n_orb)
+        )
+        found = np.flatnonzero(J_single >= 0)
+        I_single, J_single = found // masks.shape[1], J_single[found]
+        I_diagonal = np.arange(len(rows), dtype=np.int64)
+        I_1e = np.concatenate((I_single, I_diagonal))
+        J_1e = np.concatenate((J_single, I_diagonal + first))
+        data_1e = np.concatenate(
+            (
+                self.Hamiltonian_1e_driver.H_ij_batch(
+                    rows[I_single], self.psi_internal_packed[J_single]
+                ),
+                self.Hamiltonian_1e_driver.H_ii_batch(rows),
+            )
+        )
+        I_2e, J_2e, data_2e = self.Hamiltonian_2e_driver.H_triplets(psi_rows, self.psi_internal)
+        # Sum contributions to the same (I, J); keys are sorted row-major
+        keys, inverse = np.unique(
+            np.concatenate((I_1e * N_j + J_1e, I_2e * N_j + J_2e)), return_inverse=True
+        )
+        data = np.bincount(inverse, weights=np.concatenate((data_1e, data_2e)), minlength=len(keys))
+        # Only non-zero matrix elements are stored
+        nonzero = data != 0
+        return keys[nonzero], data[nonzero]
+
+    def H_i_block_from_keys(self, keys, data, n_rows):
+        """CSR arrays (indptr, indices, data) of `n_rows' rows, from their sorted row-major keys"""
+        N_j = len(self.psi_internal)
+        indptr = np.zeros(n_rows + 1, dtype=np.int64)
+        np.cumsum(np.bincount(keys // N_j, minlength=n_rows), out=indptr[1:])
+        return indptr, keys % N_j, data
+
+    def H_i_block_matrix_elements(self, start, stop):
+        """Generate rows [start, stop) of H_i in CSR format, when a block is first requested or
+        has to be recomputed on the fly
+
+        :return indptr, indices, data: CSR arrays of the block, row indices are relative to `start'
+        """
+        return self.H_i_block_from_keys(*self.H_i_row_matrix_elements(start, stop), stop - start)
+
+    def H_i_block_to_memmap(self, b, block):
+        """Spill CSR block `b' of H_i to disk, and return it as read-only memory-mapped arrays"""
+        spilled_block = []
+        for name, a in zip(("indptr", "indices", "data"), block):
+            if a.size == 0:  # Empty files cannot be mapped
+                spilled_block.append(a)
+                continue
+            path = pathlib.Path(self.H_cache_tmpdir.name, f"H_i_block_{b}_{name}.npy")
+            a_mm = np.lib.format.open_memmap(path, mode="w+", dtype=a.dtype, shape=a.shape)
+            a_mm[:] = a
+            a_mm.flush()
+            del a_mm
+            spilled_block.append(np.load(path, mmap_mode="r"))
+        return tuple(spilled_block)
+
+    def H_i_store_block(self, b, block):
+        """Store a freshly generated CSR block `b' of H_i in memory if it fits in what is left of
+        `max_H_cache_bytes'. Otherwise it is spilled to disk, or will be recomputed on the fly.
+        Return the block as it should be used (memory-mapped if spilled)."""
+        nbytes = sum(a.nbytes for a in block)
+        budget = self.max_H_cache_bytes
+        if budget is None or self.H_i_cached_bytes + nbytes <= budget:
+            location = "memory"
+            self.H_i_cache[b] = block
+            self.H_i_cached_bytes += nbytes
+        elif self.H_cache_spill == "memmap":
+            location = "memmap"
+            self.H_i_cache[b] = block = self.H_i_block_to_memmap(b, block)
+        elif self.H_cache_spill == "recompute":
+            location = "recompute"
+        else:
+            raise ValueError(f"Unknown H_cache_spill option: {self.H_cache_spill}")
+        self.H_i_block_location[b] = (location, nbytes)
+        return block
+
+    def H_i_block(self, b):
+        """Return CSR block `b' of H_i.
+        The first request of a block generates and stores it (see `H_i_store_block'); afterwards,
+        blocks that did not fit in `max_H_cache_bytes' are read from disk or recomputed on the fly.
+        """
+        if b in self.H_i_cache:
+            return self.H_i_cache[b]
+        block = self.H_i_block_matrix_elements(*self.H_i_blocks[b])
+        if b not in self.H_i_block_location:
+            block = self.H_i_store_block(b, block)
+        return block
+
+    def H_i_iter_blocks(self):
+        """Iterate over the (start, stop, CSR block) of H_i, one block at a time"""
+        for b, (start, stop) in enumerate(self.H_i_blocks):
+            yield start, stop, self.H_i_block(b)
+
+    @property
+    def H_cache_split(self):
+        """Number of local rows of H_i, and bytes of their matrix elements, stored in memory, spilled to disk,
+        and recomputed on the fly. Only blocks generated so far are accounted for.
+        >>> h = Hamiltonian_generator(MPI.COMM_WORLD, 0, None, None, [0]*4, H_cache_block_size=2)
+        >>> h.H_i_block_location = {0: ("memory", 64), 1: ("recompute", 48)}
+        >>> h.H_cache_split
+        {'memory': (2, 64), 'memmap': (0, 0), 'recompute': (2, 48)}
+        """
+        split = {location: [0, 0] for location in ("memory", "memmap", "recompute")}
+        for b, (location, nbytes) in self.H_i_block_location.items():
+            start, stop = self.H_i_blocks[b]
+            split[location][0] += stop - start
+            split[location][1] += nbytes
+        return {location: tuple(v) for location, v in split.items()}
+
+    @staticmethod
+    def csr_matrix_product(indptr, indices, data, M):
+        """Compute the product of a CSR matrix with a dense (n x k) matrix M
+        All k columns are handled at once, by the compiled (OpenMP) kernel if it is built
+        >>> indptr, indices, data = np.array([0, 2, 2, 3]), np.array([0, 2, 1]), np.array([1., 2., 3.])
+        >>> Hamiltonian_generator.csr_matrix_product(indptr, indices, data, np.arange(6.).reshape(3, 2))
+        array([[ 8., 11.],
+               [ 0.,  0.],
+               [ 6.,  9.]])
+        """
+        if idk_lib is not None:
+            # Row-major M and W: each non-zero is a contiguous update of the k columns of a row of W
+            W = np.empty((len(indptr) - 1, M.shape[1]), dtype="float")
+            idk_lib.csr_matrix_product(
+                np.ascontiguousarray(indptr, dtype=np.int64),
+                np.ascontiguousarray(indices, dtype=np.int64),
+                np.ascontiguousarray(data, dtype=np.float64),
+                len(W),
+                np.ascontiguousarray(M, dtype=np.float64),
+                M.shape[1],
+                W,
+            )
+            return W
+        W = np.zeros((len(indptr) - 1, M.shape[1]), dtype="float")
+        if len(data) == 0:
+            return W
+        # Sum the contributions of each row; reduceat is only valid for non-empty rows
+        non_empty = np.diff(indptr) > 0
+        W[non_empty] = np.add.reduceat(data[:, np.newaxis] * M[indices], indptr[:-1][non_empty])
+        return W
 
     def H_i_implicit_matrix_product(self, M):
         """Function to implicitly compute matrix-matrix product W_i = H_i * M
-        At first call, matrix elements of H_i are built `on-the-fly'. Matrix elements are cached
-        for later use, and iterated through to compute H_i * V implicitly.
+        At first call, matrix elements of H_i are built `on-the-fly' by blocks of rows. Blocks are cached
+        for later use (in memory or on disk, see `max_H_cache_bytes'), or re-built at each call if they don't fit.
 
         :param H_i: local (self.local_size \times n) row-wise portion of Hamiltonian (never explicitly formed)
         :param V:  (self.full_size \times k) diensional numpy array
 
         :return W_i: locally computed chunk of matrix-matrix product (self.local_size \times k), as a numpy array
         """
+        if M.ndim == 1:  # Handle case when M is a vector
+            M = M.reshape(len(M), 1)
+        # Row-major layout, converted once for all the blocks
+        M = np.ascontiguousarray(M, dtype="float")
+        k = M.shape[1]  # Column dimension
+        # Pre-allocate space for local brick of matrix-matrix product
+        W_i = np.zeros((self.local_size, k), dtype="float")
+        for start, stop, block in self.H_i_iter_blocks():
+            W_i[start:stop] = self.csr_matrix_product(*block, M)
+        return W_i
 
-        def H_i_implicit_matrix_product_step(matrix_elements, M):
-            # Implicitly compute the 1e/2e Hamiltonain matrix-matrix product W_i = H_i * M
-            # :param matrix_elements: python dictionary of 1e or 2e Hamiltonian matrix elements
-            if M.ndim == 1:  # Handle case when M is a vector
-                M = M.reshape(len(M), 1)
-            k = M.shape[1]  # Column dimension
-            # Pre-allocate space for local brick of matrix-matrix product
-            W_i = np.zeros((self.local_size, k), dtype="float")
-            # Iterate through nonzero matrix elements to compute matrix-matrix product
-            for (I, J), matrix_elt in matrix_elements.items():
-                W_i[I, :] += matrix_elt * M[J, :]  # Update row I of W_i
-            return W_i
-
-        # On first call, these will do the same things regardless of the `driven_by' option
-        # If option to cache, compute elements and store in a sparse representation, then multiply
-        return H_i_implicit_matrix_product_step(
-            self.H_i_1e_matrix_elements, M
-        ) + H_i_implicit_matrix_product_step(self.H_i_2e_matrix_elements, M)
+    @cached_property
+    def H_i_halo(self):
+        """Halo exchange pattern of H_i: the columns of H_i with a non-zero in a local row,
+        grouped by the rank owning them (local columns excluded), and the local rows other ranks
+        need. Built from the (cached or recomputed) blocks of H_i, once; the columns of the cached
+        blocks are renumbered once as well, to index [local rows | received rows] of M.
+
+        :return (neighbor graph communicator,
+                 recv_columns: columns received, sorted (so grouped by source),
+                 recv_counts: by source,
+                 send_rows: local rows sent, grouped by destination,
+                 send_counts: by destination,
+                 block_columns: renumbered columns (CSR indices) of the cached blocks, by block)
+        """
+        columns = np.unique(
+            np.concatenate(
+                [np.unique(block[1]) for _, _, block in self.H_i_iter_blocks()]
+                + [np.zeros(0, dtype=np.int64)]
+            )
+        ).astype(np.int64)
+        owners = np.searchsorted(self.offsets, columns, side="right") - 1
+        columns, owners = columns[owners != self.rank], owners[owners != self.rank]
+        # Each rank tells the owners which of their rows it needs
+        recv_counts_all = np.bincount(owners, minlength=self.world_size).astype(np.int64)
+        send_counts_all = np.zeros(self.world_size, dtype=np.int64)
+        self.comm.Alltoall([recv_counts_all, MPI.INT64_T], [send_counts_all, MPI.INT64_T])
+        requested = np.zeros(send_counts_all.sum(), dtype=np.int64)
+        self.comm.Alltoallv(
+            [columns, recv_counts_all, np.cumsum(recv_counts_all) - recv_counts_all, MPI.INT64_T],
+            [requested, send_counts_all, np.cumsum(send_counts_all) - send_counts_all, MPI.INT64_T],
+        )
+        # Only ranks actually exchanging rows are neighbors
+        sources = np.flatnonzero(recv_counts_all)
+        destinations = np.flatnonzero(send_counts_all)
+        graph_comm = self.comm.Create_dist_graph_adjacent(
+            sources.tolist(), destinations.tolist(), reorder=False
+        )
+        # Recomputed blocks are renumbered each time they are generated
+        block_columns = {
+            b: self.H_i_halo_columns(columns, self.H_i_cache[b][1])
+            for b, (location, _) in self.H_i_block_location.items()
+            if location != "recompute"
+        }
+        return (
+            graph_comm,
+            columns,
+            recv_counts_all[sources],
+            requested - self.offsets[self.rank],
+            send_counts_all[destinations],
+            block_columns,
+        )
 
+    def H_i_halo_columns(self, recv_columns, indices):
+        """Renumber columns of H_i to [local rows | received rows `recv_columns'] (see `H_i_halo')
+        >>> h = Hamiltonian_generator(MPI.COMM_WORLD, 0, None, None, [0]*4)
+        >>> h.H_i_halo_columns(np.array([7, 9]), np.array([9, 0, 3, 7]))
+        array([5, 0, 3, 4])
+        """
+        start = self.offsets[self.rank]
+        local = (indices >= start) & (indices < start + self.local_size)
+        return np.where(
+            local, indices - start, self.local_size + np.searchsorted(recv_columns, indices)
+        )
+
+    def H_i_distributed_matrix_product(self, M_i):
+        """Compute W_i = H_i * M, for M distributed by rows (M_i: self.local_size x k local rows)
+        Rows of M owned by other ranks are exchanged according to `vector_exchange'; with "halo",
+        only the rows matching columns of H_i (see `H_i_halo') are sent, in one neighborhood
+        collective.
+
+        :return W_i: locally computed chunk of matrix-matrix product (self.local_size x k)
+        """
+        if M_i.ndim == 1:  # Handle case when M_i is a vector
+            M_i = M_i.reshape(len(M_i), 1)
+        k = M_i.shape[1]
+        if self.vector_exchange == "allgather":
+            M = np.zeros((self.full_problem_size, k), dtype="float")
+            self.comm.Allgatherv(
+                [np.ascontiguousarray(M_i, dtype="float"), MPI.DOUBLE],
+                [M, k * np.array(self.distribution), k * np.array(self.offsets), MPI.DOUBLE],
+            )
+            return self.H_i_implicit_matrix_product(M)
+        graph_comm, recv_columns, recv_counts, send_rows, send_counts, block_columns = self.H_i_halo
+        halo = np.empty((len(recv_columns), k), dtype="float")
+        graph_comm.Neighbor_alltoallv(
+            [
+                np.ascontiguousarray(M_i[send_rows], dtype="float"),
+                k * send_counts,
+                k * (np.cumsum(send_counts) - send_counts),
+                MPI.DOUBLE,
+            ],
+            [halo, k * recv_counts, k * (np.cumsum(recv_counts) - recv_counts), MPI.DOUBLE],
+        )
+        # Only the rows of M that H_i reads, indexed by the renumbered columns of its blocks
+        M = np.ascontiguousarray(np.concatenate((M_i, halo)), dtype="float")
+        W_i = np.zeros((self.local_size, k), dtype="float")
+        for b, (start, stop) in enumerate(self.H_i_blocks):
+            indptr, indices, data = self.H_i_block(b)
+            columns = block_columns.get(b)
+            if columns is None:
+                columns = self.H_i_halo_columns(recv_columns, indices)
+            W_i[start:stop] = self.csr_matrix_product(indptr, columns, data, M)
+        return W_i
 
 import inspect  # noqa
 
@@ -2600,7 +3623,9 @@ class Davidson_manager(object):
         self.offsets = H_i_generator.offsets
         self.local_size = H_i_generator.local_size
 
-    def parallel_iteration_restart(self, dim_S, n_eig, n_newvecs, X_ik, V_ik, W_ik):
+    def parallel_iteration_restart(
+        self, dim_S, n_eig, n_newvecs, X_ik, V_ik, W_ik, orthogonalization="mgs"
+    ):
         """Restart Davidson's iteration; resize the trial subspace V_k
         and its associated data structures. Prevent a significant
         blow-up of column dimension.
@@ -2610,6 +3635,7 @@ class Davidson_manager(object):
         :param n_newvecs: number of new vectors added at the previous iteration
         :param X_ik: current Ritz vectors, numpy array
         :param V_ik, W_ik: local working variables, numpy arrays
+        :param orthogonalization: "mgs" (vector by vector) or "cholqr2" (by block)
 
         :return new values for dim_S, V_ik, and W_ik following implicit restart
         """
@@ -2621,6 +3647,11 @@ class Davidson_manager(object):
         dim_S = V_inew.shape[1]  # New subspace dimension
         V_ik = np.zeros((self.local_size, 0), dtype="float")
         W_ik = np.zeros((self.local_size, 0), dtype="float")
+        if orthogonalization == "cholqr2":
+            # Orthonormalize the restart basis at once (Ritz vectors are already orthonormal)
+            V_ik = self.block_orthogonalize(V_ik, V_inew)
+            dim_S = n_newvecs = V_ik.shape[1]
+            return dim_S, n_newvecs, V_ik, W_ik
         # Initialize; normalize first basis vector
         v_inew = np.array(V_inew[:, 0], dtype="float")
         v_new = np.zeros(self.full_problem_size, dtype="float")
@@ -2658,24 +3689,143 @@ class Davidson_manager(object):
         norm_tk = np.linalg.norm(t_k)
         return t_ik / norm_tk, norm_tk  # Return new orthonormalized vector
 
-    def preconditioning(self, D_i, l_k, r_ik):
-        """Preconditon next guess vector
+    def block_orthogonalize(self, V_ik, T_ik, subspace_tol=0.0):
+        """Parallel block orthogonalization of new guess vectors T_k against the trial subspace V_k
+        (orthonormal), with the block structure of |bmgs_h| in `arches.algorithms':
+            - block classical Gram-Schmidt, applied twice (BCGS2): T <- T - V (V^T T)
+            - CholQR2 within the block: T <- T R^-1, with R^T R = T^T T, applied twice
+        Each inner-product matrix is computed locally and reduced with one Allreduce, so the number
+        of collectives per block is constant (5), whatever the dimension of V_k and T_k.
+        Columns of T_k are first normalized; those whose norm falls below `subspace_tol' once
+        projected out of V_k are dropped (as in `mgs'). If the remaining columns are (numerically)
+        linearly dependent, they are orthogonalized one by one with `mgs' instead. R_jj is the norm
+        of column j once projected out of the previous ones, but from the Gram matrix it is only
+        accurate down to ~sqrt(machine epsilon); the block is deemed dependent below 1e-6.
+
+        :param V_ik: local work variable, numpy matrix with orthonormal columns
+        :param T_ik: local work variable, numpy matrix
+
+        :return local rows of the orthonormalized (kept) columns of T_k, numpy matrix
+        """
+
+        def allreduce(A_i):
+            A = np.zeros_like(A_i)
+            self.comm.Allreduce([np.ascontiguousarray(A_i), MPI.DOUBLE], [A, MPI.DOUBLE])
+            return A
+
+        T_ik = np.array(T_ik, dtype="float")
+        T_ik = T_ik / np.sqrt(allreduce(np.einsum("ij,ij->j", T_ik, T_ik)))
+        for _ in range(2):
+            T_ik = T_ik - V_ik @ allreduce(V_ik.T @ T_ik)
+        G = allreduce(T_ik.T @ T_ik)
+        kept = np.sqrt(np.diag(G)) > subspace_tol
+        T_ik, G = T_ik[:, kept], G[np.ix_(kept, kept)]
+        try:
+            for k in range(2):
+                if k:
+                    G = allreduce(T_ik.T @ T_ik)
+                R = np.linalg.cholesky(G).T
+                if np.any(np.diag(R) <= max(subspace_tol, 1e-6)):
+                    raise np.linalg.LinAlgError("Linearly dependent trial vectors")
+                T_ik = np.linalg.solve(R.T, T_ik.T).T  # T R^-1
+        except np.linalg.LinAlgError:
+            Q_ik = np.array(V_ik)
+            for t_ik in T_ik.T:
+                t_ik, norm_tk = self.mgs(Q_ik, t_ik)
+                if norm_tk > subspace_tol:
+                    Q_ik = np.c_[Q_ik, t_ik]
+            return Q_ik[:, V_ik.shape[1] :]
+        return T_ik
+
+    def preconditioning(self, D_i, l_k, r_ik, x_ik=None, pc="diagonal", reference_space=None):
+        """Preconditon next guess vector, approximate solution of the correction equation (H - l_k) t = r
+        Available preconditioners (`pc'):
+            - "diagonal": t = M r, with M = (D - l_k)^-1 (Davidson's preconditioner)
+            - "olsen": t = M r - eps M x, with eps = <x|M r> / <x|M x>, so that <x|t> = 0
+              (Olsen's correction [J. Olsen et al., `90])
+            - "block": same as "olsen", with M = (D - l_k)^-1 except on a small reference space P,
+              where (H_PP - l_k) is inverted exactly (see `reference_space'). Without the correction,
+              M r would be (close to) x for a large enough P, and no new direction would be added
 
         :param D_i: diagonal portion of local Hamiltonian, as a numpy vector
         :param l_k: an eigenvalue, as a scalar
         :param r_ik: residual, a numpy vector
+        :param x_ik: Ritz vector associated to l_k, a numpy vector (for "olsen")
+        :param reference_space: (local indices of P, their position in P, H_PP) (for "block")
 
         :return numpy vector
         """
-        # Build diagonal preconditioner
-        M_k = np.diag(np.clip(np.reciprocal(D_i - l_k), a_min=-1e5, a_max=1e5))
-        return np.dot(M_k, r_ik)
+        # Diagonal preconditioner
+        M_ik = np.clip(np.reciprocal(D_i - l_k), a_min=-1e5, a_max=1e5)
+        if pc == "diagonal":
+            return M_ik * r_ik
+        if pc not in ("olsen", "block"):
+            raise ValueError(f"Unknown preconditioner: {pc}")
+        # M applied to [r, x] at once
+        M_rx_i = M_ik[:, np.newaxis] * np.c_[r_ik, x_ik]
+        if pc == "block":
+            P_i, P_position, H_PP = reference_space
+            # Gather the reference part of [r, x] on all ranks; all solve the small system
+            rx_iP = np.zeros((len(H_PP), 2), dtype="float")
+            rx_iP[P_position] = np.c_[r_ik, x_ik][P_i]
+            rx_P = np.zeros_like(rx_iP)
+            self.comm.Allreduce([rx_iP, MPI.DOUBLE], [rx_P, MPI.DOUBLE])
+            M_rx_i[P_i] = np.linalg.solve(H_PP - l_k * np.eye(len(H_PP)), rx_P)[P_position]
+        # Each rank computes partial inner-products <x|M r> and <x|M x>
+        x_M_rx_i = np.dot(x_ik, M_rx_i)
+        x_M_rx = np.zeros(2, dtype="float")
+        self.comm.Allreduce([x_M_rx_i, MPI.DOUBLE], [x_M_rx, MPI.DOUBLE])
+        return M_rx_i[:, 0] - x_M_rx[0] / x_M_rx[1] * M_rx_i[:, 1]
+
+    def reference_space(self, D_i, n_ref):
+        """Reference space of the "block" preconditioner: the n_ref determinants with the lowest
+        diagonal elements, and the exact Hamiltonian H_PP between them, identical on all ranks.
+        Each rank takes its rows of P from the (cached) CSR blocks of H_i, and keeps their columns in P.
+
+        :param D_i: diagonal portion of local Hamiltonian, as a numpy vector
+        :param n_ref: size of the reference space
+
+        :return (local indices of P, their position in P, H_PP)
+        """
+        n = self.full_problem_size
+        D = np.zeros(n, dtype="float")
+        self.comm.Allgatherv(
+            [np.ascontiguousarray(D_i, dtype="float"), MPI.DOUBLE],
+            [D, self.distribution, self.offsets, MPI.DOUBLE],
+        )
+        P = np.sort(np.argsort(D, kind="stable")[: min(n_ref, n)])
+        start = self.offsets[self.rank]
+        local = (P >= start) & (P < start + self.local_size)
+        P_i, P_position = P[local] - start, np.flatnonzero(local)
+        H_iP = np.zeros((len(P), len(P)), dtype="float")
+        for b, (block_start, block_stop) in enumerate(self.H_i_generator.H_i_blocks):
+            in_block = (P_i >= block_start) & (P_i < block_stop)
+            if not in_block.any():
+                continue
+            indptr, indices, data = self.H_i_generator.H_i_block(b)
+            for row, position in zip(P_i[in_block] - block_start, P_position[in_block]):
+                columns = indices[indptr[row] : indptr[row + 1]]
+                # Position of each column in P (sorted), if it is one of them
+                k = np.minimum(np.searchsorted(P, columns), len(P) - 1)
+                in_P = P[k] == columns
+                H_iP[position, k[in_P]] = data[indptr[row] : indptr[row + 1]][in_P]
+        H_PP = np.zeros_like(H_iP)
+        self.comm.Allreduce([H_iP, MPI.DOUBLE], [H_PP, MPI.DOUBLE])
+        return P_i, P_position, H_PP
 
     def print_master(self, str_):
         """Master rank prints inputted str"""
         if self.rank == self.MPI_master_rank:
             print(str_)
 
+    def print_H_cache_split(self):
+        """Master rank prints how the matrix elements of H are stored, summed over all ranks"""
+        for location, (n_rows, n_bytes) in self.H_i_generator.H_cache_split.items():
+            split = np.array([n_rows, n_bytes], dtype="int64")
+            total = np.zeros(2, dtype="int64")
+            self.comm.Allreduce([split, MPI.INT64_T], [total, MPI.INT64_T])
+            self.print_master(f"H cache, {location}: {total[0]} rows, {total[1]} bytes")
+
     def initial_guess_vectors(self, n, dim_S):
         """Generate standard initial guess vectors for Davidson's iteration.
         Locally distributed canonical basis vectors
@@ -2700,6 +3850,9 @@ class Davidson_manager(object):
         max_iter=1000,
         m=1,
         q=100,
+        pc="diagonal",
+        n_ref=64,
+        orthogonalization="mgs",
     ):
         """Davidson's method implemented in parallel. The Hamiltonian
         matrix is distrubted row-wise across MPI rank.
@@ -2714,9 +3867,19 @@ class Davidson_manager(object):
         :param max_iter: max no. of iterations for Davidson to run
         :param m: minimal subspace dimension, m <= dim_S
         :param q: memory footprint tuning, q is maximally allowed subspace dimension
+        :param pc: preconditioner of the correction vectors, "diagonal", "olsen" or "block"
+                   (see `preconditioning')
+        :param n_ref: size of the reference space of the "block" preconditioner
+        :param orthogonalization: orthogonalization of the new trial vectors against the subspace,
+                                  "mgs" (vector by vector, as `parallel_iteration_restart')
+                                  or "cholqr2" (by block, see `block_orthogonalize')
 
         :return a list of `n_eig` eigenvalues/associated eigenvectors, as numpy vector/array resp.
         """
+        if pc not in ("diagonal", "olsen", "block"):
+            raise ValueError(f"Unknown preconditioner: {pc}")
+        if orthogonalization not in ("cholqr2", "mgs"):
+            raise ValueError(f"Unknown orthogonalization: {orthogonalization}")
         # Initialization steps
         n = self.full_problem_size  # Save full problem size
         # Establish local vars: trial subspace (V_ik) and action of H_i on full V_k (W_ik = H_i * V_k)
@@ -2733,6 +3896,8 @@ class Davidson_manager(object):
         V_ik = np.c_[V_ik, V_iguess]
         # Build `diagonal` of local Hamiltonian
         D_i = self.H_i_generator.D_i
+        # Reference space of the block preconditioner, computed once
+        reference_space = self.reference_space(D_i, n_ref) if pc == "block" else None
 
         n_newvecs = dim_S  # No. of vectors added is initial subspace dimension
         restart = True
@@ -2740,22 +3905,16 @@ class Davidson_manager(object):
             self.print_master(
                 f"Process rank: {self.rank}, Iterate: {k}, Subspace dimension: {dim_S}"
             )
-            # Gather full trial vectors added during previous iteration on each rank
-            V_new = np.zeros((n, n_newvecs), dtype="float")
+            # Trial vectors added during previous iteration
             V_inew = np.array(V_ik[:, -n_newvecs:], dtype="float")
-            self.comm.Allgatherv(
-                [V_inew, MPI.DOUBLE],
-                [
-                    V_new,
-                    n_newvecs * np.array(self.distribution),
-                    n_newvecs * np.array(self.offsets),
-                    MPI.DOUBLE,
-                ],
-            )
             # Compute new columns of W_ik, W_inew = H_i * V_new
-            # TODO: Some maximal allowed dimension before we switch to on the fly?
-            W_inew = self.H_i_generator.H_i_implicit_matrix_product(V_new)  # Default is to cache
+            # Rows of V_new owned by other ranks are exchanged (all of them, or only those
+            # H_i needs, see `vector_exchange')
+            # Matrix elements are cached up to `max_H_cache_bytes', the rest is spilled to disk or recomputed on the fly
+            W_inew = self.H_i_generator.H_i_distributed_matrix_product(V_inew)
             W_ik = np.c_[W_ik, W_inew]
+            if k == 1:
+                self.print_H_cache_split()
 
             # Each rank computes partial update to the projected Hamiltonian S_k
             if restart:  # If True, need to compute full S_k explicitly
@@ -2804,12 +3963,16 @@ class Davidson_manager(object):
             if all(converged):  # Convergence check
                 self.print_master("All eigenvalues converged, exiting iteration")
                 break
+            T_ik = []  # New trial vectors, orthogonalized at once with `cholqr2'
             for j in working_indices:  # Iterate through non-converged eigenpairs
                 self.print_master(
                     f"Eigenvalue {j}: not converged, preconditioning next trial vector"
                 )
                 # Precondition next trial vector
-                t_ik = self.preconditioning(D_i, L_k[j], R_i[:, j])
+                t_ik = self.preconditioning(D_i, L_k[j], R_i[:, j], X_ik[:, j], pc, reference_space)
+                if orthogonalization == "cholqr2":
+                    T_ik.append(t_ik)
+                    continue
                 # Orthogonalize new trial vector against previous basis vectors via parallel-MGS
                 t_k = np.zeros(n, dtype="float")
                 self.comm.Allgatherv(
@@ -2822,13 +3985,19 @@ class Davidson_manager(object):
                 if norm_tk > subspace_tol:
                     V_ik = np.c_[V_ik, t_ik]  # Append new vector to trial subspace
                     n_newvecs += 1
+            if T_ik:
+                # Orthogonalize the block of new trial vectors against previous basis vectors, and
+                # among themselves; `small' ones are ignored
+                T_ik = self.block_orthogonalize(V_ik, np.stack(T_ik, axis=1), subspace_tol)
+                V_ik = np.c_[V_ik, T_ik]  # Append new vectors to trial subspace
+                n_newvecs = T_ik.shape[1]
 
             dim_S = V_ik.shape[1]  # Update dimension of trial subspace
 
             if q <= dim_S:  # Collapose trial basis
                 self.print_master(f"q <= dim_S: {dim_S}, restarting Davidson's")
                 dim_S, n_newvecs, V_ik, W_ik = self.parallel_iteration_restart(
-                    dim_S, n_eig, n_newvecs, X_ik, V_ik, W_ik
+                    dim_S, n_eig, n_newvecs, X_ik, V_ik, W_ik, orthogonalization
                 )
                 restart = True  # Indicate restart
 
@@ -2837,7 +4006,7 @@ class Davidson_manager(object):
                     "No new vectors added at previous iteration, restarting Davidson's"
                 )
                 dim_S, n_newvecs, V_ik, W_ik = self.parallel_iteration_restart(
-                    dim_S, n_eig, n_newvecs, X_ik, V_ik, W_ik
+                    dim_S, n_eig, n_newvecs, X_ik, V_ik, W_ik, orthogonalization
                 )
                 restart = True  # Indicate restart
 
@@ -2869,11 +4038,21 @@ class Davidson_manager(object):
 class Powerplant_manager(object):
     """Class to compute all Energy associated with psi_internal (Psi_det);
     E denotes the variational energy <psi_det|H|psi_det>.
-    E_PT2 denotes the PT2 contribution for the connected determinants."""
+    E_PT2 denotes the PT2 contribution for the connected determinants.
+    psi_coef is either a vector (ground state), or a matrix of shape (len(psi_internal), n_states),
+    with one column per state; energies are then computed for all states at once (one per state)."""
 
     # Generator class for current basis of determinants
     # Each rank has instance of this corresponding to locally stored dets psi_local \subset psi_internal
-    def __init__(self, comm, H_i_generator: Hamiltonian_generator):
+    def __init__(
+        self,
+        comm,
+        H_i_generator: Hamiltonian_generator,
+        pt2_screening_threshold: float = None,
+        generator_norm_fraction: float = None,
+        constraint_runtimes: Dict[Tuple[OrbitalIdx, ...], Tuple[float, int]] = None,
+        n_states: int = None,
+    ):
         self.comm = comm
         self.world_size = self.comm.Get_size()  # No. of processes running
         self.rank = self.comm.Get_rank()  # Rank of current process
@@ -2886,6 +4065,55 @@ class Powerplant_manager(object):
         self.internal_offsets = H_i_generator.offsets
         self.psi_internal = self.H_i_generator.psi_internal
         self.N_orb = self.H_i_generator.N_orb
+        # Constraints with a bound on |E_pt2(C)| below this threshold are skipped (None: none)
+        self.pt2_screening_threshold = pt2_screening_threshold
+        # (No. of skipped constraints, No. of constraints, sum of the bounds of the skipped ones)
+        self.pt2_screening_report = (0, 0, 0.0)
+        # Only the largest |c_I| determinants covering this fraction of the norm of psi are used
+        # as generators of the connected space (None: all internal determinants)
+        self.generator_norm_fraction = generator_norm_fraction
+        # Constraint -> (measured runtime, estimated work), kept across CIPSI iterations to refine the
+        # cost model of the constraint scheduling; updated in place once all constraints are processed
+        self.constraint_runtimes = constraint_runtimes
+        # No. of states returned by the diagonalization (None: ground state only, as a vector)
+        self.n_states = n_states
+
+    @cached_property
+    def psi_internal_packed(self) -> DetArray:
+        # Packed internal determinants, used to filter them out of the connected space
+        return DetArray.from_psi_det(self.psi_internal, self.N_orb)
+
+    @cached_property
+    def psi_internal_by_constraint(self) -> Dict[Tuple[OrbitalIdx, ...], DetArray]:
+        # Internal determinants, bucketed by the triplet constraint they satisfy (their three highest
+        # occupied alpha orbitals); only the bucket of C can intersect the connected space of C
+        alpha = self.psi_internal_packed.occupation[:, 0]
+        # Number of occupied alpha orbitals at or above each orbital
+        above = np.cumsum(alpha[:, ::-1], axis=1)[:, ::-1]
+        constraints, inverse = np.unique(alpha & (above <= 3), axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        order = np.argsort(inverse, kind="stable")
+        buckets = np.split(order, np.cumsum(np.bincount(inverse))[:-1])
+        return {
+            tuple(np.flatnonzero(C).tolist()): self.psi_internal_packed[bucket]
+            for C, bucket in zip(constraints, buckets)
+        }
+
+    @cached_property
+    def psi_internal_bloom_filter(self):
+        # Prefilter of internal determinants (None if the compiled kernels are not built)
+        if idk_lib is None:
+            return None
+        return Bloom_filter(self.psi_internal_packed)
+
+    @cached_property
+    def psi_internal_diagonal(self) -> Tuple[np.ndarray, np.ndarray]:
+        # Diagonal elements and orbital energies of internal determinants,
+        # carried over to the determinants of the connected space generated from them
+        return (
+            self.H_i_generator.H_ii_batch(self.psi_internal_packed),
+            self.H_i_generator.orbital_energies(self.psi_internal_packed),
+        )
 
     @cached_property
     def DM(self):
@@ -2895,16 +4123,29 @@ class Powerplant_manager(object):
     @property
     def E_and_psi_coef(self) -> Tuple[Energy, Psi_coef]:
         """Diagonalize Hamiltonian in // and return ground state energy (new E) and corresponding eigenvector (new psi_coef)
+        With `n_states', return the n_states lowest energies and eigenvectors (as the columns of psi_coef)
         Done per CIPSI iteration"""
+        n_eig = self.n_states or 1
         try:
-            energies, coeffs = self.DM.distributed_davidson()
+            energies, coeffs = self.DM.distributed_davidson(n_eig=n_eig, m=n_eig)
         except NotImplementedError:
             print("Davidson Failed, fallback to numpy eigh")
             psi_H_psi = self.lewis.H  # Build full Hamiltonian
             energies, coeffs = np.linalg.eigh(psi_H_psi)
 
-        E, psi_coef = energies[0], coeffs[:, 0]
-        return E, psi_coef
+        if self.n_states is None:
+            return energies[0], coeffs[:, 0]
+        return energies[: self.n_states], coeffs[:, : self.n_states]
+
+    @staticmethod
+    def coef_matrix(psi_coef: Psi_coef) -> np.ndarray:
+        """Coefficients as a matrix of shape (len(psi_internal), n_states), a single state being one column
+        >>> Powerplant_manager.coef_matrix([0.6, 0.8])
+        array([[0.6],
+               [0.8]])
+        """
+        c = np.array(psi_coef, dtype="float")
+        return c.reshape(len(c), -1)
 
     def E(self, psi_coef: Psi_coef) -> Energy:
         """Compute the variatonal energy associated with psi_det
@@ -2913,37 +4154,138 @@ class Powerplant_manager(object):
 
         We assume the wavefunction is normalized; np.linalg.norm(c) = 1.
         Each rank will necessarily have access to the full list of determinant coefficients
-        Vector * Vector.T * Matrix, distributed matrix inner product"""
-        c = np.array(psi_coef, dtype="float")  # Coef. vector as np array
-        # Compute local portion of matrix * vector product H_i * |psi_det>
+        Vector * Vector.T * Matrix, distributed matrix inner product
+        For several states (psi_coef as a matrix), return the vector of their energies"""
+        c = self.coef_matrix(psi_coef)  # Coef. vectors as the columns of a np array
+        # Compute local portion of matrix * matrix product H_i * |psi_det>, all states at once
         H_i_psi_det = self.H_i_generator.H_i_implicit_matrix_product(c)
-        # Each rank computes portion of Vector.T * Vector inner-product (E_i, portion of variational energy)
+        # Each rank computes portion of Vector.T * Vector inner-products (E_i, portion of variational energies)
         # Get coeffs. of local determinants
         c_i = c[
             self.internal_offsets[self.rank] : (
                 self.internal_offsets[self.rank] + self.internal_distribution[self.rank]
             )
         ]
-        E_i = np.copy(np.dot(c_i.T, H_i_psi_det))
-        E = np.zeros(1, dtype="float")  # Pre-allocate
+        E_i = np.einsum("is,is->s", c_i, H_i_psi_det)
+        E = np.zeros_like(E_i)  # Pre-allocate
         self.comm.Allreduce(
             [E_i, MPI.DOUBLE], [E, MPI.DOUBLE]
         )  # Default op=SUM, reduce contributions
         # All ranks return varitonal energy
         # TODO: Fix this if there's a more efficient way to convert to a float
-        return E.item()
+        return E.item() if np.ndim(psi_coef) == 1 else E
+
+    def generator_indices(self, psi_coef: Psi_coef) -> np.ndarray:
+        r"""Indices of the internal determinants used as generators: by decreasing |c_I|, until
+        `generator_norm_fraction' of the norm of psi (\sum_I c_I^2) is covered
+        (sorted, to preserve the order of psi_internal). For several states, c_I^2 is summed over states"""
+        if self.generator_norm_fraction is None:
+            return np.arange(len(self.psi_internal))
+        c2 = np.square(self.coef_matrix(psi_coef)).sum(axis=1)
+        order = np.argsort(-c2, kind="stable")
+        covered_before = np.cumsum(c2[order]) - c2[order]
+        return np.sort(order[covered_before < self.generator_norm_fraction * c2.sum()])
+
+    @cached_property
+    def H_ij_max(self) -> float:
+        """Upper bound on |<I|H|J>| for I != J, from the largest integral magnitudes by category
+        (see |integral_category|): 2 V_max(E, F, G) for double excitations,
+        h_max + 2 N_elec V_max(C, D, E) for single excitations"""
+        V_single, V_double = 0.0, 0.0
+        for idx4, value in self.H_i_generator.d_two_e_integral.items():
+            category = integral_category(*compound_idx4_reverse(idx4))
+            if category in ("C", "D", "E"):
+                V_single = max(V_single, abs(value))
+            if category in ("E", "F", "G"):
+                V_double = max(V_double, abs(value))
+        h_max = max(
+            (abs(v) for (i, j), v in self.H_i_generator.d_one_e_integral.items() if i != j),
+            default=0.0,
+        )
+        n_elec = len(self.psi_internal[0].alpha) + len(self.psi_internal[0].beta)
+        return max(2 * V_double, h_max + 2 * n_elec * V_single)
 
-    def gen_local_constraints(self) -> Iterator[Tuple[OrbitalIdx, ...]]:
+    def constraint_pt2_bound(
+        self, C: Tuple[OrbitalIdx, ...], psi_coef: Psi_coef, E_var: Energy
+    ) -> float:
+        r"""Upper bound on |E_pt2(C)| = \sum_{J \in C} <Psi|H|J>^2 / |E_var - H_JJ|, as computed by
+        |psi_external_pt2| from the generators |I⟩ (see |generator_indices|)
+        With h_I(C) the number of determinants connected to |I⟩ satisfying C, numerators obey
+            \sum_J |<Psi|H|J>| <= H_max \sum_I |c_I| h_I(C)
+            max_J |<Psi|H|J>| <= H_max \sum_{I, h_I(C) > 0} |c_I|
+        and denominators are bounded from below by their minimum over the external |J⟩ satisfying C,
+        which are generated, but only their diagonal elements are computed (no <I|H|J>).
+        For several states, |c_I| is the largest over states, and the smallest denominator over
+        states is used: the bound holds for each state"""
+        generators = self.generator_indices(psi_coef)
+        psi_generators = self.psi_internal_packed[generators]
+        psi_J, G, _ = triplet_constrained_excitations(
+            psi_generators, C, self.psi_internal_packed, self.psi_internal_bloom_filter
+        )
+        if len(psi_J) == 0:
+            return 0.0
+        parents = generators[G]
+        H_ii_internal, F_internal = self.psi_internal_diagonal
+        H_JJ = self.H_i_generator.H_ii_incremental(
+            psi_J, self.psi_internal_packed[parents], H_ii_internal[parents], F_internal[parents]
+        )
+        denominator = np.abs(np.subtract.outer(H_JJ, np.atleast_1d(E_var))).min()
+        c = np.abs(self.coef_matrix(psi_coef)[generators]).max(axis=1)
+        h = constraint_connections(C, psi_generators, self.N_orb)
+        numerator = self.H_ij_max**2 * np.dot(c, h) * c[h > 0].sum()
+        return float(numerator / denominator) if denominator > 0 else np.inf
+
+    def gen_local_constraints(
+        self, psi_coef: Psi_coef = None, E_var: Energy = None
+    ) -> Iterator[Tuple[OrbitalIdx, ...]]:
         # Generate local constraints
         # Call to MPI function that yields local constraints
-        C_loc, _ = dispatch_local_constraints(self.comm, self.psi_internal, self.N_orb)
-        for C in C_loc:
+        psi_generators = self.psi_internal_packed
+        if psi_coef is not None:
+            # Only constraints reached from generators matter
+            psi_generators = psi_generators[self.generator_indices(psi_coef)]
+        screening = self.pt2_screening_threshold is not None and psi_coef is not None
+        if screening and E_var is None:
+            E_var = self.E(psi_coef)
+        screened = [0, 0.0]  # No. of constraints screened by this rank, and the sum of their bounds
+
+        def screened_out(C):
+            # Screening: skip constraints whose contribution is bounded below the threshold
+            bound = self.constraint_pt2_bound(C, psi_coef, E_var)
+            if bound < self.pt2_screening_threshold:
+                screened[0], screened[1] = screened[0] + 1, screened[1] + bound
+                return True
+            return False
+
+        # Constraints are screened before the load balancing, which only sees the computed ones
+        C_loc, H_loc = dispatch_local_constraints(
+            self.comm,
+            psi_generators,
+            self.N_orb,
+            self.constraint_runtimes,
+            screened_out if screening else None,
+        )
+        runtimes = {}
+        for C, h in zip(C_loc, H_loc):
+            start = time.perf_counter()
             yield C
+            # Time spent by the caller on C, until it asks for the next constraint
+            runtimes[C] = (time.perf_counter() - start, h)
+        if self.constraint_runtimes is not None:
+            for runtimes_rank in self.comm.allgather(runtimes):
+                self.constraint_runtimes.update(runtimes_rank)
+        if screening:
+            # Report the (global) screening; `bound_skipped' bounds the truncation error
+            n_skipped, bound_skipped = screened
+            self.pt2_screening_report = tuple(
+                self.comm.allreduce(x)
+                for x in (n_skipped, len(C_loc) + n_skipped, bound_skipped)
+            )
 
     def psi_external_pt2(
         self, C: Tuple[OrbitalIdx, ...], psi_coef: Psi_coef, E_var: Energy
     ) -> List[Energy]:
-        """
+        r"""
         Compute the E_pt2 contributions of a subset of the connected space determined by given constraiant C
         The individual pt2 contribution of each connected det |J⟩ is given by
             E_pt2_J = ⟨Ψ(n)∣H∣∣J⟩^2 / ( E(n)−⟨J∣H∣∣J⟩ )
@@ -2953,98 +4295,109 @@ class Powerplant_manager(object):
                   This function only generates determinants |C⟩ (and the corresponding E_pt2 contributions)
                   s.to C (i.e., only generate connected dets occupied in orbitals a_0, a_1, a_2)
         :param psi_coef: list of determinant coefficients in expansion of trial WF
+                         (or matrix, one column per state, see |Powerplant_manager|)
 
         Outputs:
+        Connected determinants s.to |C⟩ (as a |DetArray|), and
         List of energies, Jth entry contains E_pt2 contribution of determinant |J⟩ \in connected space s.to |C⟩
+        (for several states, Jth row contains the E_pt2 contributions of |J⟩ to each state)
         """
 
         # Compute len(psi_internal) \times len(psi_external_chunk) `Hamiltonian'
         # Each rank computes its contributions in place, these are then gathered to compute the full pt2 energy in self.E_pt2
-        c = np.array(psi_coef, dtype="float")  # Coef. vector as np array
-        # Pre-allocate space for nominators of E_pt2 contributions (as dict for now)
-        nominator_conts_table = defaultdict(int)
-        # Two-electron matrix elements
+        c = self.coef_matrix(psi_coef)  # Coef. vectors as the columns of a np array
+        # Matrix elements <I|H|J> are emitted as (|J⟩, value) pairs (|J⟩ packed); numerator contributions
+        # of all states, c[I, :] * <I|H|J>, are then aggregated by `sort and accumulate' on the packed bitstrings of |J⟩
+        # so the connected space is generated once, whatever the number of states
+        # The parent |I⟩ of each |J⟩ is kept, to compute ⟨J∣H∣∣J⟩ incrementally from ⟨I∣H∣∣I⟩
 
         # By constraint:
         # for C in constraints:
         #   for I, J in gen_connected_by_constraint(psi_internal, C):
         #       E_pt2_J <- (|J⟩, c[I]* <I|H|J>)
         # Store pairs of (|J⟩, E_pt2_J) -> By end of inner loop, partial contribution of |J⟩ to E_pt2 is fully computed
-        # As in [Tubman et al., `18] they instead store individual numerator conts separately, do a sort by bistring, then aggregate across bitstrings
+        # As in [Tubman et al., `18], store individual numerator conts separately, do a sort by bistring, then aggregate across bitstrings
 
+        # Generators of the connected space (all internal determinants, unless screened by |c_I|)
+        # Internal determinants that are not generators are still removed from the connected space below
+        generators = self.generator_indices(psi_coef)
+        psi_generators = self.psi_internal_packed[generators]
         if self.H_i_generator.driven_by == "determinant":
-            # Pass over internal determinants
-            for I, det_I in enumerate(self.psi_internal):
-                # Inner pass (for each |I⟩) generates all excitations satisfying constraint |C⟩ from |I⟩
-                # Triplet constrained singles
-                for det_J in det_I.triplet_constrained_single_excitations_from_det(C, self.N_orb):
-                    for (
-                        idx,
-                        phase,
-                    ) in self.H_i_generator.Hamiltonian_2e_driver.H_ij_indices(det_I, det_J):
-                        nominator_conts_table[det_J] += (
-                            c[I]
-                            * phase
-                            * self.H_i_generator.Hamiltonian_2e_driver.H_ijkl_orbital(*idx)
-                        )
-                    nominator_conts_table[det_J] += c[
-                        I
-                    ] * self.H_i_generator.Hamiltonian_1e_driver.H_ij(det_I, det_J)
-                # Triplet-constrained doubles
-                for det_J in det_I.triplet_constrained_double_excitations_from_det(C, self.N_orb):
-                    for (
-                        idx,
-                        phase,
-                    ) in self.H_i_generator.Hamiltonian_2e_driver.H_ij_indices(det_I, det_J):
-                        nominator_conts_table[det_J] += (
-                            c[I]
-                            * phase
-                            * self.H_i_generator.Hamiltonian_2e_driver.H_ijkl_orbital(*idx)
-                        )
+            # Excitations (|J⟩, index in generators) satisfying constraint |C⟩, in one batch;
+            # internal determinants are already rejected
+            psi_J, G, _ = triplet_constrained_excitations(
+                psi_generators, C, self.psi_internal_packed, self.psi_internal_bloom_filter
+            )
+            J_parents = generators[G]
+            # <I|H|J> of all the (I, J) pairs at once
+            J_H = self.H_i_generator.H_ij_batch(self.psi_internal_packed[J_parents], psi_J)
         elif self.H_i_generator.driven_by == "integral":
-            for (
-                (I, det_J),
-                idx,
-                phase,
-            ) in self.H_i_generator.Hamiltonian_2e_driver.H_indices_pt2(self.psi_internal, C):
-                nominator_conts_table[det_J] += (
-                    c[I] * phase * self.H_i_generator.Hamiltonian_2e_driver.H_ijkl_orbital(*idx)
-                )
-            # One-electron matrix elements
-            for I, det_I in enumerate(self.psi_internal):
-                # Inner pass (for each |I⟩) generates all excitations satisfying constraint |C⟩ from |I⟩
-                # Triplet constrained singles
-                # Each det_J will show up all connected to multiple I.. so have to do this outside of integral loop
-                for det_J in det_I.triplet_constrained_single_excitations_from_det(C, self.N_orb):
-                    nominator_conts_table[det_J] += c[
-                        I
-                    ] * self.H_i_generator.Hamiltonian_1e_driver.H_ij(det_I, det_J)
+            H_2e_driver = self.H_i_generator.Hamiltonian_2e_driver
+            J_words, J_H, J_parents = [], [], []
+            # Two-electron matrix elements, one batch of pairs per integral
+            for (G, psi_J), idx, phases in H_2e_driver.H_indices_pt2(psi_generators, C):
+                J_words.append(psi_J.words)
+                J_H.append(phases * H_2e_driver.H_ijkl_orbital(*idx))
+                J_parents.append(generators[G])
+            # One-electron matrix elements, of the triplet constrained singles
+            # Each |J⟩ will show up connected to multiple I, so this is done outside of the integral loop
+            psi_J, G, _ = triplet_constrained_excitations(psi_generators, C, max_degree=1)
+            J_words.append(psi_J.words)
+            J_H.append(
+                self.H_i_generator.Hamiltonian_1e_driver.H_ij_batch(psi_generators[G], psi_J)
+            )
+            J_parents.append(generators[G])
+            psi_J = DetArray(np.concatenate(J_words), self.N_orb)
+            J_H, J_parents = np.concatenate(J_H), np.concatenate(J_parents)
         else:
             raise NotImplementedError
 
-        # Remove contributions of internal determinants
-        for det_I in self.psi_internal:
-            if det_I in nominator_conts_table:
-                del nominator_conts_table[det_I]
-        # `Sort and accumulate` E_pt2 contributions corresponding to individual dets ∣J⟩ done in place above...
-        # Each item in (key, item) pair is the partial E_pt2 contribution of ∣J⟩ -> Denoted E_pt2_J
-
-        E_pt2_J = nominator_conts_table.values()
-        nominator_conts = np.array(list(E_pt2_J), dtype="float")
-        # TODO: For integral driven, loop over integrals? In general, be more efficient in this area.
-        psi_connected_C = [det_J for det_J in nominator_conts_table.keys()]
-        denominator_conts = np.divide(
-            1.0,
-            E_var - np.array([self.H_i_generator.H_ii(det_J) for det_J in psi_connected_C]),
+        # Aggregate E_pt2 contributions of individual dets ∣J⟩ -> one numerator per unique ∣J⟩
+        J_conts = c[J_parents] * np.asarray(J_H, dtype="float")[:, np.newaxis]
+        if es_lib is not None:
+            # Hash map keyed by the packed bitstrings of ∣J⟩, in one pass
+            accumulator = External_space_accumulator(self.N_orb, c.shape[1])
+            accumulator.add(psi_J, J_conts, J_parents)
+            psi_connected_C_packed, nominator_conts, parents = accumulator.result()
+        else:
+            # `Sort and accumulate`: sort the packed keys of ∣J⟩, and reduce contiguous runs
+            psi_connected_C_packed, nominator_conts, first = psi_J.accumulate(
+                J_conts, return_index=True
+            )
+            parents = J_parents[first]
+        # Remove contributions of internal determinants; only those satisfying C can be connected here
+        # Candidates are first prefiltered by the Bloom filter, then searched in the bucket of C
+        external = np.ones(len(psi_connected_C_packed), dtype=bool)
+        psi_internal_C = self.psi_internal_by_constraint.get(tuple(C))
+        if psi_internal_C is not None:
+            candidates = np.arange(len(psi_connected_C_packed))
+            if self.psi_internal_bloom_filter is not None:
+                candidates = np.flatnonzero(
+                    self.psi_internal_bloom_filter.may_contain(psi_connected_C_packed)
+                )
+            external[candidates] = psi_internal_C.index(psi_connected_C_packed[candidates]) < 0
+        nominator_conts = nominator_conts[external]
+        psi_connected_C_packed = psi_connected_C_packed[external]
+        parents = parents[external]
+        # Diagonal elements <J|H|J>, updated from the diagonal and orbital energies of one parent |I⟩
+        H_ii_internal, F_internal = self.psi_internal_diagonal
+        H_ii_connected = self.H_i_generator.H_ii_incremental(
+            psi_connected_C_packed,
+            self.psi_internal_packed[parents],
+            H_ii_internal[parents],
+            F_internal[parents],
         )
+        # One column per state, E_var being the vector of the variational energies of the states
+        denominator_conts = np.divide(1.0, np.atleast_1d(E_var) - H_ii_connected[:, np.newaxis])
 
         # Compute E_pt2 contributions of this subset of connected space
         # Do this einsum in place, then Reduce later
         # Return the determinants we generated as well for the selection step
+        E_pt2_conts = np.einsum("is,is,is -> is", nominator_conts, nominator_conts, denominator_conts)
         return (
-            psi_connected_C,
-            np.einsum("i,i,i -> i", nominator_conts, nominator_conts, denominator_conts),
-        )  # vector * vector * vector -> scalar
+            psi_connected_C_packed,
+            E_pt2_conts[:, 0] if np.ndim(psi_coef) == 1 else E_pt2_conts,
+        )  # vector * vector * vector -> scalar, for each state
 
     def E_pt2(self, psi_coef: Psi_coef) -> Energy:
         """
@@ -3055,24 +4408,149 @@ class Powerplant_manager(object):
         :param psi_coef: list of determinant coefficients in expansion of trial WF
 
         Output:
-        E_pt2 value for the current CIPSI iteration, as a float
+        E_pt2 value for the current CIPSI iteration, as a float (a vector of one value per state
+        for several states)
         """
 
         # Pre-allocate space for the reduced E_pt2 contributions
         E_var = self.E(psi_coef)  # Pre-compute variational energy
-        E_pt2_conts = np.zeros(1, dtype="double")
+        E_pt2_conts = np.zeros(np.size(E_var), dtype="double")
         # Generate chunks of the connected space by constraints
-        for C in self.gen_local_constraints():
+        for C in self.gen_local_constraints(psi_coef, E_var):
             # Track E_pt2 contributions of determinants in the current chunk of the connected space
             _, E_pt2_conts_local = self.psi_external_pt2(C, psi_coef, E_var)
-            E_pt2_conts += sum(E_pt2_conts_local)
+            E_pt2_conts += E_pt2_conts_local.sum(axis=0)
 
         # Sum in place -> MPI.Allreduce call
         # Equivalent to MPI AllGather + sum. Do this because we can't store the full external space
-        _E_pt2 = np.zeros(1, dtype="double")  # Pre-allocate recvbuf for final E_pt2 value
+        _E_pt2 = np.zeros_like(E_pt2_conts)  # Pre-allocate recvbuf for final E_pt2 value(s)
         self.comm.Allreduce([E_pt2_conts, MPI.DOUBLE], [_E_pt2, MPI.DOUBLE])
 
-        return _E_pt2.item()
+        return _E_pt2.item() if np.ndim(psi_coef) == 1 else _E_pt2
+
+    def constraint_weights(
+        self, psi_coef: Psi_coef, E_var: Energy = None
+    ) -> Tuple[List[Tuple[OrbitalIdx, ...]], np.ndarray]:
+        r"""All triplet-constraints generating at least one connected determinant, and their weights
+        w_C = \sum_I c_I^2 h_I(C), with h_I(C) the number of determinants connected to |I⟩ satisfying C.
+        For several states, c_I^2 is summed over states.
+        The constraints are those of |gen_local_constraints|: only the generators |I⟩ (see
+        |generator_indices|) are summed over, and constraints screened by `pt2_screening_threshold'
+        are dropped.
+        Weights are computed in // and are identical on all ranks"""
+        generators = self.generator_indices(psi_coef)
+        c2 = np.square(self.coef_matrix(psi_coef)[generators]).sum(axis=1)
+        psi_generators = self.psi_internal_packed[generators]
+        na = getattr(self.psi_internal[0], "alpha").popcnt()  # No. of alpha electrons
+        constraints = generate_all_constraints(na, self.N_orb)
+        w_local = np.zeros(len(constraints), dtype="float")
+        local = range(self.rank, len(constraints), self.world_size)
+        chunk = max(1, 2**20 // len(psi_generators))
+        for start in range(0, len(local), chunk):
+            k = local[start : start + chunk]
+            w_local[k] = constraint_connections_matrix(
+                [constraints[i] for i in k], psi_generators, self.N_orb
+            ) @ c2
+        if self.pt2_screening_threshold is not None:
+            # Same screening (and report) as the constraints actually computed
+            if E_var is None:
+                E_var = self.E(psi_coef)
+            n_skipped, bound_skipped = 0, 0.0
+            for i in np.flatnonzero(w_local):
+                bound = self.constraint_pt2_bound(constraints[i], psi_coef, E_var)
+                if bound < self.pt2_screening_threshold:
+                    n_skipped, bound_skipped = n_skipped + 1, bound_skipped + bound
+                    w_local[i] = 0.0
+            self.pt2_screening_report = tuple(
+                self.comm.allreduce(x)
+                for x in (n_skipped, np.count_nonzero(w_local) + n_skipped, bound_skipped)
+            )
+        w = np.zeros(len(constraints), dtype="float")
+        self.comm.Allreduce([w_local, MPI.DOUBLE], [w, MPI.DOUBLE])
+        nonzero = np.flatnonzero(w)
+        return [constraints[k] for k in nonzero], w[nonzero]
+
+    def E_pt2_stochastic(
+        self,
+        psi_coef: Psi_coef,
+        error_target: float,
+        deterministic_weight: float = 0.5,
+        n_samples_batch: int = 8,
+        seed: int = 0,
+        on_constraint: Callable[[DetArray, np.ndarray], None] = None,
+    ) -> Tuple[Energy, float]:
+        r"""
+        Semistochastic E_pt2, in the style of [Garniron et al., `17]
+        The connected space is partitioned by triplet-constraints, and E_pt2 = \sum_C e_C.
+            - Constraints with the largest weights (up to `deterministic_weight' of the total weight)
+              are computed deterministically.
+            - The remainder is sampled with probability p_C ∝ w_C, and estimated as the mean of e_C / p_C.
+        Samples are drawn in batches of `n_samples_batch' per rank, until the statistical error is below
+        `error_target'. Exact e_C are kept, so each constraint is computed at most once; once all
+        constraints have been computed, the exact E_pt2 is returned (with a zero error).
+        Samples are identical on all ranks (same seed), and new constraints are computed in //
+        For several states, the same samples are used for all of them, until the error of each state
+        is below `error_target'; E_pt2 and the errors are then vectors (one value per state)
+
+        Inputs:
+        :param psi_coef: list of determinant coefficients in expansion of trial WF
+        :param error_target: target statistical error (one standard deviation) on E_pt2
+        :param on_constraint: called with the connected determinants of each constraint computed by
+                              this rank, and their E_pt2 contributions (see |psi_external_pt2|)
+
+        Output:
+        (E_pt2, statistical error) for the current CIPSI iteration
+        """
+        E_var = self.E(psi_coef)  # Pre-compute variational energy
+        constraints, w = self.constraint_weights(psi_coef, E_var)
+        # Exact contributions e_C computed so far (one column per state), NaN if unknown
+        e = np.full((len(constraints), np.size(E_var)), np.nan)
+
+        def compute(indices):
+            # Compute e_C for new constraints in // and share them with all ranks
+            local = []
+            for k in indices[self.rank :: self.world_size]:
+                psi_connected_C, E_pt2_energies_C = self.psi_external_pt2(
+                    constraints[k], psi_coef, E_var
+                )
+                if on_constraint is not None:
+                    on_constraint(psi_connected_C, E_pt2_energies_C)
+                local.append((k, E_pt2_energies_C.sum(axis=0)))
+            for e_rank in self.comm.allgather(local):
+                for k, e_C in e_rank:
+                    e[k] = e_C
+
+        # Deterministic part: largest weights first
+        order = np.argsort(-w, kind="stable")
+        w_before = np.cumsum(w[order]) - w[order]
+        n_deterministic = np.count_nonzero(w_before < deterministic_weight * w.sum())
+        deterministic, stochastic = order[:n_deterministic], order[n_deterministic:]
+        compute(deterministic)
+        E_deterministic = e[deterministic].sum(axis=0)
+
+        def result(E_pt2, error):
+            # Floats for a single state, vectors for several states
+            if np.ndim(psi_coef) == 1:
+                return E_pt2.item(), error.item()
+            return E_pt2, error
+
+        # Stochastic part: importance sampling of the remaining constraints
+        p = w[stochastic] / w[stochastic].sum()
+        rng = np.random.default_rng(seed)
+        n_samples, sum_x, sum_x2 = 0, 0.0, 0.0  # Running sums of the samples x = e_C / p_C
+        while np.isnan(e[stochastic]).any():
+            draws = rng.choice(len(stochastic), size=n_samples_batch * self.world_size, p=p)
+            new = np.unique(stochastic[draws])
+            compute(new[np.isnan(e[new]).any(axis=1)])
+            x = e[stochastic[draws]] / p[draws, np.newaxis]
+            n_samples = n_samples + len(x)
+            sum_x, sum_x2 = sum_x + x.sum(axis=0), sum_x2 + np.square(x).sum(axis=0)
+            mean = sum_x / n_samples
+            error = np.sqrt(np.maximum(sum_x2 / n_samples - mean**2, 0.0) / (n_samples - 1))
+            if n_samples > len(draws) and np.all(error <= error_target):
+                return result(E_deterministic + mean, error)
+        # Every constraint has been computed, no need to sample anymore
+        return result(E_deterministic + e[stochastic].sum(axis=0), np.zeros_like(E_deterministic))
 
 
 #  __
@@ -3090,32 +4568,67 @@ def selection_step(
     psi_coef: Psi_coef,
     psi_det: Psi_det,
     n,
+    pt2_fraction: float = None,
+    pt2_screening_threshold: float = None,
+    generator_norm_fraction: float = None,
+    constraint_runtimes: Dict[Tuple[OrbitalIdx, ...], Tuple[float, int]] = None,
+    state_selection: str = "average",
+    pt2_error_target: float = None,
+    pt2_report: Dict[str, Energy] = None,
 ) -> Tuple[Energy, Psi_coef, Psi_det]:
     # 1. Each MPI rank has a subset of constraints and computes E_pt2 contributions of determinants in this constraint (disjoint partitioning)
     # 2. Take the n determinants (across ranks) who have the biggest contribution and add it the wave function psi
+    #    If `pt2_fraction' is given, n is a hard cap: only take the determinants with the biggest contributions
+    #    until `pt2_fraction' of E_pt2 is captured (as the selection factor of Quantum Package)
     # 3. Diagonalize H corresponding to this new wave function to get the new variational energy, and new psi_coef
+    # For several states (psi_coef as a matrix, one column per state), E_pt2 contributions of all states are
+    # computed in the same pass over the connected space; determinants are selected by the average of
+    # their contributions over states, or by their largest contribution to any state (`state_selection',
+    # see |pt2_selection_criterion|), and the new energies and psi_coef are those of the same number of states
+    # If `pt2_error_target' is given, E_pt2 is estimated semistochastically to this statistical error
+    # (see |Powerplant_manager.E_pt2_stochastic|); only the determinants of the constraints computed
+    # for the estimate are candidates for selection
+    # E_pt2 of the input wave function, its error, and the screening of the constraints
+    # (see |Powerplant_manager.pt2_screening_report|) are written into `pt2_report' (if given)
 
     # In the main code:
     # -> Go to 1., stop when E_pt2 < Threshold || N < Threshold
     # See example of chained call to this function in `test_f2_631g_1p5p5det`
 
     # Instance of Powerplant manager class for computing E_pt2 energies
-    PP_manager = Powerplant_manager(comm, lewis)
+    # Constraints whose E_pt2 contribution is bounded below `pt2_screening_threshold' are skipped
+    # Generators are restricted to the determinants covering `generator_norm_fraction' of the norm
+    # Runtimes of the constraints are recorded into `constraint_runtimes' (if given), to schedule the next iteration
+    PP_manager = Powerplant_manager(
+        comm, lewis, pt2_screening_threshold, generator_norm_fraction, constraint_runtimes
+    )
 
     # Each rank generates a chunk of the external space at the time -> computes the E_pt2 contributions of its respective chunk
     # Compute the n (local) best contributions on each rank -> Allgather + partial sort to get n global best across ranks
 
     # 1.
     # Compute the local best E_pt2 contributions + associated dets
-    local_best_dets, local_best_energies = local_sort_pt2_energies(PP_manager, psi_coef, psi_det, n)
+    local_best_dets, local_best_energies, E_pt2_criterion, E_pt2, error = local_sort_pt2_energies(
+        PP_manager, psi_coef, psi_det, n, state_selection, pt2_error_target
+    )
+    if pt2_report is not None:
+        pt2_report.update(E_pt2=E_pt2, error=error, screening=PP_manager.pt2_screening_report)
 
     # 2.
     # Global sort local contributions to get global best E_pt2 contributions + dets
-    global_best_dets = global_sort_pt2_energies(comm, local_best_dets, local_best_energies, n)
+    global_best_dets = global_sort_pt2_energies(
+        comm,
+        local_best_dets,
+        local_best_energies,
+        n,
+        PP_manager.psi_internal_packed,
+        pt2_fraction,
+        E_pt2_criterion,
+    )
 
     # 3.
     # Add `best' determinants to the trial wavefunction
-    psi_det_extented = psi_det + global_best_dets
+    psi_det_extented = psi_det + global_best_dets.to_psi_det()
 
     # 4.
     # New instance of Hamiltonian manager class for the extended wavefunction
@@ -3125,70 +4638,255 @@ def selection_step(
         lewis.d_one_e_integral,
         lewis.d_two_e_integral,
         psi_det_extented,
+        lewis.driven_by,
+        lewis.max_H_cache_bytes,
+        lewis.H_cache_spill,
+        lewis.H_cache_dir,
+        lewis.H_cache_block_size,
+        lewis.vector_exchange,
     )
 
     # Return new E_var, psi_coef, and extended wavefunction
-    return (*Powerplant_manager(comm, lewis_new).E_and_psi_coef, psi_det_extented)
+    n_states = None if np.ndim(psi_coef) == 1 else np.shape(psi_coef)[1]
+    return (
+        *Powerplant_manager(comm, lewis_new, n_states=n_states).E_and_psi_coef,
+        psi_det_extented,
+    )
+
+
+class Top_k_buffer(object):
+    """Fixed-capacity buffer of the k largest magnitude E_pt2 contributions seen so far, and their
+    (packed) determinants. PT2 contributions are always < 0, and 1 is used as a tombstone value for
+    empty slots. Candidates above the current threshold (the worst kept energy) are rejected without
+    being copied; only the survivors are merged with the buffer.
+
+    >>> buffer = Top_k_buffer(2, 4)
+    >>> psi = DetArray.from_psi_det([Determinant((0, 1), (0, 1)), Determinant((0, 2), (0, 1)),
+    ...                              Determinant((0, 3), (0, 1))], 4)
+    >>> buffer.push(psi, np.array([-0.1, -0.3, -0.2]))
+    >>> sorted(zip(buffer.energies.tolist(), buffer.psi))
+    [(-0.3, Determinant(alpha=(0, 2), beta=(0, 1))), (-0.2, Determinant(alpha=(0, 3), beta=(0, 1)))]
+    >>> buffer.threshold
+    -0.2
+    """
+
+    def __init__(self, k: int, n_orb: int):
+        self.k = k
+        self.n_orb = n_orb
+        self.energies = np.ones(k, dtype="float")
+        self.words = np.zeros((k, 2, DetArray.n_words(n_orb)), dtype=np.uint64)
+        # Candidates have to be below the threshold to be merged; an empty buffer rejects everything
+        self.threshold = 1.0 if k else -np.inf
+        # Sum of all the E_pt2 contributions pushed, kept or not
+        self.E_pt2 = 0.0
+
+    def push(self, psi: DetArray, energies: np.ndarray):
+        """Merge candidate determinants and their E_pt2 contributions into the buffer"""
+        self.E_pt2 += energies.sum().item()
+        survivors = np.flatnonzero(energies < self.threshold)
+        if not len(survivors):
+            return
+        if len(survivors) > self.k:
+            # Only the k best survivors can make it into the buffer
+            survivors = survivors[np.argpartition(energies[survivors], self.k - 1)[: self.k]]
+        working_energies = np.concatenate([self.energies, energies[survivors]])
+        working_words = np.concatenate([self.words, psi.words[survivors]])
+        best = np.argpartition(working_energies, self.k - 1)[: self.k]
+        self.energies = working_energies[best]
+        self.words = working_words[best]
+        self.threshold = self.energies.max().item()
+
+    @property
+    def psi(self) -> DetArray:
+        # Tombstones are empty words (`dummy' determinants Determinant((), ()))
+        return DetArray(self.words, self.n_orb)
+
+
+def merge_top_k(energies: np.ndarray, psi: DetArray, n: int) -> Tuple[np.ndarray, DetArray]:
+    """Keep the n largest magnitude E_pt2 contributions of unique determinants, dropping tombstones
+    (energy of 1, see |Top_k_buffer|)
+    >>> psi = DetArray.from_psi_det([Determinant((0, 1), (0, 1)), Determinant((0, 2), (0, 1)),
+    ...                              Determinant((0, 1), (0, 1)), Determinant((), ())], 4)
+    >>> energies, best = merge_top_k(np.array([-0.2, -0.1, -0.2, 1.0]), psi, 3)
+    >>> sorted(zip(energies.tolist(), best))
+    [(-0.2, Determinant(alpha=(0, 1), beta=(0, 1))), (-0.1, Determinant(alpha=(0, 2), beta=(0, 1)))]
+    """
+    keep = np.flatnonzero(energies < 1.0)
+    _, unique = np.unique(psi[keep].keys, return_index=True)
+    keep = keep[unique]
+    if len(keep) > n:
+        keep = keep[np.argpartition(energies[keep], n - 1)[:n]] if n else keep[:0]
+    return energies[keep], psi[keep]
+
+
+def pt2_selection_criterion(E_pt2_J: np.ndarray, state_selection: str = "average") -> np.ndarray:
+    """Selection criterion of connected determinants, from their E_pt2 contributions to several states
+    (one column per state): the average over states ("average"), or the largest magnitude contribution
+    to any state ("max"; contributions to excited states can be > 0). Contributions to a single state
+    (a vector) are their own criterion
+    >>> E_pt2_J = np.array([[-0.1, -0.3], [-0.2, 0.4]])
+    >>> pt2_selection_criterion(E_pt2_J, "average")
+    array([-0.2,  0.1])
+    >>> pt2_selection_criterion(E_pt2_J, "max")
+    array([-0.3,  0.4])
+    >>> pt2_selection_criterion(E_pt2_J[:, 0], "min")
+    Traceback (most recent call last):
+        ...
+    ValueError: Unknown state_selection: min
+    """
+    if state_selection not in ("average", "max"):
+        raise ValueError(f"Unknown state_selection: {state_selection}")
+    if E_pt2_J.ndim == 1:
+        return E_pt2_J
+    if state_selection == "average":
+        return E_pt2_J.mean(axis=1)
+    return E_pt2_J[np.arange(len(E_pt2_J)), np.abs(E_pt2_J).argmax(axis=1)]
 
 
 def local_sort_pt2_energies(
-    PP_manager: Powerplant_manager, psi_coef: Psi_coef, psi_det: Psi_det, n
+    PP_manager: Powerplant_manager,
+    psi_coef: Psi_coef,
+    psi_det: Psi_det,
+    n,
+    state_selection: str = "average",
+    pt2_error_target: float = None,
 ):
     # Function to compute the local n best E_pt2 contributions
     # Each rank computes the best contributions from a (disjoint) subset of the connected space, determined by constraint
+    # For several states, contributions are ranked by their `pt2_selection_criterion'
+    # With `pt2_error_target', only the constraints needed by the semistochastic E_pt2 are computed
+    # (see |Powerplant_manager.E_pt2_stochastic|), and determinants are selected among theirs
 
-    # Pre-allocate space to track bests from previous chunk
-    E_var = PP_manager.E(psi_coef)
-    # PT2 contribution are always < 0, use 1 as a tombstone value; these will never be selected
-    local_best_energies = np.ones(n, dtype="float")
+    # Pre-allocate space to track the n bests; memory stays O(n) whatever the number of constraints
     # TODO: Will have to think more carefully about the case when size of the constraint space is < n
-    # `Dummy' determinants, corresponding to local_best_energies = 1
-    local_best_dets = [Determinant((), ())] * n
+    local_best = Top_k_buffer(n, PP_manager.N_orb)
+
+    def push(psi_connected_C, E_pt2_energies_C):
+        # Update `local' n largest magnitude E_pt2 contributions with the current chunk
+        # Contributions to excited states can be > 0, so criteria are ranked as -|criterion|:
+        # the n `smallest' are the largest magnitude contributors (E_pt2 < 0 for a single state)
+        criterion = pt2_selection_criterion(E_pt2_energies_C, state_selection)
+        local_best.push(psi_connected_C, -np.abs(criterion))
+
+    if pt2_error_target is not None:
+        E_pt2, error = PP_manager.E_pt2_stochastic(psi_coef, pt2_error_target, on_constraint=push)
+        # Total of the (ranked) selection criterion, estimated from the E_pt2 of each state
+        # (exact for a single state; its magnitude is at most the one of the exact total otherwise)
+        criterion = pt2_selection_criterion(np.atleast_2d(E_pt2), state_selection)
+        E_pt2_criterion = -abs(criterion.item())
+        return local_best.psi, local_best.energies, E_pt2_criterion, E_pt2, error
 
-    for C in PP_manager.gen_local_constraints():
+    E_var = PP_manager.E(psi_coef)
+    E_pt2_local = np.zeros(np.size(E_var), dtype="double")
+    for C in PP_manager.gen_local_constraints(psi_coef, E_var):
         # 1.
         # Compute E_pt2 contributions of current chunk of determinants
         # It is assumed that `chunk_size` is enough to fit in memory
         psi_connected_C, E_pt2_energies_C = PP_manager.psi_external_pt2(C, psi_coef, E_var)
+        E_pt2_local += E_pt2_energies_C.sum(axis=0)
 
         # 2.
-        # Aggregate current E_pt2 contributions and current n `best' contributions to partial sort
-        if len(E_pt2_energies_C) > 0:
-            working_energies = np.r_[E_pt2_energies_C, local_best_energies]
-            working_dets = psi_connected_C + local_best_dets
-        else:
-            # Nothing generated; local best dets and energies remain the same... Pass to next constraint in loop
-            continue
-
-        # Update `local' n largest magnitude E_pt2 contributions from working chunk -> indices of top n determinants
-        # E_pt2 < 0, so n `smallest' are actually the largest magnitude contributors
-        local_idx = np.argpartition(working_energies, n)[:n]
-        local_best_energies = np.array(working_energies[local_idx], dtype="float")
-        # Get determinants that are the local best contributors
-        local_best_dets = [working_dets[i] for i in local_idx]
-
-    # Return n largest magnitude energies/dets from this rank
-    return local_best_dets, local_best_energies
-
-
-def global_sort_pt2_energies(comm, local_best_dets: Psi_det, local_best_energies, n):
-    # MPI Gather call local bests -> partial sort to get n global best of these guys
-    # Ugly, but at least we can store this in memory
-    # Pre-allocate space + Gather locally best contributions on all ranks
-    if comm.Get_size() > 1:
-        aggregated_energies = np.zeros((comm.Get_size()) * n, dtype="float")
-        comm.Allgather([local_best_energies, MPI.DOUBLE], [aggregated_energies, MPI.DOUBLE])
-        # Lower-case MPI command for python objs
-        aggregated_dets_ = comm.allgather(local_best_dets)
-        # mpi4py gathers lists into a list of lists -> need to unpack into a single list
-        aggregated_dets = list(chain.from_iterable(aggregated_dets_))
-        # Partial sort gathered local bests -> `global' n largest mangitude E_pt2 contributions
-        global_idx = np.argpartition(aggregated_energies, n)[:n]
-
-        # Now, save global best E_pt2 contributors
-        global_best_dets = [aggregated_dets[i] for i in global_idx]
+        push(psi_connected_C, E_pt2_energies_C)
+
+    E_pt2 = np.zeros_like(E_pt2_local)
+    PP_manager.comm.Allreduce([E_pt2_local, MPI.DOUBLE], [E_pt2, MPI.DOUBLE])
+    if np.ndim(psi_coef) == 1:
+        E_pt2 = E_pt2.item()
+    # Return n largest magnitude energies/dets from this rank, the (total) E_pt2 of the selection
+    # criterion, E_pt2 (of each state), and its error (none, E_pt2 is exact)
+    return (
+        local_best.psi,
+        local_best.energies,
+        PP_manager.comm.allreduce(local_best.E_pt2),
+        E_pt2,
+        np.zeros_like(E_pt2),
+    )
+
+
+def tree_merge_top_k(comm, energies: np.ndarray, psi: DetArray, n: int) -> Tuple[np.ndarray, DetArray]:
+    """MPI function, reduce the (energy, determinant) records of all ranks to the n best unique ones
+    Binomial reduction tree: at each of the log2(P) levels, a rank receives the (at most n) records of
+    its partner, merges them with its own and keeps n. Only the final n records are broadcast by rank 0.
+    Records are exchanged as typed buffers: their number (MPI.INT64_T), energies (MPI.DOUBLE)
+    and packed determinants (MPI.UINT64_T)"""
+    rank, size = comm.Get_rank(), comm.Get_size()
+    energies, psi = merge_top_k(energies, psi, n)
+    shape = psi.words.shape[1:]
+    m = np.zeros(1, dtype=np.int64)  # No. of records exchanged
+    step = 1
+    while step < size:
+        if rank % (2 * step):
+            # Send records to the partner one level up, and leave the tree
+            m[0] = len(energies)
+            comm.Send([m, MPI.INT64_T], dest=rank - step, tag=0)
+            comm.Send([energies, MPI.DOUBLE], dest=rank - step, tag=1)
+            comm.Send([np.ascontiguousarray(psi.words), MPI.UINT64_T], dest=rank - step, tag=2)
+            break
+        if rank + step < size:
+            comm.Recv([m, MPI.INT64_T], source=rank + step, tag=0)
+            energies_partner = np.empty(m[0], dtype="float")
+            words_partner = np.empty((m[0], *shape), dtype=np.uint64)
+            comm.Recv([energies_partner, MPI.DOUBLE], source=rank + step, tag=1)
+            comm.Recv([words_partner, MPI.UINT64_T], source=rank + step, tag=2)
+            energies, psi = merge_top_k(
+                np.concatenate([energies, energies_partner]),
+                DetArray(np.concatenate([psi.words, words_partner]), psi.n_orb),
+                n,
+            )
+        step *= 2
+    # Broadcast the n best records of the root
+    m[0] = len(energies)
+    comm.Bcast([m, MPI.INT64_T], root=0)
+    if rank:
+        energies, words = np.empty(m[0], dtype="float"), np.empty((m[0], *shape), dtype=np.uint64)
     else:
-        global_best_dets = local_best_dets
+        energies, words = np.ascontiguousarray(energies), np.ascontiguousarray(psi.words)
+    comm.Bcast([energies, MPI.DOUBLE], root=0)
+    comm.Bcast([words, MPI.UINT64_T], root=0)
+    return energies, DetArray(words, psi.n_orb)
+
+
+def pt2_fraction_cutoff(energies: np.ndarray, E_pt2: Energy, pt2_fraction: float) -> np.ndarray:
+    """Indices of the largest magnitude E_pt2 contributions, just enough of them to capture
+    `pt2_fraction' of E_pt2 (or all of them, if they sum to less than that)
+    >>> pt2_fraction_cutoff(np.array([-0.1, -0.5, -0.3, -0.1]), -1.0, 0.75)
+    array([1, 2])
+    >>> pt2_fraction_cutoff(np.array([-0.1, -0.5, -0.3, -0.1]), -1.0, 0.8)
+    array([1, 2])
+    >>> pt2_fraction_cutoff(np.array([-0.1, -0.5, -0.3, -0.1]), -1.0, 0.81)
+    array([1, 2, 0])
+    """
+    order = np.argsort(energies, kind="stable")
+    captured_before = np.cumsum(energies[order]) - energies[order]
+    # E_pt2 < 0; keep a determinant while what is captured before it is not enough
+    return order[captured_before > pt2_fraction * E_pt2 + 1e-12 * abs(E_pt2)]
+
+
+def global_sort_pt2_energies(
+    comm,
+    local_best_dets: DetArray,
+    local_best_energies,
+    n,
+    psi_internal: DetArray = None,
+    pt2_fraction: float = None,
+    E_pt2: Energy = None,
+) -> DetArray:
+    # Reduce local bests -> n global best of these guys, through a reduction tree
+    # Each rank only ever holds 2 * n records; duplicates and tombstones are dropped at each merge
+    if psi_internal is not None:
+        # Determinants already in the wave function are never selected again
+        external = psi_internal.index(local_best_dets) < 0
+        local_best_energies, local_best_dets = local_best_energies[external], local_best_dets[external]
+
+    # `Global' n largest magnitude E_pt2 contributions -> n unique determinants (if that many were generated)
+    global_best_energies, global_best_dets = tree_merge_top_k(
+        comm, local_best_energies, local_best_dets, n
+    )
+    if pt2_fraction is not None:
+        # n is only a cap; keep just enough determinants to capture `pt2_fraction' of the (total) E_pt2
+        global_best_dets = global_best_dets[
+            pt2_fraction_cutoff(global_best_energies, E_pt2, pt2_fraction)
+        ]
 
     # Return dets corresponding to globally `best' E_pt2 contributions
     return global_best_dets
@@ -3220,105 +4918,184 @@ def check_constraint(det: Determinant, spin="alpha"):
     return spindet[-3:]
 
 
+def constraint_connections(
+    C: Tuple[OrbitalIdx, ...], psi: Psi_det, n_orb: int, max_degree: int = 2
+) -> np.ndarray:
+    """Number of determinants singly or doubly (only singly, with max_degree = 1) connected to each
+    determinant of psi, and satisfying triplet-constraint C (an upper bound, used to estimate the
+    work, or the weight, of C)
+    :param psi: |DetArray|, or list of |Determinant|
+
+    >>> psi = [Determinant((0, 1, 2), (0, 1, 2)), Determinant((0, 1, 3), (0, 1, 2))]
+    >>> constraint_connections((1, 2, 3), psi, 5)
+    array([7, 7], dtype=int32)
+    >>> constraint_connections((1, 2, 3), psi, 5, max_degree=1)
+    array([1, 1], dtype=int32)
+    """
+    if not isinstance(psi, DetArray):
+        psi = DetArray.from_psi_det(psi, n_orb)
+    return constraint_connections_matrix([C], psi, n_orb, max_degree)[0].astype("i")
+
+
+def constraint_connections_matrix(
+    constraints: List[Tuple[OrbitalIdx, ...]], psi: DetArray, n_orb: int, max_degree: int = 2
+) -> np.ndarray:
+    """Work matrix; number of determinants singly or doubly (only singly, with max_degree = 1)
+    connected to each determinant of psi (columns), and satisfying each triplet-constraint (rows).
+    Computed with popcounts over the packed alpha bitstrings, vectorized over constraints and determinants
+
+    >>> psi = DetArray.from_psi_det([Determinant((0, 1, 2), (0, 1, 2)), Determinant((0, 1, 3), (0, 1, 2))], 5)
+    >>> constraint_connections_matrix([(0, 1, 2), (1, 2, 3), (2, 3, 4)], psi, 5)
+    array([[9, 7],
+           [7, 7],
+           [1, 1]])
+    """
+    constraints = np.array(constraints, dtype=np.int64).reshape(-1, 3)
+    n_C, n_words = len(constraints), psi.words.shape[2]
+    # Bitmasks of the constraint orbitals, and of the orbitals below (`lower') / above (`upper') min(C)
+    C_mask = np.zeros((n_C, n_words), dtype=np.uint64)
+    for o in constraints.T:
+        np.bitwise_or.at(
+            C_mask, (np.arange(n_C), o // 64), np.left_shift(np.uint64(1), (o % 64).astype(np.uint64))
+        )
+    c_min = constraints.min(axis=1)
+    # Number of lower orbitals in each word, as a shift in [0, 64]
+    n_lower = np.clip(c_min[:, None] - 64 * np.arange(n_words)[None, :], 0, 64).astype(np.uint64)
+    # (1 << 64) overflows, so build the full words separately
+    lower_mask = np.where(
+        n_lower == 64,
+        np.uint64(0xFFFFFFFFFFFFFFFF),
+        np.left_shift(np.uint64(1), n_lower % np.uint64(64)) - np.uint64(1),
+    )
+    min_bit = np.zeros((n_C, n_words), dtype=np.uint64)
+    np.bitwise_or.at(
+        min_bit, (np.arange(n_C), c_min // 64), np.left_shift(np.uint64(1), (c_min % 64).astype(np.uint64))
+    )
+    upper_mask = ~(lower_mask | min_bit)
+
+    alpha = psi.words[None, :, psi.spin_index["alpha"], :]
+
+    def count(mask):
+        # Number of occupied alpha orbitals among mask, shape (n_C, N)
+        return DetArray.popcount(alpha & mask[:, None, :]).sum(axis=-1, dtype=np.int64)
+
+    n_constraint = count(C_mask)  # Occupied constraint orbitals
+    n_upper = count(upper_mask & ~C_mask)  # Occupied non-constraint orbitals above min(C)
+    occ_lower = count(lower_mask)  # Occupied lower orbitals
+    unocc_lower = c_min[:, None] - occ_lower  # Unoccupied lower orbitals
+    nb = DetArray.popcount(psi.words[:, psi.spin_index["beta"], :]).sum(axis=-1, dtype=np.int64)
+    nb = np.broadcast_to(nb[None, :], n_constraint.shape)
+    zero, one = np.zeros_like(n_constraint), np.ones_like(n_constraint)
+
+    # n_particles = [np_a, np_b, np_aa, np_bb, np_ab]
+    # Number of particles (or pairs) that (could possibly) involve an excitation satisfying C
+    #   0 constraint orbitals occupied: no excitation satisfies C
+    #   1: excitation must be aa (into the empty constraint orbitals)
+    #   2: a single must excite into the empty constraint orbital; no bb, ab into it
+    #   3: any a or aa excitation into lower unoccupied alpha orbitals, any b or bb excitation
+    nv = n_orb - nb
+    n_particles = np.select(
+        [n_constraint[None] == k for k in (1, 2, 3)],
+        [
+            np.stack([zero, zero, one, zero, zero]),
+            np.stack([one, zero, unocc_lower, zero, nv]),
+            np.stack(
+                [unocc_lower, nv, unocc_lower * (unocc_lower - 1) // 2, nv * (nv - 1) // 2, nv * unocc_lower]
+            ),
+        ],
+        0,
+    )
+    # n_holes = [nh_a, nh_b, nh_aa, nh_bb, nh_ab]
+    # Number of holes (or pairs) that (could possibly) involve an excitation satisfying C
+    #   >2 non-constraint orbitals occupied above min(C): no excitation satisfies C
+    #   2: excitation must be aa (out of the higher non-constraint orbitals)
+    #   1: a single must excite out of the higher non-constraint orbital; no bb, ab out of it
+    #   0: excitations out of any lower occupied alpha orbitals, any b or bb excitation
+    n_holes = np.select(
+        [n_upper[None] == k for k in (2, 1, 0)],
+        [
+            np.stack([zero, zero, one, zero, zero]),
+            np.stack([one, zero, occ_lower, zero, nb]),
+            np.stack([occ_lower, nb, occ_lower * (occ_lower - 1) // 2, nb * (nb - 1) // 2, occ_lower * nb]),
+        ],
+        0,
+    )
+    # Number of singly/doubly connected determinants satisfying C
+    #   Simply (per spin type) number of holes * particles that will yield an excitation in C
+    #   Singles are the first two kinds
+    k = slice(None) if max_degree == 2 else slice(0, 2)
+    return np.einsum("kcn,kcn->cn", n_particles[k], n_holes[k])
+
+
 def dispatch_local_constraints(
-    comm: MPI.COMM_WORLD, psi: Psi_det, n_orb: int
+    comm: MPI.COMM_WORLD,
+    psi: Psi_det,
+    n_orb: int,
+    runtimes: Dict[Tuple[OrbitalIdx, ...], Tuple[float, int]] = None,
+    screen: Callable[[Tuple[OrbitalIdx, ...]], bool] = None,
 ) -> List[Tuple[OrbitalIdx, ...]]:
     """MPI function, perform static load balancing + distribution of triplet-constraints to MPI ranks
-    Work is roughly distributed based on the number of connected determinants satisfying a particular constraint
+    Work is roughly distributed based on the number of connected determinants satisfying a particular constraint,
+    with a largest-processing-time-first (LPT) schedule
 
     Inputs:
-    :param psi: List of internal determinants (global)
+    :param psi: |DetArray|, or list of internal determinants (global)
+    :param runtimes: Constraint -> (measured runtime, estimated work) of a previous CIPSI iteration;
+                     scales the estimated work of each constraint by its measured time per unit of work
+    :param screen: Constraints for which it returns True are dropped before the load balancing
+                   (each constraint with some work is tested once, by a single rank)
 
     Outputs:
     :param C_loc: Local constraints"""
 
-    rank = comm.Get_rank()
-    # Initialize array to track workload of each rank
-    W = np.zeros(shape=(comm.Get_size(),), dtype="i")
-    C_loc = []  # Pre-allocate space for local constraints
-    na = getattr(psi[0], "alpha").popcnt()  # No. of alpha electrons
-    nb = getattr(psi[0], "beta").popcnt()  # No. of beta electrons
-    # Pass through all triplet constraints to distribute
-    H = []  # Track work dist.
-    for C in generate_all_constraints(na, n_orb):
-        B_upper = tuple(range(min(C) + 1, n_orb))  # Upper bitmask
-        B_lower = tuple(range(min(C)))  # Lower bitmask
-        h = 0  # Track work of this constraint
-        for det in psi:
-            det_a = getattr(det, "alpha")
-            constraint_orbitals_occupied = det_a & C
-            # Operations below is equivalent to `det_a & B_upper - C`
-            nonconstrained_orbitals_occupied = (det_a & B_upper).get_holes(C)
-            # n_particles = [np_a, np_b, np_aa, np_bb, np_ab]
-            # Number of particles (or pairs) that (could possibly) involve an excitation satisfying C
-            if constraint_orbitals_occupied.popcnt() == 0:
-                # No excitations will satisfy C -> Pass
-                n_particles = np.zeros(5, dtype="i")
-            elif constraint_orbitals_occupied.popcnt() == 1:
-                # To satisfy C, excitation must be aa (into empty constraint orbitals)
-                n_particles = np.array([0, 0, 1, 0, 0], dtype="i")
-            elif constraint_orbitals_occupied.popcnt() == 2:
-                # To satisfy C, only possible single is a, must excite into empty constraint orbital
-                # Operations below is equivalent to `B_lower - det_a` in set operations
-                na_orbs_unocc_lower = det_a.get_particles(B_lower)
-                # No bb; for ab doubles, a must excite into empty constraint orbital, so 1 * (self.n_orb - nb) ab pairs
-                n_particles = np.array(
-                    [1, 0, na_orbs_unocc_lower.popcnt(), 0, (n_orb - nb)], dtype="i"
-                )
-            elif constraint_orbitals_occupied.popcnt() == 3:
-                # To satisfy C, any a or aa excitaion into `lower` unoccupied alpha orbitals
-                # All possible b or bb excitations satisfy C
-                # Operations below is equivalent to `B_lower - det_a` in set operations
-                na_orbs_unocc_lower = det_a.get_particles(B_lower)
-                # Divide some things by 2 to avoid repeats due to permuation (e.g., (p1, p2) = (1, 2) <-> (p1, p2) = (2, 1))
-                n_particles = np.array(
-                    [
-                        na_orbs_unocc_lower.popcnt(),
-                        n_orb - nb,
-                        na_orbs_unocc_lower.popcnt() * (na_orbs_unocc_lower.popcnt() - 1) / 2,
-                        (n_orb - nb) * (n_orb - nb - 1) / 2,
-                        (n_orb - nb) * na_orbs_unocc_lower.popcnt(),
-                    ],
-                    dtype="i",
-                )
-
-            # n_holes = [nh_a, nh_b, nh_aa, nh_bb, nh_ab]
-            # Number of holes (or pairs) that (could possibly) involve an excitation satisfying C
-            if nonconstrained_orbitals_occupied.popcnt() > 2:
-                # No excitations will satisfy C -> Pass
-                n_holes = np.zeros(5, dtype="i")
-            elif nonconstrained_orbitals_occupied.popcnt() == 2:
-                # To satisfy C, excitation must be aa (out of `higher` non-constraint orbitals)
-                n_holes = np.array([0, 0, 1, 0, 0], dtype="i")
-            elif nonconstrained_orbitals_occupied.popcnt() == 1:
-                # To satisfy C, only possible single is a, must excite out of `higher` constraint orbitals
-                na_orbs_occ_lower = det_a & B_lower
-                # No bb; for ab doubles, a must excite out of `higher` constraint orbital, so 1 * nb ab pairs
-                n_holes = [1, 0, na_orbs_occ_lower.popcnt(), 0, nb]
-            elif nonconstrained_orbitals_occupied.popcnt() == 0:
-                # To satisfy C, can excite out of any `lower` occupied alpha orbitals
-                # All possible b or bb excitations satisfy C
-                na_orbs_occ_lower = det_a & B_lower
-                n_holes = [
-                    na_orbs_occ_lower.popcnt(),
-                    nb,
-                    na_orbs_occ_lower.popcnt() * (na_orbs_occ_lower.popcnt() - 1) / 2,
-                    nb * (nb - 1) / 2,
-                    na_orbs_occ_lower.popcnt() * nb,
-                ]
-
-            # Number of singly/doubly connected determinants to |det> satisfying constraint C
-            #   Simply (per spin type) number of holes * particles that will yield an excitation in C
-            h += np.dot(n_particles, n_holes)  # Add to work thus far
-
-        if h:  # Handle case where no dets satisfy C.. No one will do it
-            _, loc = comm.allreduce(
-                (W[rank], rank), MPI.MINLOC
-            )  # This is a tuple, so use python command
-            if loc == rank:  # Rank with lowest amount of work collects current constraint
-                C_loc.append(C)
-                H.append(h)
-                W[rank] += h  # Add h to the amount of `work` rank has
+    if not isinstance(psi, DetArray):
+        psi = DetArray.from_psi_det(psi, n_orb)
+    rank, size = comm.Get_rank(), comm.Get_size()
+    na = int(DetArray.popcount(psi.words[0, psi.spin_index["alpha"]]).sum())  # No. of alpha electrons
+    constraints = generate_all_constraints(na, n_orb)
+    # Each rank computes the work of a contiguous slice of the constraints,
+    # by chunks of the (constraints x determinants) work matrix to bound the memory
+    H_local = np.zeros(len(constraints), dtype=np.int64)
+    lo, hi = len(constraints) * rank // size, len(constraints) * (rank + 1) // size
+    chunk = max(1, 2**20 // max(1, len(psi)))
+    for start in range(lo, hi, chunk):
+        stop = min(hi, start + chunk)
+        H_local[start:stop] = constraint_connections_matrix(constraints[start:stop], psi, n_orb).sum(axis=1)
+    if screen is not None:
+        for k in lo + np.flatnonzero(H_local[lo:hi]):
+            if screen(constraints[k]):
+                H_local[k] = 0
+    # A single collective gives the work of every constraint to every rank
+    H_all = np.zeros(len(constraints), dtype=np.int64)
+    comm.Allreduce([H_local, MPI.INT64_T], [H_all, MPI.INT64_T])
+
+    # Cost model; estimated work, times the time per unit of work measured on the previous iteration
+    # (the average one for constraints that were not timed)
+    cost = H_all.astype("float")
+    if runtimes:
+        index = {C: k for k, C in enumerate(constraints)}
+        timed = [(index[C], t, h) for C, (t, h) in runtimes.items() if C in index and h > 0]
+        if timed and sum(t for _, t, _ in timed) > 0:
+            k, t, h = (np.array(x) for x in zip(*timed))
+            mean_rate = t.sum() / h.sum()
+            rate = np.full(len(constraints), mean_rate)
+            rate[k] = np.maximum(t / h, 1e-3 * mean_rate)
+            cost *= rate
+
+    # LPT: same greedy assignment on every rank, passing through constraints by decreasing cost;
+    # the rank with lowest amount of work (lowest rank on ties) collects the current one.
+    # Constraints no det satisfies are dropped
+    W = [(0.0, r) for r in range(size)]  # Heap of (amount of work, rank)
+    local = []
+    nonzero = np.flatnonzero(H_all)
+    for k in nonzero[np.argsort(-cost[nonzero], kind="stable")]:
+        w, loc = heapq.heappop(W)
+        if loc == rank:
+            local.append(k)
+        heapq.heappush(W, (w + cost[k], loc))
+    local.sort()  # Process in generation order
+    C_loc = [constraints[k] for k in local]  # Local constraints
+    H = [int(H_all[k]) for k in local]  # Track work dist.
 
     # Return local constraints and distribution of work
     return C_loc, H
@@ -3,6 +3,8 @@ from __future__ import annotations
 
 from typing import Tuple, Dict, List, NewType, Iterator
 from itertools import chain, product, combinations, takewhile
+from functools import cached_property
+import numpy as np
 
 # Orbital index (0,1,2,...,n_orb-1)
 OrbitalIdx = NewType("OrbitalIdx", int)
@@ -1085,6 +1087,212 @@ class Determinant:
         return h1, h2, p1, p2
 
 
+#    _
+#   | \  _ _|_    /\  ._ ._ _.
+#   |_/ (/_ |_   /--\ |  | (_| \/
+#                              /
+
+
+class DetArray:
+    """Batch of |Determinant| packed as occupation number (ON) bitstrings in a numpy array of shape
+    (N, 2, n_words) and dtype uint64. Orbital o of |Determinant| I is occupied in spin s (0 for alpha,
+    1 for beta) if bit (o % 64) of words[I, s, o // 64] is set; same convention as |Spin_determinant_bitstring|.
+    Indexing with an integer returns a |Determinant|, indexing with a slice or an array returns a |DetArray|.
+
+    >>> psi = DetArray.from_psi_det([Determinant((0, 1), (0, 2)), Determinant((0, 3), (1, 2))], 4)
+    >>> psi
+    DetArray([Determinant(alpha=(0, 1), beta=(0, 2)), Determinant(alpha=(0, 3), beta=(1, 2))], n_orb=4)
+    >>> psi.words[:, :, 0]
+    array([[3, 5],
+           [9, 6]], dtype=uint64)
+    >>> psi[1]
+    Determinant(alpha=(0, 3), beta=(1, 2))
+    >>> psi[[1]]
+    DetArray([Determinant(alpha=(0, 3), beta=(1, 2))], n_orb=4)
+    """
+
+    spin_index = {"alpha": 0, "beta": 1}
+
+    def __init__(self, words: np.ndarray, n_orb: int):
+        self.words = words
+        self.n_orb = n_orb
+
+    @staticmethod
+    def n_words(n_orb: int) -> int:
+        """Number of 64-bit words needed to store a |Spin_determinant| of n_orb orbitals
+        >>> DetArray.n_words(28), DetArray.n_words(64), DetArray.n_words(65)
+        (1, 1, 2)
+        """
+        return max(1, -(-n_orb // 64))
+
+    @staticmethod
+    def mask(orbitals: Tuple[OrbitalIdx, ...], n_orb: int) -> np.ndarray:
+        """Create bitmask (as n_words uint64 words) with bits of `orbitals' set to 1
+        >>> DetArray.mask((0, 1, 7, 8), 10)
+        array([387], dtype=uint64)
+        >>> DetArray.mask((0, 64), 70)
+        array([1, 1], dtype=uint64)
+        """
+        mask = 0
+        for o in orbitals:
+            mask |= 1 << o
+        return DetArray.bitstring_to_words(mask, n_orb)
+
+    @staticmethod
+    def between_mask(h: OrbitalIdx, p: OrbitalIdx, n_orb: int) -> np.ndarray:
+        """Create bitmask (as n_words uint64 words) with bits of orbitals strictly between h and p set to 1
+        >>> DetArray.between_mask(1, 5, 10)
+        array([28], dtype=uint64)
+        >>> DetArray.between_mask(65, 62, 70)
+        array([9223372036854775808, 1], dtype=uint64)
+        """
+        lo, hi = min(h, p), max(h, p)
+        return DetArray.bitstring_to_words(((1 << hi) - 1) ^ ((1 << (lo + 1)) - 1), n_orb)
+
+    @staticmethod
+    def bitstring_to_words(bitstring: int, n_orb: int) -> np.ndarray:
+        """Split an arbitrary-precision integer bitstring into n_words uint64 words
+        >>> DetArray.bitstring_to_words(2**64 + 3, 70)
+        array([3, 1], dtype=uint64)
+        """
+        return np.array(
+            [(bitstring >> (64 * w)) & 0xFFFFFFFFFFFFFFFF for w in range(DetArray.n_words(n_orb))],
+            dtype=np.uint64,
+        )
+
+    @staticmethod
+    def popcount(words: np.ndarray) -> np.ndarray:
+        """Number of bits set in each uint64 word
+        >>> DetArray.popcount(np.array([0, 7, 2**63], dtype=np.uint64))
+        array([0, 3, 1], dtype=uint8)
+        """
+        if hasattr(np, "bitwise_count"):  # numpy >= 2.0
+            return np.bitwise_count(words)
+        bits = np.unpackbits(words.astype("<u8").view(np.uint8).reshape(*words.shape, 8), axis=-1)
+        return bits.sum(axis=-1, dtype=np.uint8)
+
+    def count_occupied(self, mask: np.ndarray, spin: str) -> np.ndarray:
+        """Number of occupied `spin' orbitals among the bits set in mask, for each |Determinant|
+        >>> psi = DetArray.from_psi_det([Determinant((0, 1, 4), ()), Determinant((0, 2, 3), ())], 5)
+        >>> psi.count_occupied(DetArray.between_mask(0, 4, 5), "alpha")
+        array([1, 2], dtype=uint64)
+        """
+        return self.popcount(self.words[:, self.spin_index[spin]] & mask).sum(axis=-1, dtype=np.uint64)
+
+    @classmethod
+    def from_psi_det(cls, psi_det: Psi_det, n_orb: int) -> DetArray:
+        """Pack a list of |Determinant|"""
+        words = np.zeros((len(psi_det), 2, cls.n_words(n_orb)), dtype=np.uint64)
+        I, s, o = [], [], []
+        for i, det in enumerate(psi_det):
+            for spin, sdet in enumerate(det):
+                I.extend([i] * len(sdet))
+                s.extend([spin] * len(sdet))
+                o.extend(sdet)
+        o = np.array(o, dtype=np.uint64)
+        np.bitwise_or.at(
+            words,
+            (np.array(I, dtype=np.int64), np.array(s, dtype=np.int64), (o // 64).astype(np.int64)),
+            np.left_shift(np.uint64(1), o % np.uint64(64)),
+        )
+        return cls(words, n_orb)
+
+    @property
+    def occupation(self) -> np.ndarray:
+        """Occupation numbers, as a boolean array of shape (N, 2, n_orb)
+        >>> DetArray.from_psi_det([Determinant((0, 2), (1,))], 3).occupation.astype(int)
+        array([[[1, 0, 1],
+                [0, 1, 0]]])
+        """
+        bits = np.unpackbits(self.words.astype("<u8").view(np.uint8), axis=-1, bitorder="little")
+        return bits[..., : self.n_orb].astype(bool)
+
+    def to_psi_det(self) -> Psi_det:
+        """Unpack to a list of |Determinant|"""
+        return [
+            Determinant(tuple(np.flatnonzero(a).tolist()), tuple(np.flatnonzero(b).tolist()))
+            for a, b in self.occupation
+        ]
+
+    def __len__(self):
+        return len(self.words)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return DetArray(self.words[key : key + 1 or None], self.n_orb).to_psi_det()[0]
+        return DetArray(self.words[key], self.n_orb)
+
+    def __iter__(self):
+        return iter(self.to_psi_det())
+
+    def __repr__(self):
+        return f"DetArray({self.to_psi_det()!r}, n_orb={self.n_orb})"
+
+    @property
+    def keys(self) -> np.ndarray:
+        """One opaque key per |Determinant| (raw bytes of its words, as a numpy void scalar).
+        Keys can be compared, sorted and searched by numpy, and hashed via `tobytes()'
+        >>> psi = DetArray.from_psi_det([Determinant((0, 1), (0, 2)), Determinant((0, 1), (0, 2))], 4)
+        >>> len(np.unique(psi.keys))
+        1
+        """
+        n_bytes = self.words.shape[1] * self.words.shape[2] * 8
+        words = np.ascontiguousarray(self.words).reshape(len(self), n_bytes // 8)
+        return words.view(np.dtype((np.void, n_bytes)))[:, 0]
+
+    @cached_property
+    def sorted_keys(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Sorted keys, and the permutation that sorts them; used for lookups"""
+        keys = self.keys
+        order = np.argsort(keys, kind="stable")
+        return keys[order], order
+
+    def index(self, other: DetArray) -> np.ndarray:
+        """Return the index in self of each |Determinant| of `other', -1 if absent
+        >>> psi = DetArray.from_psi_det([Determinant((0, 1), (0, 2)), Determinant((0, 3), (1, 2))], 4)
+        >>> psi.index(DetArray.from_psi_det([Determinant((0, 3), (1, 2)), Determinant((0, 3), (1, 3))], 4))
+        array([ 1, -1])
+        """
+        if other.words.shape[2] != self.words.shape[2]:
+            raise ValueError("DetArrays with a different number of words cannot be compared")
+        if len(self) == 0:
+            return np.full(len(other), -1, dtype=np.int64)
+        sorted_keys, order = self.sorted_keys
+        other_keys = other.keys
+        pos = np.minimum(np.searchsorted(sorted_keys, other_keys), len(self) - 1)
+        return np.where(sorted_keys[pos] == other_keys, order[pos], -1)
+
+    def __contains__(self, det: Determinant) -> bool:
+        return self.index(DetArray.from_psi_det([det], self.n_orb))[0] >= 0
+
+    def accumulate(self, values: np.ndarray, return_index: bool = False):
+        """Sum `values' belonging to the same |Determinant| (sort-and-accumulate, [Tubman et al., `18]).
+        Keys are sorted, and contiguous runs of equal keys are reduced; return the unique determinants
+        (in key order) and the associated sums. If `return_index', also return the index in self of
+        one occurrence of each unique determinant (as `np.unique')
+        >>> psi = DetArray.from_psi_det([Determinant((0, 1), (0, 2)), Determinant((0, 3), (1, 2)),
+        ...                              Determinant((0, 1), (0, 2))], 4)
+        >>> unique, sums = psi.accumulate(np.array([1.0, 2.0, 4.0]))
+        >>> unique
+        DetArray([Determinant(alpha=(0, 1), beta=(0, 2)), Determinant(alpha=(0, 3), beta=(1, 2))], n_orb=4)
+        >>> sums
+        array([5., 2.])
+        >>> psi.accumulate(np.array([1.0, 2.0, 4.0]), return_index=True)[2]
+        array([0, 1])
+        """
+        values = np.asarray(values)
+        if len(self) == 0:
+            index = np.zeros(0, dtype=np.int64)
+            return (self, values[:0], index) if return_index else (self, values[:0])
+        keys = self.keys
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+        index = order[starts]
+        unique, sums = DetArray(self.words[index], self.n_orb), np.add.reduceat(values[order], starts)
+        return (unique, sums, index) if return_index else (unique, sums)
+
+
 Psi_det = List[Determinant]
 Psi_coef = List[float]
 # We have two type of energy.
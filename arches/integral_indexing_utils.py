@@ -1,5 +1,6 @@
 # ruff : noqa : E741
 import math
+import numpy as np
 from ctypes import CDLL, Structure
 from ctypes import c_longlong as idx_t
 from arches.func_decorators import return_tuple, offload
@@ -142,6 +143,27 @@ def compound_idx4(i, j, k, l):
     return compound_idx2(compound_idx2(i, k), compound_idx2(j, l))
 
 
+def compound_idx2_batch(i, j):
+    """
+    compound_idx2 of arrays of indices, element-wise
+    >>> compound_idx2_batch(np.array([0, 1, 1, 2]), np.array([1, 0, 2, 1]))
+    array([1, 1, 4, 4])
+    """
+    i, j = np.asarray(i, dtype=np.int64), np.asarray(j, dtype=np.int64)
+    p, q = np.minimum(i, j), np.maximum(i, j)
+    return (q * (q + 1)) // 2 + p
+
+
+def compound_idx4_batch(i, j, k, l):
+    """
+    compound_idx4 of arrays of indices, element-wise
+    >>> i, j, k, l = np.array([[0, 1, 0, 0], [1, 0, 1, 0], [1, 0, 1, 1]]).T
+    >>> compound_idx4_batch(i, j, k, l)
+    array([1, 3, 4])
+    """
+    return compound_idx2_batch(compound_idx2_batch(i, k), compound_idx2_batch(j, l))
+
+
 @offload(return_tuple(iu_lib.compound_idx2_reverse))
 def compound_idx2_reverse(ij):
     """
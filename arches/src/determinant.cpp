@@ -1,13 +1,17 @@
 #if !defined(DOCTEST_CONFIG_DISABLE)
 #define DOCTEST_CONFIG_IMPLEMENT_WITH_MAIN
 #endif
+#include <algorithm>
+#include <bloom_filter.h>
+#include <cstring>
 #include <determinant.h>
 #include <doctest/doctest.h>
 
 int compute_phase_single_excitation(spin_det_t d, uint64_t h, uint64_t p) {
     const auto &[i, j] = std::minmax(h, p);
     spin_det_t hpmask(d.size());
-    hpmask.set(i + 1, j - i - 1, 1);
+    if (j > i + 1)
+        hpmask.set(i + 1, j - i - 1, 1);
     const bool parity = (hpmask & d).count() % 2;
     return parity ? -1 : 1;
 }
@@ -19,8 +23,8 @@ TEST_CASE("testing get_phase_single") {
     CHECK(compute_phase_single_excitation(spin_det_t{"00100"}, 2, 4) == 1);
 }
 
-int compute_phase_double_excitation(spin_det_t d, uint64_t h1, uint64_t h2, uint_64_t p1,
-                                    uint_64_t p2) {
+int compute_phase_double_excitation(spin_det_t d, uint64_t h1, uint64_t h2, uint64_t p1,
+                                    uint64_t p2) {
     // Single spin channel excitations, i.e., (2,0) or (0,2)
     int phase =
         compute_phase_single_excitation(d, h1, p1) * compute_phase_single_excitation(d, h2, p2);
@@ -29,7 +33,7 @@ int compute_phase_double_excitation(spin_det_t d, uint64_t h1, uint64_t h2, uint
     return phase;
 }
 
-int compute_phase_double_excitation(det_t d, uint64_t h1, uint64_t h2, uint_64_t p1, uint_64_t p2) {
+int compute_phase_double_excitation(det_t d, uint64_t h1, uint64_t h2, uint64_t p1, uint64_t p2) {
 
     // Cross channel excitations, i.e., (1,1)
     // Assumes alpha are h1-p1, beta are h2-p2
@@ -54,7 +58,7 @@ det_t apply_single_excitation(det_t s, int spin, uint64_t h, uint64_t p) {
     return s2;
 }
 
-spin_det_t apply_single_excitation(spin_det_t s, int spin, uint64_t h, uint64_t p) {
+spin_det_t apply_spin_single_excitation(spin_det_t s, uint64_t h, uint64_t p) {
     assert(s[h] == 1);
     assert(s[p] == 0);
 
@@ -70,8 +74,8 @@ TEST_CASE("testing apply_single_excitation") {
     CHECK(apply_single_excitation(s, 1, 0, 1) == det_t{spin_det_t{"11000"}, spin_det_t{"00010"}});
 }
 
-det_t apply_double_excitation(det_t s, std::pair<int> spin, uint64_t h1, uint64_t h2, uint64_t p1,
-                              uint64_t p2) {
+det_t apply_double_excitation(det_t s, std::pair<int, int> spin, uint64_t h1, uint64_t h2,
+                              uint64_t p1, uint64_t p2) {
     // Check if valid
     assert(s[spin.first][h1] == 1);
     assert(s[spin.second][h2] == 1);
@@ -79,20 +83,20 @@ det_t apply_double_excitation(det_t s, std::pair<int> spin, uint64_t h1, uint64_
     assert(s[spin.second][p2] == 0);
 
     auto s2 = det_t{s};
-    s[spin.first][h1] = 0;
-    s[spin.second][h2] = 0;
-    s[spin.first][p1] = 1;
-    s[spin.second][p2] = 1;
+    s2[spin.first][h1] = 0;
+    s2[spin.second][h2] = 0;
+    s2[spin.first][p1] = 1;
+    s2[spin.second][p2] = 1;
     return s2;
 }
 
 TEST_CASE("testing apply_double_excitation") {
     det_t s{spin_det_t{"11000000"}, spin_det_t{"10001000"}};
-    CHECK(apply_double_excitation(s, std::pair<int>{0, 0}, 0, 1, 4, 5) ==
+    CHECK(apply_double_excitation(s, std::pair<int, int>{0, 0}, 7, 6, 3, 2) ==
           det_t(spin_det_t{"00001100"}, spin_det_t{"10001000"}));
-    CHECK(apply_double_excitation(s, std::pair<int>{1, 1}, 0, 4, 1, 7) ==
+    CHECK(apply_double_excitation(s, std::pair<int, int>{1, 1}, 7, 3, 6, 0) ==
           det_t(spin_det_t{"11000000"}, spin_det_t{"01000001"}));
-    CHECK(apply_double_excitation(s, std::pair<int>{0, 1}, 1, 0, 2, 2) ==
+    CHECK(apply_double_excitation(s, std::pair<int, int>{0, 1}, 6, 7, 5, 5) ==
           det_t(spin_det_t{"10100000"}, spin_det_t{"00101000"}));
 }
 
@@ -123,12 +127,12 @@ std::vector<det_t> get_ss_doubles_by_exc_mask(det_t d, int spin, spin_constraint
 
     std::vector<det_t> res;
     // h, p are sorted so h1 < h2; p1 < p2 always
-    for (auto h1 = 0; h1 < h.size() - 1; h1++) {
-        for (auto h2 = h1 + 1; h2 < h.size(); h2++) {
-            for (auto p1 = 0; p1 < p.size() - 1; p1++) {
-                for (auto p2 = p1 + 1; p2 < p.size(); p2++) {
-                    res.push_back(
-                        apply_double_excitation(d, std::pair<int>(spin, spin), h1, h2, p1, p2));
+    for (size_t h1 = 0; h1 < h.size(); h1++) {
+        for (size_t h2 = h1 + 1; h2 < h.size(); h2++) {
+            for (size_t p1 = 0; p1 < p.size(); p1++) {
+                for (size_t p2 = p1 + 1; p2 < p.size(); p2++) {
+                    res.push_back(apply_double_excitation(d, std::pair<int, int>(spin, spin), h[h1],
+                                                          h[h2], p[p1], p[p2]));
                 }
             }
         }
@@ -151,11 +155,11 @@ std::vector<det_t> get_constrained_singles(det_t d, exc_constraint_t constraint,
     spin_det_t max_orb_mask(std::string(max_orb, '1'));
 
     // apply bit masks and get final list
-    spin_constraint_t alpha_holes = to_constraint((~d[0] & hole_mask) & max_orb_mask);
-    spin_constraint_t alpha_parts = to_constraint((d[0] & part_mask) & max_orb_mask);
+    spin_constraint_t alpha_holes = to_constraint((d[0] & hole_mask) & max_orb_mask);
+    spin_constraint_t alpha_parts = to_constraint((~d[0] & part_mask) & max_orb_mask);
 
-    spin_constraint_t beta_holes = to_constraint((~d[1] & hole_mask) & max_orb_mask);
-    spin_constraint_t beta_parts = to_constraint((d[1] & part_mask) & max_orb_mask);
+    spin_constraint_t beta_holes = to_constraint((d[1] & hole_mask) & max_orb_mask);
+    spin_constraint_t beta_parts = to_constraint((~d[1] & part_mask) & max_orb_mask);
 
     // at this point, hole and particle bitsets are guaranteed to be disjoint
     // iterate over product list and add to return vector
@@ -171,9 +175,9 @@ std::vector<det_t> get_all_singles(det_t d) {
 
     std::vector<det_t> singles;
     std::vector<det_t> alpha_singles =
-        get_singles_by_exc_mask(d, 0, to_constraint(~d[0]), to_constraint(d[0]));
+        get_singles_by_exc_mask(d, 0, to_constraint(d[0]), to_constraint(~d[0]));
     std::vector<det_t> beta_singles =
-        get_singles_by_exc_mask(d, 1, to_constraint(~d[1]), to_constraint(d[1]));
+        get_singles_by_exc_mask(d, 1, to_constraint(d[1]), to_constraint(~d[1]));
     singles.insert(singles.end(), alpha_singles.begin(), alpha_singles.end());
     singles.insert(singles.end(), beta_singles.begin(), beta_singles.end());
 
@@ -197,17 +201,17 @@ std::vector<det_t> get_constrained_os_doubles(det_t d, exc_constraint_t constrai
     spin_det_t max_orb_mask(std::string(max_orb, '1'));
 
     // apply bit masks and get final list
-    spin_constraint_t alpha_holes = to_constraint((~d[0] & hole_mask) & max_orb_mask);
-    spin_constraint_t alpha_parts = to_constraint((d[0] & part_mask) & max_orb_mask);
+    spin_constraint_t alpha_holes = to_constraint((d[0] & hole_mask) & max_orb_mask);
+    spin_constraint_t alpha_parts = to_constraint((~d[0] & part_mask) & max_orb_mask);
 
-    spin_constraint_t beta_holes = to_constraint((~d[1] & hole_mask) & max_orb_mask);
-    spin_constraint_t beta_parts = to_constraint((d[1] & part_mask) & max_orb_mask);
+    spin_constraint_t beta_holes = to_constraint((d[1] & hole_mask) & max_orb_mask);
+    spin_constraint_t beta_parts = to_constraint((~d[1] & part_mask) & max_orb_mask);
 
     // get all singles and iterate over product of (1,0) X (0,1) to get (1,1)
     std::vector<spin_det_t> alpha_singles =
-        get_spin_singles_by_exc_mask(d, 0, alpha_holes, alpha_parts);
+        get_spin_singles_by_exc_mask(d[0], alpha_holes, alpha_parts);
     std::vector<spin_det_t> beta_singles =
-        get_spin_singles_by_exc_mask(d, 1, beta_holes, beta_parts);
+        get_spin_singles_by_exc_mask(d[1], beta_holes, beta_parts);
 
     for (auto &a : alpha_singles) {
         for (auto &b : beta_singles) {
@@ -234,11 +238,11 @@ std::vector<det_t> get_constrained_ss_doubles(det_t d, exc_constraint_t constrai
     spin_det_t max_orb_mask(std::string(max_orb, '1'));
 
     // apply bit masks and get final list
-    spin_constraint_t alpha_holes = to_constraint((~d[0] & hole_mask) & max_orb_mask);
-    spin_constraint_t alpha_parts = to_constraint((d[0] & part_mask) & max_orb_mask);
+    spin_constraint_t alpha_holes = to_constraint((d[0] & hole_mask) & max_orb_mask);
+    spin_constraint_t alpha_parts = to_constraint((~d[0] & part_mask) & max_orb_mask);
 
-    spin_constraint_t beta_holes = to_constraint((~d[1] & hole_mask) & max_orb_mask);
-    spin_constraint_t beta_parts = to_constraint((d[1] & part_mask) & max_orb_mask);
+    spin_constraint_t beta_holes = to_constraint((d[1] & hole_mask) & max_orb_mask);
+    spin_constraint_t beta_parts = to_constraint((~d[1] & part_mask) & max_orb_mask);
 
     // at this point, hole and particle bitsets are guaranteed to be disjoint
     // iterate over product list and add to return vector
@@ -249,4 +253,211 @@ std::vector<det_t> get_constrained_ss_doubles(det_t d, exc_constraint_t constrai
     ss_doubles.insert(ss_doubles.end(), beta_ss_doubles.begin(), beta_ss_doubles.end());
 
     return ss_doubles;
-}
\ No newline at end of file
+}
+
+std::vector<det_t> get_constrained_determinants(det_t d, exc_constraint_t constraint,
+                                                uint64_t max_orb) {
+    std::vector<det_t> res = get_constrained_singles(d, constraint, max_orb);
+    for (const auto &doubles : {get_constrained_ss_doubles(d, constraint, max_orb),
+                                get_constrained_os_doubles(d, constraint, max_orb)})
+        res.insert(res.end(), doubles.begin(), doubles.end());
+    return res;
+}
+
+TEST_CASE("testing get_constrained_determinants") {
+    // Holes in orbitals {0, 1}, particles in orbitals {2, 3}
+    det_t d{spin_det_t{"0011"}, spin_det_t{"0001"}};
+    const exc_constraint_t constraint{{0, 1}, {2, 3}};
+    CHECK(get_constrained_singles(d, constraint, 4).size() == 2 * 2 + 1 * 2);
+    CHECK(get_constrained_ss_doubles(d, constraint, 4).size() == 1);
+    CHECK(get_constrained_os_doubles(d, constraint, 4).size() == 2 * 2 * 1 * 2);
+    CHECK(get_constrained_determinants(d, constraint, 4).size() == 6 + 1 + 8);
+    CHECK(get_all_singles(d).size() == 2 * 2 + 1 * 3);
+}
+
+//  _____     _       _      _
+// |_   _| __(_)_ __ | | ___| |_
+//   | || '__| | '_ \| |/ _ \ __|
+//   | || |  | | |_) | |  __/ |_
+//   |_||_|  |_| .__/|_|\___|\__|
+//             |_|
+// Triplet-constrained excitations of packed determinants
+
+namespace {
+
+inline bool is_occupied(const word_t *sdet, const idx_t o) {
+    return (sdet[o >> 6] >> (o & 63)) & 1;
+}
+
+inline void flip(word_t *sdet, const idx_t o) { sdet[o >> 6] ^= word_t(1) << (o & 63); }
+
+// Orbitals in [lo, hi) of a packed spin determinant that are occupied (or not)
+spin_constraint_t orbitals_in(const word_t *sdet, const idx_t lo, const idx_t hi,
+                              const bool occupied) {
+    spin_constraint_t res;
+    for (idx_t o = lo; o < hi; o++)
+        if (is_occupied(sdet, o) == occupied)
+            res.push_back(o);
+    return res;
+}
+
+// All sets of `degree' (1 or 2) orbitals made of all the `forced' orbitals, completed by `free' ones
+std::vector<spin_constraint_t> completions(const spin_constraint_t &forced,
+                                           const spin_constraint_t &free, const size_t degree) {
+    std::vector<spin_constraint_t> res;
+    if (forced.size() > degree)
+        return res;
+    if (forced.size() == degree)
+        res.push_back(forced);
+    else if (forced.size() + 1 == degree)
+        for (const auto &o : free) {
+            res.push_back(forced);
+            res.back().push_back(o);
+        }
+    else
+        for (size_t i = 0; i < free.size(); i++)
+            for (size_t j = i + 1; j < free.size(); j++)
+                res.push_back({free[i], free[j]});
+    return res;
+}
+
+// Binary search of det in internal_sorted (memcmp order), after the Bloom filter prefilter
+inline bool is_internal(const word_t *det, const idx_t n_words, const word_t *internal_sorted,
+                        const idx_t n_internal, const word_t *filter, const idx_t n_bits_log2,
+                        const idx_t n_hashes) {
+    if (!n_internal || !bloom::may_contain(filter, n_bits_log2, n_hashes, det, n_words))
+        return false;
+    const size_t n_bytes = 2 * n_words * sizeof(word_t);
+    const word_t *end = internal_sorted + n_internal * 2 * n_words;
+    idx_t lo = 0, hi = n_internal;
+    while (lo < hi) {
+        const idx_t mid = lo + (hi - lo) / 2;
+        if (std::memcmp(internal_sorted + mid * 2 * n_words, det, n_bytes) < 0)
+            lo = mid + 1;
+        else
+            hi = mid;
+    }
+    const word_t *found = internal_sorted + lo * 2 * n_words;
+    return found < end && std::memcmp(found, det, n_bytes) == 0;
+}
+
+} // namespace
+
+extern "C" idx_t triplet_constrained_excitations(
+    const word_t *psi, const idx_t n, const idx_t n_words, const idx_t n_orb,
+    const idx_t *constraint, const idx_t max_degree, const word_t *internal_sorted,
+    const idx_t n_internal, const word_t *filter, const idx_t n_bits_log2, const idx_t n_hashes,
+    word_t *dets, idx_t *parents, int8_t *degrees, const idx_t capacity) {
+    // |J> satisfies C iff the alpha orbitals of |J> at or above min(C) are exactly C.
+    // From |I>, an alpha excitation has to remove the occupied orbitals above min(C) outside of C
+    // (forced holes), and fill the empty orbitals of C (forced particles); the remaining holes
+    // (particles) are occupied (empty) alpha orbitals below min(C).
+    // Beta excitations keep the alpha part, so only |I> satisfying C has beta (or no alpha) ones.
+    // With max_degree = 1, only the singles are generated.
+    const idx_t c_min = *std::min_element(constraint, constraint + 3);
+    std::vector<std::vector<word_t>> dets_I(n);
+    std::vector<std::vector<int8_t>> degrees_I(n);
+#pragma omp parallel for schedule(dynamic)
+    for (idx_t I = 0; I < n; I++) {
+        const word_t *det_I = psi + I * 2 * n_words, *alpha = det_I, *beta = det_I + n_words;
+        spin_constraint_t forced_holes, forced_particles;
+        for (idx_t o = c_min; o < n_orb; o++) {
+            const bool in_C = std::find(constraint, constraint + 3, o) != constraint + 3;
+            if (is_occupied(alpha, o) && !in_C)
+                forced_holes.push_back(o);
+            else if (!is_occupied(alpha, o) && in_C)
+                forced_particles.push_back(o);
+        }
+        if (idx_t(forced_holes.size()) > max_degree || idx_t(forced_particles.size()) > max_degree)
+            continue;
+        const auto occ_lower = orbitals_in(alpha, 0, c_min, true);
+        const auto vir_lower = orbitals_in(alpha, 0, c_min, false);
+        std::vector<spin_constraint_t> alpha_holes[2], alpha_particles[2], beta_holes[2],
+            beta_particles[2];
+        for (size_t degree = 1; degree <= 2; degree++) {
+            alpha_holes[degree - 1] = completions(forced_holes, occ_lower, degree);
+            alpha_particles[degree - 1] = completions(forced_particles, vir_lower, degree);
+            if (forced_holes.empty() && forced_particles.empty()) {
+                beta_holes[degree - 1] = completions({}, orbitals_in(beta, 0, n_orb, true), degree);
+                beta_particles[degree - 1] =
+                    completions({}, orbitals_in(beta, 0, n_orb, false), degree);
+            }
+        }
+        std::vector<word_t> det(2 * n_words);
+        auto emit = [&](const spin_constraint_t &ha, const spin_constraint_t &pa,
+                        const spin_constraint_t &hb, const spin_constraint_t &pb) {
+            std::copy(det_I, det_I + 2 * n_words, det.begin());
+            for (const auto &o : ha)
+                flip(det.data(), o);
+            for (const auto &o : pa)
+                flip(det.data(), o);
+            for (const auto &o : hb)
+                flip(det.data() + n_words, o);
+            for (const auto &o : pb)
+                flip(det.data() + n_words, o);
+            if (is_internal(det.data(), n_words, internal_sorted, n_internal, filter, n_bits_log2,
+                            n_hashes))
+                return;
+            dets_I[I].insert(dets_I[I].end(), det.begin(), det.end());
+            degrees_I[I].push_back(ha.size() + hb.size());
+        };
+        // Singles, then same-spin and opposite-spin doubles
+        for (idx_t d = 0; d < max_degree; d++) {
+            for (const auto &ha : alpha_holes[d])
+                for (const auto &pa : alpha_particles[d])
+                    emit(ha, pa, {}, {});
+            for (const auto &hb : beta_holes[d])
+                for (const auto &pb : beta_particles[d])
+                    emit({}, {}, hb, pb);
+        }
+        if (max_degree == 2 && forced_holes.size() < 2 && forced_particles.size() < 2) {
+            // Opposite-spin doubles; any beta single, with an alpha single keeping C
+            const auto hb = completions({}, orbitals_in(beta, 0, n_orb, true), 1);
+            const auto pb = completions({}, orbitals_in(beta, 0, n_orb, false), 1);
+            for (const auto &ha : alpha_holes[0])
+                for (const auto &pa : alpha_particles[0])
+                    for (const auto &h : hb)
+                        for (const auto &p : pb)
+                            emit(ha, pa, h, p);
+        }
+    }
+    idx_t n_dets = 0;
+    for (const auto &d : degrees_I)
+        n_dets += d.size();
+    if (n_dets > capacity)
+        return n_dets;
+    for (idx_t I = 0, pos = 0; I < n; I++) {
+        std::copy(dets_I[I].begin(), dets_I[I].end(), dets + pos * 2 * n_words);
+        std::copy(degrees_I[I].begin(), degrees_I[I].end(), degrees + pos);
+        std::fill(parents + pos, parents + pos + degrees_I[I].size(), I);
+        pos += degrees_I[I].size();
+    }
+    return n_dets;
+}
+
+TEST_CASE("testing triplet_constrained_excitations") {
+    // |I> = |0 1 2; 0>, 5 orbitals. Singles and doubles of |I> with (1, 2, 3) as three highest
+    // alpha orbitals: 0 -> 3 (alpha single) and 0 -> 3 with any beta single (4 opposite-spin doubles)
+    const word_t psi[2] = {0b00111, 0b00001};
+    const idx_t constraint[3] = {1, 2, 3};
+    word_t dets[2 * 5];
+    idx_t parents[5];
+    int8_t degrees[5];
+    CHECK(triplet_constrained_excitations(psi, 1, 1, 5, constraint, 2, nullptr, 0, nullptr, 0, 0,
+                                          dets, parents, degrees, 0) == 5);
+    CHECK(triplet_constrained_excitations(psi, 1, 1, 5, constraint, 2, nullptr, 0, nullptr, 0, 0,
+                                          dets, parents, degrees, 5) == 5);
+    CHECK(dets[0] == 0b01110);
+    CHECK(dets[1] == 0b00001);
+    CHECK(degrees[0] == 1);
+    CHECK(degrees[4] == 2);
+    // An internal determinant is rejected
+    const word_t internal[2] = {0b01110, 0b00001};
+    CHECK(triplet_constrained_excitations(psi, 1, 1, 5, constraint, 2, internal, 1, nullptr, 0, 0,
+                                          dets, parents, degrees, 5) == 4);
+    // Singles only
+    CHECK(triplet_constrained_excitations(psi, 1, 1, 5, constraint, 1, nullptr, 0, nullptr, 0, 0,
+                                          dets, parents, degrees, 5) == 1);
+    CHECK(dets[0] == 0b01110);
+    CHECK(degrees[0] == 1);
+}
@@ -0,0 +1,97 @@
+#include "external_space.h"
+#include "det_hash.h"
+#include <algorithm>
+#include <cstring>
+#include <tsl/hopscotch_set.h>
+#include <vector>
+
+namespace {
+
+// The hash set holds the index of each unique determinant in the contiguous storage,
+// so hash and equality look the words up there
+struct det_index_hash {
+    const std::vector<word_t> *dets;
+    idx_t n_words;
+    std::size_t operator()(const idx_t i) const noexcept {
+        return hash_words(dets->data() + i * 2 * n_words, 2 * n_words);
+    }
+};
+
+struct det_index_equal {
+    const std::vector<word_t> *dets;
+    idx_t n_words;
+    bool operator()(const idx_t i, const idx_t j) const noexcept {
+        return std::memcmp(dets->data() + i * 2 * n_words, dets->data() + j * 2 * n_words,
+                           2 * n_words * sizeof(word_t)) == 0;
+    }
+};
+
+struct external_space_accumulator {
+    const idx_t n_words;
+    // Number of values per determinant (one PT2 numerator per state)
+    const idx_t n_values;
+    std::vector<word_t> dets;
+    std::vector<double> values;
+    std::vector<idx_t> parents;
+    // Store (part of) the hash in the buckets, to rehash without reading the determinants
+    tsl::hopscotch_set<idx_t, det_index_hash, det_index_equal, std::allocator<idx_t>, 30, true>
+        index;
+
+    external_space_accumulator(const idx_t n_words, const idx_t n_values)
+        : n_words(n_words), n_values(n_values),
+          index(0, det_index_hash{&dets, n_words}, det_index_equal{&dets, n_words}) {}
+
+    void add(const word_t *det, const double *value, const idx_t parent) {
+        // Append the determinant as a candidate; drop it if it was already there
+        const idx_t n = parents.size();
+        dets.insert(dets.end(), det, det + 2 * n_words);
+        const auto [it, inserted] = index.insert(n);
+        if (inserted) {
+            values.insert(values.end(), value, value + n_values);
+            parents.push_back(parent);
+        } else {
+            dets.resize(dets.size() - 2 * n_words);
+            double *sum = values.data() + *it * n_values;
+            for (idx_t s = 0; s < n_values; s++)
+                sum[s] += value[s];
+        }
+    }
+};
+
+} // namespace
+
+extern "C" void *external_space_create(const idx_t n_words, const idx_t n_values) {
+    return new external_space_accumulator(n_words, n_values);
+}
+
+extern "C" void external_space_destroy(void *accumulator) {
+    delete static_cast<external_space_accumulator *>(accumulator);
+}
+
+extern "C" void external_space_add(void *accumulator, const word_t *dets, const double *values,
+                                   const idx_t *parents, const idx_t n) {
+    auto *acc = static_cast<external_space_accumulator *>(accumulator);
+    acc->dets.reserve(acc->dets.size() + n * 2 * acc->n_words);
+    for (idx_t i = 0; i < n; i++)
+        acc->add(dets + i * 2 * acc->n_words, values + i * acc->n_values, parents[i]);
+}
+
+extern "C" idx_t external_space_size(const void *accumulator) {
+    return static_cast<const external_space_accumulator *>(accumulator)->parents.size();
+}
+
+extern "C" void external_space_extract(const void *accumulator, word_t *dets, double *values,
+                                       idx_t *parents) {
+    const auto *acc = static_cast<const external_space_accumulator *>(accumulator);
+    std::copy(acc->dets.begin(), acc->dets.end(), dets);
+    std::copy(acc->values.begin(), acc->values.end(), values);
+    std::copy(acc->parents.begin(), acc->parents.end(), parents);
+}
+
+extern "C" void external_space_clear(void *accumulator) {
+    auto *acc = static_cast<external_space_accumulator *>(accumulator);
+    acc->index.clear();
+    acc->dets.clear();
+    acc->values.clear();
+    acc->parents.clear();
+}
@@ -0,0 +1,39 @@
+#pragma once
+#include "det_hash.h"
+#include <cstdint>
+
+// Bloom filter over packed determinants (2 * n_words uint64 words each, as in `DetArray').
+// The filter is an array of 2^n_bits_log2 bits, stored in uint64 words; each determinant sets
+// n_hashes bits, chosen by double hashing. Queries have no false negatives, and a false-positive
+// rate of about (1 - exp(-n_hashes * n / 2^n_bits_log2))^n_hashes.
+// Header-only, so that compiled kernels can reject determinants at generation time.
+
+namespace bloom {
+
+inline uint64_t hash_det(const uint64_t *det, const int64_t n_words) {
+    return hash_words(det, 2 * n_words);
+}
+
+inline void insert(uint64_t *filter, const int n_bits_log2, const int n_hashes, const uint64_t *det,
+                   const int64_t n_words) {
+    const uint64_t h = hash_det(det, n_words), mask = (uint64_t(1) << n_bits_log2) - 1;
+    const uint64_t h1 = h, h2 = mix64(h) | 1;
+    for (int k = 0; k < n_hashes; k++) {
+        const uint64_t bit = (h1 + k * h2) & mask;
+        filter[bit >> 6] |= uint64_t(1) << (bit & 63);
+    }
+}
+
+inline bool may_contain(const uint64_t *filter, const int n_bits_log2, const int n_hashes,
+                        const uint64_t *det, const int64_t n_words) {
+    const uint64_t h = hash_det(det, n_words), mask = (uint64_t(1) << n_bits_log2) - 1;
+    const uint64_t h1 = h, h2 = mix64(h) | 1;
+    for (int k = 0; k < n_hashes; k++) {
+        const uint64_t bit = (h1 + k * h2) & mask;
+        if (!((filter[bit >> 6] >> (bit & 63)) & 1))
+            return false;
+    }
+    return true;
+}
+
+} // namespace bloom
@@ -0,0 +1,21 @@
+#pragma once
+#include <cstdint>
+
+// Hashing of packed determinants (uint64 words), without allocation
+
+// splitmix64 finalizer
+inline uint64_t mix64(uint64_t x) {
+    x ^= x >> 30;
+    x *= 0xbf58476d1ce4e5b9ULL;
+    x ^= x >> 27;
+    x *= 0x94d049bb133111ebULL;
+    x ^= x >> 31;
+    return x;
+}
+
+inline uint64_t hash_words(const uint64_t *words, const int64_t n) {
+    uint64_t h = 0x9e3779b97f4a7c15ULL;
+    for (int64_t w = 0; w < n; w++)
+        h = mix64(h ^ words[w]);
+    return h;
+}
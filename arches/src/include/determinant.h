@@ -1,6 +1,9 @@
 #pragma once
 
 #include <array>
+#include <cassert>
+#include <cstdint>
+#include <det_hash.h>
 #include <functional>
 #include <iostream>
 #include <string>
@@ -11,9 +14,13 @@
 
 typedef sul::dynamic_bitset<> spin_det_t;
 
+// Hash the blocks of the bitset directly (no string allocation)
 template <> struct std::hash<spin_det_t> {
     std::size_t operator()(spin_det_t const &s) const noexcept {
-        return std::hash<std::string>()(s.to_string());
+        uint64_t h = mix64(s.size());
+        for (std::size_t i = 0; i < s.num_blocks(); i++)
+            h = mix64(h ^ s.data()[i]);
+        return h;
     }
 };
 
@@ -51,12 +58,15 @@ class det_t { // The class
     }
     // https://stackoverflow.com/a/27830679/7674852 seem to recommand doing the
     // other way arround
-    const spin_det_t &operator[](unsigned i) const { return (*this)[i]; }
+    const spin_det_t &operator[](unsigned i) const {
+        assert(i < N_SPIN_SPECIES);
+        return i == 0 ? alpha : beta;
+    }
 
     // get excitation degree between self and other determinant
-    std::array<int, N_SPIN_SPECIES> exc_degree(const det_t &b) {
-        auto ed_alpha = (*this.alpha ^ b.alpha).count() / 2;
-        auto ed_beta = (*this.beta ^ b.beta).count() / 2;
+    std::array<int, N_SPIN_SPECIES> exc_degree(const det_t &b) const {
+        const int ed_alpha = (alpha ^ b.alpha).count() / 2;
+        const int ed_beta = (beta ^ b.beta).count() / 2;
         return std::array<int, N_SPIN_SPECIES>{ed_alpha, ed_beta};
     }
 };
@@ -94,28 +104,27 @@ det_t apply_single_excitation(det_t s, int spin, uint64_t hole, uint64_t particl
 
 spin_det_t apply_spin_single_excitation(spin_det_t s, uint64_t hole, uint64_t particle);
 
-det_t apply_double_excitation(det_t s, std::pair<int> spin, uint64_t h1, uint64_t h2, uint64_t p1,
-                              uint64_t p2);
+det_t apply_double_excitation(det_t s, std::pair<int, int> spin, uint64_t h1, uint64_t h2,
+                              uint64_t p1, uint64_t p2);
 
+// Orbital indices; an excitation constraint gives the orbitals where holes (first)
+// and particles (second) can be created
 typedef std::vector<uint64_t> spin_constraint_t;
 typedef std::pair<spin_constraint_t, spin_constraint_t> exc_constraint_t;
 
-std::string to_string(const spin_constraint_t &c, uint64_t max_orb) {
+// Bit string of the orbitals of c; as for `spin_det_t', orbital 0 is the last character
+inline std::string to_string(const spin_constraint_t &c, uint64_t max_orb) {
     std::string s(max_orb, '0');
 
     for (const auto &i : c)
-        s[i] = '1';
+        s[max_orb - 1 - i] = '1';
     return s;
 }
 
-spin_constraint_t to_constraint(const spin_det_t &c) {
+inline spin_constraint_t to_constraint(const spin_det_t &c) {
     spin_constraint_t res;
-    auto npos = c.npos;
-    auto c_pos = c.find_next(0);
-    while (c_pos < npos) {
+    for (auto c_pos = c.find_first(); c_pos != c.npos; c_pos = c.find_next(c_pos))
         res.push_back(c_pos);
-        c_pos = c.find_next(0);
-    }
     return res;
 }
 
@@ -140,3 +149,22 @@ std::vector<det_t> get_ss_doubles_by_exc_mask(det_t d, int spin, spin_constraint
                                               spin_constraint_t p);
 
 std::vector<det_t> get_all_singles(det_t d);
+
+typedef long long int idx_t;
+typedef uint64_t word_t;
+
+// Triplet-constrained excitations of a batch of packed determinants (2 * n_words uint64 words each,
+// alpha words first, as in `DetArray'): all determinants singly or doubly connected to one of the
+// n determinants of psi, whose three highest occupied alpha orbitals are `constraint'
+// (only the singly connected ones if max_degree = 1).
+// Determinants found among the n_internal determinants of internal_sorted (sorted in memcmp order)
+// are rejected, after a Bloom filter prefilter (n_hashes = 0: no prefilter, see bloom_filter.h).
+// Write the determinants, the index in psi of their generator and their excitation degree into
+// preallocated buffers of size capacity, in the order of the generators.
+// Return the number of determinants; if larger than capacity, nothing is written
+// and the call should be repeated with larger buffers.
+extern "C" idx_t triplet_constrained_excitations(
+    const word_t *psi, const idx_t n, const idx_t n_words, const idx_t n_orb,
+    const idx_t *constraint, const idx_t max_degree, const word_t *internal_sorted,
+    const idx_t n_internal, const word_t *filter, const idx_t n_bits_log2, const idx_t n_hashes,
+    word_t *dets, idx_t *parents, int8_t *degrees, const idx_t capacity);
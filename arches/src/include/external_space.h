@@ -0,0 +1,28 @@
+#pragma once
+#include <cstdint>
+
+typedef long long int idx_t;
+typedef uint64_t word_t;
+
+// Accumulator of the external (connected) space: hash map from packed determinant
+// (2 * n_words uint64 words, as in `DetArray') to the sums of its PT2 numerator contributions
+// (n_values of them, one per state), and the generator of its first contribution.
+// Determinants are kept in order of first insertion.
+extern "C" void *external_space_create(const idx_t n_words, const idx_t n_values);
+
+extern "C" void external_space_destroy(void *accumulator);
+
+// Add n contributions values[i * n_values : (i + 1) * n_values], from generator parents[i],
+// to determinant dets[i]
+extern "C" void external_space_add(void *accumulator, const word_t *dets, const double *values,
+                                   const idx_t *parents, const idx_t n);
+
+// Number of unique determinants
+extern "C" idx_t external_space_size(const void *accumulator);
+
+// Write the unique determinants, their sums and parents into buffers of
+// external_space_size determinants
+extern "C" void external_space_extract(const void *accumulator, word_t *dets, double *values,
+                                       idx_t *parents);
+
+extern "C" void external_space_clear(void *accumulator);
@@ -0,0 +1,30 @@
+#pragma once
+#include <cstdint>
+
+typedef long long int idx_t;
+typedef uint64_t word_t;
+
+// Write the (row, col, value) triplets of <psi_i|H_2e|psi_j> generated by a chunk of
+// two-electron integrals into preallocated buffers of size capacity.
+// Return the number of triplets; if larger than capacity, only the first capacity were written
+// and the call should be repeated with larger buffers.
+extern "C" idx_t H_triplets_integral_chunk(const idx_t *idx, const double *values,
+                                           const idx_t n_integrals, const word_t *psi_i,
+                                           const idx_t n_i, const word_t *psi_j_sorted,
+                                           const idx_t *psi_j_order, const idx_t n_j,
+                                           const idx_t n_words, idx_t *rows, idx_t *cols,
+                                           double *vals, const idx_t capacity);
+
+// Insert n packed determinants into a Bloom filter of 2^n_bits_log2 bits (see bloom_filter.h)
+extern "C" void bloom_filter_insert(const word_t *psi, const idx_t n, const idx_t n_words,
+                                    word_t *filter, const idx_t n_bits_log2, const idx_t n_hashes);
+
+// For each of n packed determinants, write 1 in may_contain if it may be in the filter, 0 if not
+extern "C" void bloom_filter_query(const word_t *psi, const idx_t n, const idx_t n_words,
+                                   const word_t *filter, const idx_t n_bits_log2,
+                                   const idx_t n_hashes, uint8_t *may_contain);
+
+// W = H M for a CSR matrix H (n_rows rows, indptr / indices / data) and a dense row-major
+// (n x k) matrix M, all k right-hand sides at once; W is a dense row-major (n_rows x k) matrix
+extern "C" void csr_matrix_product(const idx_t *indptr, const idx_t *indices, const double *data,
+                                   const idx_t n_rows, const double *M, const idx_t k, double *W);
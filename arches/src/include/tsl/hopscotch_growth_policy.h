@@ -0,0 +1,230 @@
+/**
+ * Growth policies of the hopscotch hash tables (tsl::hopscotch_set).
+ *
+ * hopscotch_hash.h expects this header; it is not part of the vendored files,
+ * so the policies it relies on are provided here, with the same interface:
+ *   - GrowthPolicy(std::size_t& min_bucket_count_in_out): bucket count is rounded up
+ *     to a valid one, and written back;
+ *   - bucket_for_hash(hash) noexcept, next_bucket_count(), max_bucket_count(), clear() noexcept.
+ */
+#ifndef TSL_HOPSCOTCH_GROWTH_POLICY_H
+#define TSL_HOPSCOTCH_GROWTH_POLICY_H
+
+#include <algorithm>
+#include <array>
+#include <climits>
+#include <cmath>
+#include <cstddef>
+#include <cstdint>
+#include <exception>
+#include <limits>
+#include <ratio>
+#include <stdexcept>
+
+#ifdef TSL_DEBUG
+#include <cassert>
+#define tsl_hh_assert(expr) assert(expr)
+#else
+#define tsl_hh_assert(expr) (static_cast<void>(0))
+#endif
+
+#ifdef TSL_HH_NO_EXCEPTIONS
+#define TSL_HH_THROW_OR_TERMINATE(ex, msg) std::terminate()
+#else
+#define TSL_HH_THROW_OR_TERMINATE(ex, msg) throw ex(msg)
+#endif
+
+namespace tsl {
+namespace hh {
+
+/**
+ * Bucket count is a power of two, and grows by GrowthFactor (a power of two);
+ * the bucket of a hash is its lowest bits.
+ */
+template <std::size_t GrowthFactor>
+class power_of_two_growth_policy {
+ public:
+  explicit power_of_two_growth_policy(std::size_t& min_bucket_count_in_out) {
+    if (min_bucket_count_in_out > max_bucket_count()) {
+      TSL_HH_THROW_OR_TERMINATE(std::length_error,
+                                "The hash table exceeds its maximum size.");
+    }
+
+    if (min_bucket_count_in_out > 0) {
+      min_bucket_count_in_out = round_up_to_power_of_two(min_bucket_count_in_out);
+      m_mask = min_bucket_count_in_out - 1;
+    } else {
+      m_mask = 0;
+    }
+  }
+
+  std::size_t bucket_for_hash(std::size_t hash) const noexcept { return hash & m_mask; }
+
+  std::size_t next_bucket_count() const {
+    if ((m_mask + 1) > max_bucket_count() / GrowthFactor) {
+      TSL_HH_THROW_OR_TERMINATE(std::length_error,
+                                "The hash table exceeds its maximum size.");
+    }
+
+    return (m_mask + 1) * GrowthFactor;
+  }
+
+  std::size_t max_bucket_count() const {
+    // Largest power of two
+    return (std::numeric_limits<std::size_t>::max() / 2) + 1;
+  }
+
+  void clear() noexcept { m_mask = 0; }
+
+ private:
+  static std::size_t round_up_to_power_of_two(std::size_t value) {
+    if (is_power_of_two(value)) {
+      return value;
+    }
+
+    if (value == 0) {
+      return 1;
+    }
+
+    --value;
+    for (std::size_t i = 1; i < sizeof(std::size_t) * CHAR_BIT; i *= 2) {
+      value |= value >> i;
+    }
+
+    return value + 1;
+  }
+
+  static constexpr bool is_power_of_two(std::size_t value) {
+    return value != 0 && (value & (value - 1)) == 0;
+  }
+
+  static_assert(is_power_of_two(GrowthFactor) && GrowthFactor >= 2,
+                "GrowthFactor must be a power of two >= 2.");
+
+ protected:
+  std::size_t m_mask;
+};
+
+/**
+ * Bucket count grows by GrowthFactor (a ratio > 1); the bucket of a hash is hash % bucket count.
+ */
+template <class GrowthFactor = std::ratio<3, 2>>
+class mod_growth_policy {
+ public:
+  explicit mod_growth_policy(std::size_t& min_bucket_count_in_out) {
+    if (min_bucket_count_in_out > max_bucket_count()) {
+      TSL_HH_THROW_OR_TERMINATE(std::length_error,
+                                "The hash table exceeds its maximum size.");
+    }
+
+    if (min_bucket_count_in_out > 0) {
+      m_mod = min_bucket_count_in_out;
+    } else {
+      m_mod = 1;
+    }
+  }
+
+  std::size_t bucket_for_hash(std::size_t hash) const noexcept { return hash % m_mod; }
+
+  std::size_t next_bucket_count() const {
+    if (m_mod == max_bucket_count()) {
+      TSL_HH_THROW_OR_TERMINATE(std::length_error,
+                                "The hash table exceeds its maximum size.");
+    }
+
+    const double next_bucket_count = std::ceil(double(m_mod) * REHASH_SIZE_MULTIPLICATION_FACTOR);
+    if (!std::isnormal(next_bucket_count)) {
+      TSL_HH_THROW_OR_TERMINATE(std::length_error,
+                                "The hash table exceeds its maximum size.");
+    }
+
+    if (next_bucket_count > double(max_bucket_count())) {
+      return max_bucket_count();
+    } else {
+      return std::size_t(next_bucket_count);
+    }
+  }
+
+  std::size_t max_bucket_count() const { return MAX_BUCKET_COUNT; }
+
+  void clear() noexcept { m_mod = 1; }
+
+ private:
+  static constexpr double REHASH_SIZE_MULTIPLICATION_FACTOR =
+      1.0 * GrowthFactor::num / GrowthFactor::den;
+  static const std::size_t MAX_BUCKET_COUNT =
+      std::size_t(double(std::numeric_limits<std::size_t>::max() /
+                         REHASH_SIZE_MULTIPLICATION_FACTOR));
+
+  static_assert(REHASH_SIZE_MULTIPLICATION_FACTOR >= 1.1, "Growth factor should be >= 1.1.");
+
+  std::size_t m_mod;
+};
+
+namespace detail {
+
+// Smallest prime larger than 2^k, k = 2, ..., 63
+static constexpr const std::array<std::size_t, 62> PRIMES = {{
+    5ull, 11ull, 17ull, 37ull, 67ull, 131ull, 257ull, 521ull, 1031ull, 2053ull, 4099ull,
+    8209ull, 16411ull, 32771ull, 65537ull, 131101ull, 262147ull, 524309ull, 1048583ull,
+    2097169ull, 4194319ull, 8388617ull, 16777259ull, 33554467ull, 67108879ull, 134217757ull,
+    268435459ull, 536870923ull, 1073741827ull, 2147483659ull, 4294967311ull, 8589934609ull,
+    17179869209ull, 34359738421ull, 68719476767ull, 137438953481ull, 274877906951ull,
+    549755813911ull, 1099511627791ull, 2199023255579ull, 4398046511119ull, 8796093022237ull,
+    17592186044423ull, 35184372088891ull, 70368744177679ull, 140737488355333ull,
+    281474976710677ull, 562949953421381ull, 1125899906842679ull, 2251799813685269ull,
+    4503599627370517ull, 9007199254740997ull, 18014398509482143ull, 36028797018963971ull,
+    72057594037928017ull, 144115188075855881ull, 288230376151711813ull,
+    576460752303423619ull, 1152921504606847009ull, 2305843009213693967ull,
+    4611686018427388039ull, 9223372036854775837ull,
+}};
+
+}  // namespace detail
+
+/**
+ * Bucket count is a prime, roughly doubling at each growth; the bucket of a hash is
+ * hash % bucket count. Spreads poor hashes better than power_of_two_growth_policy.
+ */
+class prime_growth_policy {
+ public:
+  explicit prime_growth_policy(std::size_t& min_bucket_count_in_out) {
+    auto it_prime = std::lower_bound(detail::PRIMES.begin(), detail::PRIMES.end(),
+                                     min_bucket_count_in_out);
+    if (it_prime == detail::PRIMES.end()) {
+      TSL_HH_THROW_OR_TERMINATE(std::length_error,
+                                "The hash table exceeds its maximum size.");
+    }
+
+    m_iprime = static_cast<unsigned int>(std::distance(detail::PRIMES.begin(), it_prime));
+    if (min_bucket_count_in_out > 0) {
+      min_bucket_count_in_out = *it_prime;
+    } else {
+      min_bucket_count_in_out = 0;
+    }
+  }
+
+  std::size_t bucket_for_hash(std::size_t hash) const noexcept {
+    return hash % detail::PRIMES[m_iprime];
+  }
+
+  std::size_t next_bucket_count() const {
+    if (m_iprime + 1 >= detail::PRIMES.size()) {
+      TSL_HH_THROW_OR_TERMINATE(std::length_error,
+                                "The hash table exceeds its maximum size.");
+    }
+
+    return detail::PRIMES[m_iprime + 1];
+  }
+
+  std::size_t max_bucket_count() const { return detail::PRIMES.back(); }
+
+  void clear() noexcept { m_iprime = 0; }
+
+ private:
+  unsigned int m_iprime;
+};
+
+}  // namespace hh
+}  // namespace tsl
+
+#endif
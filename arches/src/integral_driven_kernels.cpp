@@ -0,0 +1,249 @@
+#include "integral_driven_kernels.h"
+#include "bloom_filter.h"
+#include <algorithm>
+#include <array>
+#include <cstring>
+#include <numeric>
+#include <utility>
+#include <vector>
+
+// Determinants are packed as in `DetArray': 2 * n_words uint64 words per determinant,
+// alpha words first, bit (o % 64) of word (o / 64) set if orbital o is occupied.
+// Spin-orbitals are ordered with the whole alpha block before the beta block,
+// which gives the same phase convention as `single_phase' / `double_phase'.
+
+namespace {
+
+inline bool is_occupied(const word_t *det, const idx_t n_words, const int spin, const idx_t o) {
+    return (det[spin * n_words + (o >> 6)] >> (o & 63)) & 1;
+}
+
+// Parity of the number of occupied spin-orbitals before spin-orbital (o, spin)
+inline int parity_before(const word_t *det, const idx_t n_words, const int spin, const idx_t o) {
+    int n = 0;
+    for (idx_t w = 0; w < spin * n_words + (o >> 6); w++)
+        n += __builtin_popcountll(det[w]);
+    n += __builtin_popcountll(det[spin * n_words + (o >> 6)] & ((word_t(1) << (o & 63)) - 1));
+    return n & 1;
+}
+
+// Apply creation (create = true) or annihilation operator of spin-orbital (o, spin) to det, in place.
+// Return the phase, or 0 if the determinant vanishes
+inline int apply_operator(word_t *det, const idx_t n_words, const int spin, const idx_t o,
+                          const bool create) {
+    if (is_occupied(det, n_words, spin, o) == create)
+        return 0;
+    const int phase = parity_before(det, n_words, spin, o) ? -1 : 1;
+    det[spin * n_words + (o >> 6)] ^= word_t(1) << (o & 63);
+    return phase;
+}
+
+// Binary search of det in psi_j, sorted by memcmp order (the order numpy sorts `DetArray.keys' in).
+// Return the index of det in the unsorted psi_j, -1 if absent
+inline idx_t find_det(const word_t *det, const word_t *psi_j_sorted, const idx_t *psi_j_order,
+                      const idx_t n_j, const idx_t n_words) {
+    const size_t n_bytes = 2 * n_words * sizeof(word_t);
+    idx_t lo = 0, hi = n_j;
+    while (lo < hi) {
+        const idx_t mid = lo + (hi - lo) / 2;
+        if (std::memcmp(psi_j_sorted + mid * 2 * n_words, det, n_bytes) < 0)
+            lo = mid + 1;
+        else
+            hi = mid;
+    }
+    if (lo < n_j && std::memcmp(psi_j_sorted + lo * 2 * n_words, det, n_bytes) == 0)
+        return psi_j_order[lo];
+    return -1;
+}
+
+// Distinct permutations of <ij|kl> that are equivalent for real orbitals
+int unique_permutations(const idx_t *ijkl, std::array<std::array<idx_t, 4>, 8> &perms) {
+    const idx_t i = ijkl[0], j = ijkl[1], k = ijkl[2], l = ijkl[3];
+    const std::array<std::array<idx_t, 4>, 8> all = {{{i, j, k, l},
+                                                       {j, i, l, k},
+                                                       {k, l, i, j},
+                                                       {l, k, j, i},
+                                                       {i, l, k, j},
+                                                       {l, i, j, k},
+                                                       {k, j, i, l},
+                                                       {j, k, l, i}}};
+    int n = 0;
+    for (const auto &p : all)
+        if (std::find(perms.begin(), perms.begin() + n, p) == perms.begin() + n)
+            perms[n++] = p;
+    return n;
+}
+
+// Determinants of a batch with spin-orbital (o, spin) occupied, and with it empty, as sorted index
+// lists (CSR layout over the 2 * n_orb spin-orbitals)
+class Occupancy {
+  public:
+    Occupancy(const word_t *psi, const idx_t n, const idx_t n_words, const idx_t n_orb)
+        : n_orb(n_orb) {
+        for (int occupied = 0; occupied < 2; occupied++)
+            offsets[occupied].assign(2 * n_orb + 1, 0);
+        for (idx_t I = 0; I < n; I++)
+            for (int spin = 0; spin < 2; spin++)
+                for (idx_t o = 0; o < n_orb; o++)
+                    offsets[is_occupied(psi + I * 2 * n_words, n_words, spin, o)]
+                           [spin * n_orb + o + 1]++;
+        auto fill = offsets;
+        for (int occupied = 0; occupied < 2; occupied++) {
+            std::partial_sum(offsets[occupied].begin(), offsets[occupied].end(),
+                             offsets[occupied].begin());
+            std::partial_sum(fill[occupied].begin(), fill[occupied].end(), fill[occupied].begin());
+            dets[occupied].resize(offsets[occupied].back());
+        }
+        for (idx_t I = 0; I < n; I++)
+            for (int spin = 0; spin < 2; spin++)
+                for (idx_t o = 0; o < n_orb; o++) {
+                    const bool occupied = is_occupied(psi + I * 2 * n_words, n_words, spin, o);
+                    dets[occupied][fill[occupied][spin * n_orb + o]++] = I;
+                }
+    }
+
+    std::pair<const idx_t *, const idx_t *> list(const bool occupied, const int spin,
+                                                 const idx_t o) const {
+        const idx_t *data = dets[occupied].data();
+        return {data + offsets[occupied][spin * n_orb + o],
+                data + offsets[occupied][spin * n_orb + o + 1]};
+    }
+
+  private:
+    const idx_t n_orb;
+    std::array<std::vector<idx_t>, 2> offsets;
+    std::array<std::vector<idx_t>, 2> dets;
+};
+
+// Condition on a spin-orbital of the determinants a term of H acts on
+struct Occupancy_condition {
+    bool occupied;
+    int spin;
+    idx_t o;
+};
+
+} // namespace
+
+extern "C" idx_t H_triplets_integral_chunk(const idx_t *idx, const double *values,
+                                           const idx_t n_integrals, const word_t *psi_i,
+                                           const idx_t n_i, const word_t *psi_j_sorted,
+                                           const idx_t *psi_j_order, const idx_t n_j,
+                                           const idx_t n_words, idx_t *rows, idx_t *cols,
+                                           double *vals, const idx_t capacity) {
+    // H = 1/2 \sum_{ijkl} \sum_{s, t} <ij|kl> a^+_{i s} a^+_{j t} a_{l t} a_{k s}
+    // Each non-vanishing term applied to |I> gives one (I, J, value) triplet,
+    // duplicates (I, J) are left for the caller to sum.
+    // A term only acts on the determinants with (k, s) and (l, t) occupied, and (i, s), (j, t)
+    // empty (unless they are the ones annihilated). Whatever the category of the integral, these
+    // are found from the occupancy lists of psi_i: the shortest of the lists of these spin-orbitals
+    // is walked, and the other conditions are checked on the bits. Phases and lookups are only done
+    // for the determinants the term acts on.
+    idx_t n_orb = 0;
+    for (idx_t n = 0; n < 4 * n_integrals; n++)
+        n_orb = std::max(n_orb, idx[n] + 1);
+    const Occupancy occ(psi_i, n_i, n_words, n_orb);
+    idx_t n_triplets = 0;
+#pragma omp parallel
+    {
+        std::vector<word_t> det(2 * n_words);
+        std::array<std::array<idx_t, 4>, 8> perms;
+        std::array<Occupancy_condition, 4> conditions;
+#pragma omp for schedule(dynamic)
+        for (idx_t n = 0; n < n_integrals; n++) {
+            const int n_perms = unique_permutations(idx + 4 * n, perms);
+            const double half_value = 0.5 * values[n];
+            for (int q = 0; q < n_perms; q++) {
+                const auto &[i, j, k, l] = perms[q];
+                for (int s = 0; s < 2; s++) {
+                    for (int t = 0; t < 2; t++) {
+                        // Annihilating or creating the same spin-orbital twice gives 0
+                        if (s == t && (k == l || i == j))
+                            continue;
+                        // (k, s), (l, t) occupied; (i, s), (j, t) empty unless just annihilated
+                        int n_conditions = 0;
+                        conditions[n_conditions++] = {true, s, k};
+                        conditions[n_conditions++] = {true, t, l};
+                        if (!(i == k || (s == t && i == l)))
+                            conditions[n_conditions++] = {false, s, i};
+                        if (!(j == l || (s == t && j == k)))
+                            conditions[n_conditions++] = {false, t, j};
+                        // Walk the shortest list, and check the other conditions on the bits
+                        std::pair<const idx_t *, const idx_t *> shortest;
+                        int c_shortest = -1;
+                        for (int c = 0; c < n_conditions; c++) {
+                            const auto &[occupied, spin, o] = conditions[c];
+                            const auto candidates = occ.list(occupied, spin, o);
+                            if (c_shortest < 0 || candidates.second - candidates.first <
+                                                      shortest.second - shortest.first) {
+                                shortest = candidates;
+                                c_shortest = c;
+                            }
+                        }
+                        for (const idx_t *it = shortest.first; it != shortest.second; it++) {
+                            const idx_t I = *it;
+                            const word_t *det_I = psi_i + I * 2 * n_words;
+                            bool acts = true;
+                            for (int c = 0; c < n_conditions && acts; c++) {
+                                const auto &[occupied, spin, o] = conditions[c];
+                                acts = c == c_shortest ||
+                                       is_occupied(det_I, n_words, spin, o) == occupied;
+                            }
+                            if (!acts)
+                                continue;
+                            std::copy(det_I, det_I + 2 * n_words, det.begin());
+                            int phase = apply_operator(det.data(), n_words, s, k, false);
+                            phase *= apply_operator(det.data(), n_words, t, l, false);
+                            phase *= apply_operator(det.data(), n_words, t, j, true);
+                            phase *= apply_operator(det.data(), n_words, s, i, true);
+                            const idx_t J =
+                                find_det(det.data(), psi_j_sorted, psi_j_order, n_j, n_words);
+                            if (J < 0)
+                                continue;
+                            idx_t pos;
+#pragma omp atomic capture
+                            pos = n_triplets++;
+                            if (pos < capacity) {
+                                rows[pos] = I;
+                                cols[pos] = J;
+                                vals[pos] = phase * half_value;
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    }
+    return n_triplets;
+}
+
+extern "C" void bloom_filter_insert(const word_t *psi, const idx_t n, const idx_t n_words,
+                                    word_t *filter, const idx_t n_bits_log2, const idx_t n_hashes) {
+    for (idx_t I = 0; I < n; I++)
+        bloom::insert(filter, n_bits_log2, n_hashes, psi + I * 2 * n_words, n_words);
+}
+
+extern "C" void bloom_filter_query(const word_t *psi, const idx_t n, const idx_t n_words,
+                                   const word_t *filter, const idx_t n_bits_log2,
+                                   const idx_t n_hashes, uint8_t *may_contain) {
+#pragma omp parallel for
+    for (idx_t I = 0; I < n; I++)
+        may_contain[I] = bloom::may_contain(filter, n_bits_log2, n_hashes, psi + I * 2 * n_words,
+                                            n_words);
+}
+
+extern "C" void csr_matrix_product(const idx_t *indptr, const idx_t *indices, const double *data,
+                                   const idx_t n_rows, const double *M, const idx_t k, double *W) {
+    // Rows of W are independent; each non-zero H_IJ adds H_IJ * M[J, :] to W[I, :],
+    // a contiguous axpy over the k columns
+#pragma omp parallel for schedule(dynamic, 64)
+    for (idx_t I = 0; I < n_rows; I++) {
+        double *W_I = W + I * k;
+        std::fill(W_I, W_I + k, 0.0);
+        for (idx_t p = indptr[I]; p < indptr[I + 1]; p++) {
+            const double H_IJ = data[p];
+            const double *M_J = M + indices[p] * k;
+            for (idx_t c = 0; c < k; c++)
+                W_I[c] += H_IJ * M_J[c];
+        }
+    }
+}
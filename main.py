@@ -1,5 +1,5 @@
 #!/usr/bin/env python3
-from arches.drivers import Hamiltonian_generator, selection_step
+from arches.drivers import Hamiltonian_generator, Powerplant_manager, selection_step
 from arches.io import load_integrals, load_wf
 from mpi4py import MPI
 import argparse
@@ -25,6 +25,62 @@ if __name__ == "__main__":
         help="Number of determinants to target",
     )
 
+    parser.add_argument(
+        "-pt2_fraction",
+        type=float,
+        default=None,
+        required=False,
+        help="Fraction of |E_pt2| to capture at each selection step: the determinants with the largest contributions are selected until this fraction is reached. Default is to select N_det determinants (the wave function doubles at each iteration).",
+    )
+
+    parser.add_argument(
+        "-max_selected",
+        type=int,
+        default=None,
+        required=False,
+        help="Hard cap on the number of determinants selected at each iteration. Default is N_det.",
+    )
+
+    parser.add_argument(
+        "-pt2_screening_threshold",
+        type=float,
+        default=None,
+        required=False,
+        help="Skip the triplet-constraints whose upper bound on |E_pt2(C)| is below this threshold during selection. Default is no screening.",
+    )
+
+    parser.add_argument(
+        "-generator_norm_fraction",
+        type=float,
+        default=None,
+        required=False,
+        help="Only use the determinants with the largest |c_I|, covering this fraction of the norm of the wave function, as generators of the connected space during selection. Default is to use all determinants.",
+    )
+
+    parser.add_argument(
+        "-pt2_error_target",
+        type=float,
+        default=None,
+        required=False,
+        help="Estimate E_pt2 semistochastically, to this statistical error (one standard deviation), during selection: only the triplet-constraints with the largest weights, and a sample of the others, are computed, and determinants are selected among theirs. Default is to compute E_pt2 over the whole connected space.",
+    )
+
+    parser.add_argument(
+        "-n_states",
+        type=int,
+        default=1,
+        required=False,
+        help="Number of states (ground and lowest excited states) to compute. Their PT2 contributions are computed in the same pass over the connected space. Default is the ground state only.",
+    )
+
+    parser.add_argument(
+        "-state_selection",
+        choices=["average", "max"],
+        default="average",
+        required=False,
+        help="With several states, select determinants by the average of their E_pt2 contributions over states, or by their largest contribution to any state.",
+    )
+
     parser.add_argument(
         "-driven_by",
         choices=["integral", "determinant"],
@@ -33,6 +89,45 @@ if __name__ == "__main__":
         help="Way in which Hamiltonian is generated. Integral driven: local set of integrals, determinants are found on each node. Determinant driven: local set of determinants, all integrals are on each node.",
     )
 
+    parser.add_argument(
+        "-max_H_cache_bytes",
+        type=int,
+        default=None,
+        required=False,
+        help="Memory budget (in bytes, per rank) for caching the Hamiltonian matrix elements. Default is no limit.",
+    )
+
+    parser.add_argument(
+        "-H_cache_spill",
+        choices=["recompute", "memmap"],
+        default="recompute",
+        required=False,
+        help="What to do with the Hamiltonian matrix elements above max_H_cache_bytes. Recompute: generate them on the fly at each Davidson iteration. Memmap: spill them to memory-mapped files in H_cache_dir.",
+    )
+
+    parser.add_argument(
+        "-H_cache_dir",
+        default=None,
+        required=False,
+        help="Directory (ideally on a local disk) for the memory-mapped Hamiltonian matrix elements. Default is the system temporary directory.",
+    )
+
+    parser.add_argument(
+        "-H_cache_block_size",
+        type=int,
+        default=1024,
+        required=False,
+        help="Number of rows of the Hamiltonian generated, cached, spilled or recomputed together.",
+    )
+
+    parser.add_argument(
+        "-vector_exchange",
+        choices=["allgather", "halo"],
+        default="allgather",
+        required=False,
+        help="How Davidson's trial vectors are exchanged for the distributed Hamiltonian products. Allgather: every rank gathers the full vectors. Halo: each rank only receives the components matching the columns of its rows of H.",
+    )
+
     args = parser.parse_args()
     # Load integrals
     comm = MPI.COMM_WORLD
@@ -54,12 +149,57 @@ if __name__ == "__main__":
 
     # Hamiltonian engine
     lewis = Hamiltonian_generator(
-        comm, E0, d_one_e_integral, d_two_e_integral, psi_det, driven_by=args.driven_by
+        comm,
+        E0,
+        d_one_e_integral,
+        d_two_e_integral,
+        psi_det,
+        driven_by=args.driven_by,
+        max_H_cache_bytes=args.max_H_cache_bytes,
+        H_cache_spill=args.H_cache_spill,
+        H_cache_dir=args.H_cache_dir,
+        H_cache_block_size=args.H_cache_block_size,
+        vector_exchange=args.vector_exchange,
     )
 
+    if args.n_states > 1:
+        # Start from the lowest states of the initial wave function
+        E, psi_coef = Powerplant_manager(comm, lewis, n_states=args.n_states).E_and_psi_coef
+
+    # Measured runtimes of the constraints, reused to schedule them on the next iteration
+    constraint_runtimes = {}
+    # E_pt2 of the wave function at each selection step, its statistical error, and the screening
+    pt2_report = {}
     while len(psi_det) < args.N_det_target:
-        E, psi_coef, psi_det = selection_step(comm, lewis, n_ord, psi_coef, psi_det, len(psi_det))
-        # Update Hamiltonian engine
+        N_det = len(psi_det)
+        n = N_det if args.max_selected is None else args.max_selected
+        E, psi_coef, psi_det = selection_step(
+            comm,
+            lewis,
+            n_ord,
+            psi_coef,
+            psi_det,
+            n,
+            pt2_fraction=args.pt2_fraction,
+            pt2_screening_threshold=args.pt2_screening_threshold,
+            generator_norm_fraction=args.generator_norm_fraction,
+            constraint_runtimes=constraint_runtimes,
+            state_selection=args.state_selection,
+            pt2_error_target=args.pt2_error_target,
+            pt2_report=pt2_report,
+        )
+        print(f"N_det: {N_det}, E_pt2 {pt2_report['E_pt2']} +/- {pt2_report['error']}")
+        if args.pt2_screening_threshold is not None:
+            n_skipped, n_constraints, bound_skipped = pt2_report["screening"]
+            print(
+                f"Screened {n_skipped}/{n_constraints} constraints, "
+                f"E_pt2 truncation bound {bound_skipped}"
+            )
+        if len(psi_det) == N_det:
+            # Nothing left to select
+            break
+        # Update Hamiltonian engine, removing the spilled matrix elements of the previous one
+        lewis.close()
         lewis = Hamiltonian_generator(
             comm,
             E0,
@@ -67,5 +207,10 @@ if __name__ == "__main__":
             d_two_e_integral,
             psi_det,
             driven_by=args.driven_by,
+            max_H_cache_bytes=args.max_H_cache_bytes,
+            H_cache_spill=args.H_cache_spill,
+            H_cache_dir=args.H_cache_dir,
+            H_cache_block_size=args.H_cache_block_size,
+            vector_exchange=args.vector_exchange,
         )
         print(f"N_det: {len(psi_det)}, E {E}")
@@ -3,8 +3,10 @@
 import unittest
 import time
 import sys
+import pathlib
 import os
 import random
+import numpy as np
 
 from arches.integral_indexing_utils import (
     compound_idx4_reverse,
@@ -22,17 +24,33 @@ from arches.drivers import (
     H_indices_generator,
     Hamiltonian_generator,
     Powerplant_manager,
+    Davidson_manager,
     selection_step,
     generate_all_constraints,
     check_constraint,
+    constraint_connections,
+    dispatch_local_constraints,
+    global_sort_pt2_energies,
+    triplet_constrained_excitations,
+    triplet_constrained_excitations_masks,
+    External_space_accumulator,
+    idk_lib,
+    det_lib,
+    es_lib,
 )
 from arches.io import load_eref, load_integrals, load_wf
+from arches.chunking import get_integral_chunks
 from collections import defaultdict
-from itertools import product
+from itertools import chain, product
 from functools import cached_property
-from arches.fundamental_types import Determinant
+from arches.fundamental_types import Determinant, DetArray
 from mpi4py import MPI
 
+try:  # arches.algorithms needs scipy
+    from arches.algorithms import cipsi, get_connected_dets, s_CI
+except ImportError:
+    cipsi = get_connected_dets = s_CI = None
+
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 
@@ -634,13 +652,17 @@ class Test_Integral_Driven_Categories(Test_Minimal):
             indices_PT2_con = []  # Reset list for each constraint
             for i, j, k, l in self.integral_by_category_PT2["C"]:
                 for (
-                    I,
-                    det_J,
-                ), phase in Hamiltonian_two_electrons_integral_driven.category_C_pt2(
+                    I_batch,
+                    psi_J,
+                ), phases in Hamiltonian_two_electrons_integral_driven.category_C_pt2(
                     (i, j, k, l), psi_i, con, spindet_a_occ_i, spindet_b_occ_i, n_orb
                 ):
-                    if det_J not in psi_i:
-                        indices_PT2_con.append(((I, det_to_index_j[det_J]), (i, j, k, l), phase))
+                    # Pairs come in batches, |J⟩ packed
+                    for I, det_J, phase in zip(I_batch.tolist(), psi_J, phases.tolist()):
+                        if det_J not in psi_i:
+                            indices_PT2_con.append(
+                                ((I, det_to_index_j[det_J]), (i, j, k, l), phase)
+                            )
                 # `indices_PT2_con` contains all ((I, J), idx, phase) s.to:
                 #   1. Integrals idx in category C;
                 #   2. Determinants J satisfy constraint con
@@ -683,13 +705,17 @@ class Test_Integral_Driven_Categories(Test_Minimal):
             indices_PT2_con = []  # Reset list for each constraint
             for i, j, k, l in self.integral_by_category_PT2["D"]:
                 for (
-                    I,
-                    det_J,
-                ), phase in Hamiltonian_two_electrons_integral_driven.category_D_pt2(
+                    I_batch,
+                    psi_J,
+                ), phases in Hamiltonian_two_electrons_integral_driven.category_D_pt2(
                     (i, j, k, l), psi_i, con, spindet_a_occ_i, spindet_b_occ_i, n_orb
                 ):
-                    if det_J not in psi_i:
-                        indices_PT2_con.append(((I, det_to_index_j[det_J]), (i, j, k, l), phase))
+                    # Pairs come in batches, |J⟩ packed
+                    for I, det_J, phase in zip(I_batch.tolist(), psi_J, phases.tolist()):
+                        if det_J not in psi_i:
+                            indices_PT2_con.append(
+                                ((I, det_to_index_j[det_J]), (i, j, k, l), phase)
+                            )
                 # `indices_PT2_con` contains all ((I, J), idx, phase) s.to:
                 #   1. Integrals idx in category D;
                 #   2. Determinants J satisfy constraint con
@@ -732,13 +758,17 @@ class Test_Integral_Driven_Categories(Test_Minimal):
             indices_PT2_con = []  # Reset list for each constraint
             for i, j, k, l in self.integral_by_category_PT2["E"]:
                 for (
-                    I,
-                    det_J,
-                ), phase in Hamiltonian_two_electrons_integral_driven.category_E_pt2(
+                    I_batch,
+                    psi_J,
+                ), phases in Hamiltonian_two_electrons_integral_driven.category_E_pt2(
                     (i, j, k, l), psi_i, con, spindet_a_occ_i, spindet_b_occ_i, n_orb
                 ):
-                    if det_J not in psi_i:
-                        indices_PT2_con.append(((I, det_to_index_j[det_J]), (i, j, k, l), phase))
+                    # Pairs come in batches, |J⟩ packed
+                    for I, det_J, phase in zip(I_batch.tolist(), psi_J, phases.tolist()):
+                        if det_J not in psi_i:
+                            indices_PT2_con.append(
+                                ((I, det_to_index_j[det_J]), (i, j, k, l), phase)
+                            )
                 # `indices_PT2_con` contains all ((I, J), idx, phase) s.to:
                 #   1. Integrals idx in category E;
                 #   2. Determinants J satisfy constraint con
@@ -781,13 +811,17 @@ class Test_Integral_Driven_Categories(Test_Minimal):
             indices_PT2_con = []  # Reset list for each constraint
             for i, j, k, l in self.integral_by_category_PT2["F"]:
                 for (
-                    I,
-                    det_J,
-                ), phase in Hamiltonian_two_electrons_integral_driven.category_F_pt2(
+                    I_batch,
+                    psi_J,
+                ), phases in Hamiltonian_two_electrons_integral_driven.category_F_pt2(
                     (i, j, k, l), psi_i, con, spindet_a_occ_i, spindet_b_occ_i, n_orb
                 ):
-                    if det_J not in psi_i:
-                        indices_PT2_con.append(((I, det_to_index_j[det_J]), (i, j, k, l), phase))
+                    # Pairs come in batches, |J⟩ packed
+                    for I, det_J, phase in zip(I_batch.tolist(), psi_J, phases.tolist()):
+                        if det_J not in psi_i:
+                            indices_PT2_con.append(
+                                ((I, det_to_index_j[det_J]), (i, j, k, l), phase)
+                            )
                 # `indices_PT2_con` contains all ((I, J), idx, phase) s.to:
                 #   1. Integrals idx in category F;
                 #   2. Determinants J satisfy constraint con
@@ -837,13 +871,17 @@ class Test_Integral_Driven_Categories(Test_Minimal):
             indices_PT2_con = []  # Reset list for each constraint
             for i, j, k, l in self.integral_by_category_PT2["G"]:
                 for (
-                    I,
-                    det_J,
-                ), phase in Hamiltonian_two_electrons_integral_driven.category_G_pt2(
+                    I_batch,
+                    psi_J,
+                ), phases in Hamiltonian_two_electrons_integral_driven.category_G_pt2(
                     (i, j, k, l), psi_i, con, spindet_a_occ_i, spindet_b_occ_i, n_orb
                 ):
-                    if det_J not in psi_i:
-                        indices_PT2_con.append(((I, det_to_index_j[det_J]), (i, j, k, l), phase))
+                    # Pairs come in batches, |J⟩ packed
+                    for I, det_J, phase in zip(I_batch.tolist(), psi_J, phases.tolist()):
+                        if det_J not in psi_i:
+                            indices_PT2_con.append(
+                                ((I, det_to_index_j[det_J]), (i, j, k, l), phase)
+                            )
                 # `indices_PT2_con` contains all ((I, J), idx, phase) s.to:
                 #   1. Integrals idx in category G;
                 #   2. Determinants J satisfy constraint con
@@ -919,6 +957,16 @@ def load_and_compute(fcidump_path, wf_path, driven_by):
     return Powerplant_manager(comm, lewis).E(psi_coef)
 
 
+def load_hamiltonian(fcidump_path, wf_path, driven_by="determinant", **kwargs):
+    # Wave function, and the Hamiltonian in the basis of its determinants
+    n_ord, E0, d_one_e_integral, d_two_e_integral = load_integrals(f"data/{fcidump_path}")
+    psi_coef, psi_det = load_wf(f"data/{wf_path}")
+    lewis = Hamiltonian_generator(
+        MPI.COMM_WORLD, E0, d_one_e_integral, d_two_e_integral, psi_det, driven_by, **kwargs
+    )
+    return n_ord, psi_coef, psi_det, lewis
+
+
 class Test_VariationalPowerplant_Determinant(Timing, unittest.TestCase, Test_VariationalPowerplant):
     def load_and_compute(self, fcidump_path, wf_path):
         return load_and_compute(fcidump_path, wf_path, "determinant")
@@ -929,6 +977,296 @@ class Test_VariationalPowerplant_Integral(Timing, unittest.TestCase, Test_Variat
         return load_and_compute(fcidump_path, wf_path, "integral")
 
 
+class Test_Davidson_Preconditioners(Timing, unittest.TestCase):
+    def check_eigenvalues(self, fcidump_path, wf_path, n_eig, **davidson_kwargs):
+        _, _, _, lewis = load_hamiltonian(fcidump_path, wf_path)
+        DM = Davidson_manager(lewis.comm, lewis)
+        # Same eigenvalues as with the default (diagonal) preconditioner
+        E_ref, _ = DM.distributed_davidson(n_eig=n_eig, m=n_eig)
+        E, _ = DM.distributed_davidson(n_eig=n_eig, m=n_eig, **davidson_kwargs)
+        np.testing.assert_allclose(E, E_ref, rtol=0, atol=1e-8)
+
+    def test_olsen(self):
+        self.check_eigenvalues("f2_631g.FCIDUMP", "f2_631g.30det.wf", 3, pc="olsen")
+
+    def test_block(self):
+        self.check_eigenvalues("f2_631g.FCIDUMP", "f2_631g.30det.wf", 3, pc="block", n_ref=8)
+
+    def test_block_full_reference_space(self):
+        # H_PP is the whole H: the correction keeps adding new directions
+        self.check_eigenvalues("f2_631g.FCIDUMP", "f2_631g.30det.wf", 1, pc="block", n_ref=64)
+
+    def test_reference_space(self):
+        _, _, _, lewis = load_hamiltonian(
+            "f2_631g.FCIDUMP", "f2_631g.30det.wf", H_cache_block_size=4
+        )
+        DM = Davidson_manager(lewis.comm, lewis)
+        _, _, H_PP = DM.reference_space(lewis.D_i, 8)
+        # Full H is only gathered on the master rank
+        H = lewis.comm.bcast(lewis.H, root=0)
+        P = np.sort(np.argsort(np.diag(H), kind="stable")[:8])
+        np.testing.assert_allclose(H_PP, H[np.ix_(P, P)], rtol=0, atol=1e-12)
+
+    def test_unknown_options(self):
+        _, _, _, lewis = load_hamiltonian("f2_631g.FCIDUMP", "f2_631g.10det.wf")
+        DM = Davidson_manager(lewis.comm, lewis)
+        with self.assertRaises(ValueError):
+            DM.distributed_davidson(pc="jacobi")
+        with self.assertRaises(ValueError):
+            DM.distributed_davidson(orthogonalization="householder")
+
+
+class Test_Davidson_Orthogonalization(Timing, unittest.TestCase):
+    def load(self):
+        _, _, _, lewis = load_hamiltonian("f2_631g.FCIDUMP", "f2_631g.30det.wf")
+        return lewis, Davidson_manager(lewis.comm, lewis)
+
+    def test_block_orthogonalize(self):
+        lewis, DM = self.load()
+        start, stop = lewis.offsets[lewis.rank], lewis.offsets[lewis.rank] + lewis.local_size
+        # Same random vectors on all ranks; each keeps its rows
+        rng = np.random.default_rng(0)
+        V = np.linalg.qr(rng.random((lewis.full_problem_size, 3)))[0]
+        T = rng.random((lewis.full_problem_size, 4))
+        # Last column is in the span of V and of the other columns: it is dropped
+        T[:, 3] = V[:, 0] + T[:, 0] - 2 * T[:, 1]
+        Q_i = DM.block_orthogonalize(V[start:stop], T[start:stop], subspace_tol=1e-10)
+        self.assertEqual(Q_i.shape[1], 3)
+        Q = np.concatenate(lewis.comm.allgather(Q_i))
+        np.testing.assert_allclose(Q.T @ Q, np.eye(3), atol=1e-12)
+        np.testing.assert_allclose(V.T @ Q, 0, atol=1e-12)
+
+    def test_davidson(self):
+        lewis, DM = self.load()
+        E_mgs, _ = DM.distributed_davidson(n_eig=3, m=3, q=6, orthogonalization="mgs")
+        E, X = DM.distributed_davidson(n_eig=3, m=3, q=6, orthogonalization="cholqr2")
+        np.testing.assert_allclose(E, E_mgs, rtol=0, atol=1e-8)
+        np.testing.assert_allclose(X.T @ X, np.eye(3), atol=1e-10)
+
+
+class Test_H_Cache(Timing, unittest.TestCase):
+    def load(self, fcidump_path, wf_path, **H_cache_kwargs):
+        _, psi_coef, _, lewis = load_hamiltonian(fcidump_path, wf_path, **H_cache_kwargs)
+        return psi_coef, lewis
+
+    def check_split(self, H_cache_spill):
+        fcidump_path = "f2_631g.FCIDUMP"
+        wf_path = "f2_631g.30det.wf"
+        psi_coef, lewis_ref = self.load(fcidump_path, wf_path)
+        # Budget only fits part of H, forcing the rest to be spilled or recomputed
+        _, lewis = self.load(
+            fcidump_path,
+            wf_path,
+            max_H_cache_bytes=2**12,
+            H_cache_spill=H_cache_spill,
+            H_cache_block_size=4,
+        )
+        E_ref = Powerplant_manager(lewis_ref.comm, lewis_ref).E(psi_coef)
+        for _ in range(2):  # First call builds the cache, second call re-uses it
+            E = Powerplant_manager(lewis.comm, lewis).E(psi_coef)
+            self.assertAlmostEqual(E_ref, E, places=10)
+        (n_memory, b_memory), _, _ = lewis.H_cache_split.values()
+        self.assertLessEqual(b_memory, 2**12)
+        self.assertEqual(lewis.H_i_cached_bytes, b_memory)
+        self.assertGreater(n_memory, 0)
+        self.assertEqual(lewis.H_cache_split[H_cache_spill][0], lewis.local_size - n_memory)
+        spilled = lewis.H_cache_split["memmap"][0] > 0
+        if spilled:
+            tmpdir = pathlib.Path(lewis.H_cache_tmpdir.name)
+            self.assertTrue(any(tmpdir.iterdir()))
+        lewis.close()
+        if spilled:
+            self.assertFalse(tmpdir.exists())
+
+    def test_recompute(self):
+        self.check_split("recompute")
+
+    def test_memmap(self):
+        self.check_split("memmap")
+
+    def test_unknown_spill(self):
+        with self.assertRaises(ValueError):
+            self.load("f2_631g.FCIDUMP", "f2_631g.30det.wf", H_cache_spill="swap")
+
+    def test_halo_exchange(self):
+        psi_coef, lewis_ref = self.load("f2_631g.FCIDUMP", "f2_631g.30det.wf")
+        # Spilled blocks are recomputed to build the halo pattern, and at each product
+        _, lewis = self.load(
+            "f2_631g.FCIDUMP",
+            "f2_631g.30det.wf",
+            vector_exchange="halo",
+            max_H_cache_bytes=2**12,
+            H_cache_block_size=4,
+        )
+        E_ref, _ = Powerplant_manager(lewis_ref.comm, lewis_ref).E_and_psi_coef
+        E, _ = Powerplant_manager(lewis.comm, lewis).E_and_psi_coef
+        self.assertAlmostEqual(E_ref, E, places=8)
+        # Only columns owned by other ranks are received
+        _, recv_columns, recv_counts, send_rows, send_counts, block_columns = lewis.H_i_halo
+        start = lewis.offsets[lewis.rank]
+        self.assertFalse(np.any((recv_columns >= start) & (recv_columns < start + lewis.local_size)))
+        self.assertEqual(recv_counts.sum(), len(recv_columns))
+        self.assertEqual(send_counts.sum(), len(send_rows))
+        # Columns of the cached blocks are renumbered once, the recomputed ones at each product
+        cached = {b for b, (location, _) in lewis.H_i_block_location.items() if location != "recompute"}
+        self.assertEqual(set(block_columns), cached)
+        M_i = np.random.default_rng(0).random((lewis.local_size, 3))
+        np.testing.assert_allclose(
+            lewis.H_i_distributed_matrix_product(M_i),
+            lewis_ref.H_i_distributed_matrix_product(M_i),
+            rtol=0,
+            atol=1e-10,
+        )
+        # The neighbor communicator is freed with the cache
+        lewis.close()
+        self.assertNotIn("H_i_halo", lewis.__dict__)
+
+    def test_row_matrix_elements(self):
+        # Blocks only hold non-zeros, with the values of the dense rows
+        _, lewis = self.load("f2_631g.FCIDUMP", "f2_631g.30det.wf", H_cache_block_size=4)
+        for start, stop in lewis.H_i_blocks:
+            keys, data = lewis.H_i_row_matrix_elements(start, stop)
+            I, J = np.divmod(keys, lewis.full_problem_size)
+            H_rows = np.zeros((stop - start, lewis.full_problem_size))
+            H_rows[I, J] = data
+            np.testing.assert_allclose(H_rows, lewis.H_i[start:stop], rtol=0, atol=1e-12)
+            self.assertTrue(np.all(data != 0))
+
+    def test_matrix_product(self):
+        _, lewis = self.load("f2_631g.FCIDUMP", "f2_631g.30det.wf", H_cache_block_size=4)
+        # Block of right-hand sides, all at once (and in column-major layout)
+        M = np.asfortranarray(np.random.default_rng(0).random((lewis.full_problem_size, 5)))
+        np.testing.assert_allclose(
+            lewis.H_i_implicit_matrix_product(M), lewis.H_i @ M, rtol=0, atol=1e-10
+        )
+
+
+class Test_H_ii_Batch(Timing, unittest.TestCase):
+    def check_H_ii(self, fcidump_path, wf_path):
+        n_ord, _, psi_det, lewis = load_hamiltonian(fcidump_path, wf_path)
+        H_ii_ref = [lewis.H_ii(det) for det in psi_det]
+        H_ii = lewis.H_ii_batch(DetArray.from_psi_det(psi_det, n_ord))
+        np.testing.assert_allclose(H_ii, H_ii_ref, rtol=0, atol=1e-10)
+
+    def test_f2_631g_30det(self):
+        self.check_H_ii("f2_631g.FCIDUMP", "f2_631g.30det.wf")
+
+    def test_c2_eq_dz_3(self):
+        self.check_H_ii("c2_eq_hf_dz.fcidump.gz", "c2_eq_hf_dz_3.22det.wf.gz")
+
+    def test_incremental(self):
+        n_ord, _, psi_det, lewis = load_hamiltonian("f2_631g.FCIDUMP", "f2_631g.30det.wf")
+        parents, psi_connected = [], []
+        for I, det_I in enumerate(psi_det[:3]):
+            for det_J in det_I.gen_all_connected_det(n_ord):
+                parents.append(I)
+                psi_connected.append(det_J)
+        psi_parent = DetArray.from_psi_det(psi_det, n_ord)[parents]
+        H_ii = lewis.H_ii_incremental(
+            DetArray.from_psi_det(psi_connected, n_ord),
+            psi_parent,
+            lewis.H_ii_batch(psi_parent),
+            lewis.orbital_energies(psi_parent),
+        )
+        H_ii_ref = lewis.H_ii_batch(DetArray.from_psi_det(psi_connected, n_ord))
+        np.testing.assert_allclose(H_ii, H_ii_ref, rtol=0, atol=1e-10)
+
+    def test_H_ij_batch(self):
+        n_ord, _, psi_det, lewis = load_hamiltonian("f2_631g.FCIDUMP", "f2_631g.30det.wf")
+        psi_i, psi_j = [], []
+        for det_I in psi_det[:3]:
+            for det_J in det_I.gen_all_connected_det(n_ord):
+                if det_J != det_I:
+                    psi_i.append(det_I)
+                    psi_j.append(det_J)
+        H_ij_ref = [
+            lewis.Hamiltonian_1e_driver.H_ij(det_I, det_J)
+            + sum(
+                phase * lewis.Hamiltonian_2e_driver.H_ijkl_orbital(*idx)
+                for idx, phase in lewis.Hamiltonian_2e_driver.H_ij_indices(det_I, det_J)
+            )
+            for det_I, det_J in zip(psi_i, psi_j)
+        ]
+        H_ij = lewis.H_ij_batch(
+            DetArray.from_psi_det(psi_i, n_ord), DetArray.from_psi_det(psi_j, n_ord)
+        )
+        np.testing.assert_allclose(H_ij, H_ij_ref, rtol=0, atol=1e-10)
+
+
+@unittest.skipIf(idk_lib is None, "Compiled integral-driven kernels are not built")
+class Test_Integral_Driven_Kernels(Timing, unittest.TestCase):
+    def check_H(self, fcidump_path, wf_path):
+        n_ord, E0, d_one_e_integral, d_two_e_integral = load_integrals(f"data/{fcidump_path}")
+        psi_coef, psi_det = load_wf(f"data/{wf_path}")
+        h = Hamiltonian_two_electrons_integral_driven(d_two_e_integral)
+        H_compiled = h.H(psi_det, psi_det)
+        h.use_compiled_kernels = False
+        H_ref = h.H(psi_det, psi_det)
+        np.testing.assert_allclose(H_compiled, H_ref, rtol=0, atol=1e-10)
+
+    def test_f2_631g_30det(self):
+        self.check_H("f2_631g.FCIDUMP", "f2_631g.30det.wf")
+
+    def test_c2_eq_dz_3(self):
+        self.check_H("c2_eq_hf_dz.fcidump.gz", "c2_eq_hf_dz_3.22det.wf.gz")
+
+
+@unittest.skipIf(cipsi is None, "scipy is not installed")
+class Test_PT2_Engine(Timing, unittest.TestCase):
+    def load_and_compute_pt2(self, fcidump_path, wf_path):
+        n_ord, E0, d_one_e_integral, d_two_e_integral = load_integrals(f"data/{fcidump_path}")
+        psi_coef, psi_det = load_wf(f"data/{wf_path}")
+        comm = MPI.COMM_WORLD
+        lewis = Hamiltonian_generator(
+            comm, E0, d_one_e_integral, d_two_e_integral, psi_det, "integral"
+        )
+        E_var = Powerplant_manager(comm, lewis).E(psi_coef)
+        J_chunks = get_integral_chunks(
+            n_ord, d_one_e_integral, d_two_e_integral, chunk_size=2048, comm=comm
+        )
+        _, E_pt2 = cipsi(E_var, psi_det, psi_coef, J_chunks, n_orb=n_ord, E0=E0, comm=comm)
+        return E_pt2
+
+    def test_f2_631g_1det(self):
+        E = self.load_and_compute_pt2("f2_631g.FCIDUMP", "f2_631g.1det.wf")
+        self.assertAlmostEqual(-0.367587988032339, E, places=6)
+
+    def test_f2_631g_2det(self):
+        E = self.load_and_compute_pt2("f2_631g.FCIDUMP", "f2_631g.2det.wf")
+        self.assertAlmostEqual(-0.253904406461572, E, places=6)
+
+    def test_connected_dets(self):
+        n_ord, _, _, _ = load_integrals("data/f2_631g.FCIDUMP")
+        _, psi_det = load_wf("data/f2_631g.10det.wf")
+        connected = set(chain.from_iterable(det.gen_all_connected_det(n_ord) for det in psi_det))
+        ext_dets = get_connected_dets(psi_det, n_ord, batch_size=1000)
+        self.assertEqual(set(ext_dets), connected - set(psi_det))
+        self.assertEqual(len(ext_dets), len(connected - set(psi_det)))
+        # Sorted, as the lookups expect
+        _, order = ext_dets.sorted_keys
+        np.testing.assert_array_equal(order, np.arange(len(ext_dets)))
+        C = (6, 9, 10)
+        constrained = get_connected_dets(psi_det, n_ord, [C])
+        self.assertEqual(set(constrained), {det for det in ext_dets if det.alpha[-3:] == C})
+
+    def test_s_CI(self):
+        n_ord, E0, d_one_e_integral, d_two_e_integral = load_integrals("data/f2_631g.FCIDUMP")
+        psi_coef, psi_det = load_wf("data/f2_631g.1det.wf")
+        comm = MPI.COMM_WORLD
+        J_chunks = get_integral_chunks(
+            n_ord, d_one_e_integral, d_two_e_integral, chunk_size=2048, comm=comm
+        )
+        E, _, dets = s_CI(
+            E0, psi_det, psi_coef, J_chunks, n_orb=n_ord, N_max_dets=100, comm=comm, pt2_threshold=1e-4
+        )
+        # Same energy as with the Hamiltonian built from the integral dictionaries
+        lewis = Hamiltonian_generator(
+            comm, E0, d_one_e_integral, d_two_e_integral, dets.to_psi_det(), "integral"
+        )
+        E_ref, _ = Powerplant_manager(comm, lewis).E_and_psi_coef
+        self.assertAlmostEqual(E_ref, E, places=8)
+
+
 class Test_VariationalPT2Powerplant:
     def test_f2_631g_1det(self):
         fcidump_path = "f2_631g.FCIDUMP"
@@ -980,6 +1318,296 @@ class Test_VariationalPT2_Integral(Timing, unittest.TestCase, Test_VariationalPT
         return load_and_compute_pt2(fcidump_path, wf_path, "integral")
 
 
+class Test_Semistochastic_PT2(Timing, unittest.TestCase):
+    def load(self, fcidump_path, wf_path):
+        _, psi_coef, _, lewis = load_hamiltonian(fcidump_path, wf_path)
+        return psi_coef, Powerplant_manager(lewis.comm, lewis)
+
+    def test_f2_631g_10det_deterministic(self):
+        psi_coef, PP_manager = self.load("f2_631g.FCIDUMP", "f2_631g.10det.wf")
+        E, error = PP_manager.E_pt2_stochastic(psi_coef, 1e-3, deterministic_weight=1.0)
+        self.assertAlmostEqual(-0.24321128, E, places=6)
+        self.assertEqual(error, 0.0)
+
+    def test_f2_631g_10det(self):
+        psi_coef, PP_manager = self.load("f2_631g.FCIDUMP", "f2_631g.10det.wf")
+        E, error = PP_manager.E_pt2_stochastic(psi_coef, 2e-3)
+        self.assertLessEqual(error, 2e-3)
+        self.assertLess(abs(-0.24321128 - E), 5 * 2e-3)
+
+    def test_f2_631g_10det_screening(self):
+        # Constraints are weighted over the same generators, and screened the same way, as the
+        # deterministic E_pt2
+        _, psi_coef, _, lewis = load_hamiltonian("f2_631g.FCIDUMP", "f2_631g.10det.wf")
+        PP_manager = Powerplant_manager(
+            lewis.comm, lewis, pt2_screening_threshold=1000.0, generator_norm_fraction=0.9
+        )
+        E, error = PP_manager.E_pt2_stochastic(psi_coef, 1e-3, deterministic_weight=1.0)
+        n_skipped, n_constraints, bound_skipped = PP_manager.pt2_screening_report
+        self.assertAlmostEqual(PP_manager.E_pt2(psi_coef), E, places=10)
+        self.assertEqual(error, 0.0)
+        self.assertGreater(n_skipped, 0)
+        self.assertEqual((n_skipped, n_constraints), PP_manager.pt2_screening_report[:2])
+        self.assertAlmostEqual(bound_skipped, PP_manager.pt2_screening_report[2])
+
+    def test_f2_631g_10det_selection(self):
+        n_ord, psi_coef, psi_det, lewis = load_hamiltonian("f2_631g.FCIDUMP", "f2_631g.10det.wf")
+        E_var = Powerplant_manager(lewis.comm, lewis).E(psi_coef)
+        pt2_report = {}
+        E, _, psi_det = selection_step(
+            lewis.comm,
+            lewis,
+            n_ord,
+            psi_coef,
+            psi_det,
+            10,
+            pt2_error_target=2e-3,
+            pt2_report=pt2_report,
+        )
+        self.assertEqual(len(psi_det), 20)
+        self.assertLess(E, E_var)
+        self.assertLessEqual(pt2_report["error"], 2e-3)
+        self.assertLess(abs(-0.24321128 - pt2_report["E_pt2"]), 5 * 2e-3)
+
+
+class Test_PT2_Screening(Timing, unittest.TestCase):
+    def test_f2_631g_10det(self):
+        _, psi_coef, _, lewis = load_hamiltonian("f2_631g.FCIDUMP", "f2_631g.10det.wf")
+        E_ref = -0.24321128
+        # Estimates are (very) loose; skip the constraints with the smallest ones
+        PP_manager = Powerplant_manager(lewis.comm, lewis, pt2_screening_threshold=1000.0)
+        E = PP_manager.E_pt2(psi_coef)
+        n_skipped, n_constraints, bound_skipped = PP_manager.pt2_screening_report
+        self.assertGreater(n_skipped, 0)
+        self.assertLess(n_skipped, n_constraints)
+        self.assertLessEqual(abs(E - E_ref), bound_skipped + 1e-8)
+
+    def test_f2_631g_10det_bound(self):
+        _, psi_coef, _, lewis = load_hamiltonian("f2_631g.FCIDUMP", "f2_631g.10det.wf")
+        PP_manager = Powerplant_manager(lewis.comm, lewis, generator_norm_fraction=0.9)
+        E_var = PP_manager.E(psi_coef)
+        # The contribution of each constraint is within its bound
+        for C in PP_manager.gen_local_constraints(psi_coef):
+            _, E_pt2_C = PP_manager.psi_external_pt2(C, psi_coef, E_var)
+            self.assertLessEqual(
+                abs(E_pt2_C.sum()), PP_manager.constraint_pt2_bound(C, psi_coef, E_var)
+            )
+
+    def test_f2_631g_10det_generators(self):
+        _, psi_coef, psi_det, lewis = load_hamiltonian("f2_631g.FCIDUMP", "f2_631g.10det.wf")
+        comm = lewis.comm
+        E_ref = -0.24321128
+        # The full norm keeps every generator
+        PP_manager = Powerplant_manager(comm, lewis, generator_norm_fraction=1.0)
+        self.assertEqual(len(PP_manager.generator_indices(psi_coef)), len(psi_det))
+        self.assertAlmostEqual(PP_manager.E_pt2(psi_coef), E_ref, places=6)
+        # Dropping the smallest coefficients only slightly changes E_pt2
+        PP_manager = Powerplant_manager(comm, lewis, generator_norm_fraction=0.99)
+        self.assertLess(len(PP_manager.generator_indices(psi_coef)), len(psi_det))
+        self.assertAlmostEqual(PP_manager.E_pt2(psi_coef), E_ref, places=2)
+
+    def test_f2_631g_10det_selection_report(self):
+        n_ord, psi_coef, psi_det, lewis = load_hamiltonian("f2_631g.FCIDUMP", "f2_631g.10det.wf")
+        E_ref = -0.24321128
+        pt2_report = {}
+        selection_step(
+            lewis.comm,
+            lewis,
+            n_ord,
+            psi_coef,
+            psi_det,
+            10,
+            pt2_screening_threshold=1000.0,
+            pt2_report=pt2_report,
+        )
+        n_skipped, n_constraints, bound_skipped = pt2_report["screening"]
+        self.assertGreater(n_skipped, 0)
+        self.assertLess(n_skipped, n_constraints)
+        self.assertLessEqual(abs(pt2_report["E_pt2"] - E_ref), bound_skipped + 1e-8)
+        self.assertEqual(pt2_report["error"], 0.0)
+
+
+class Test_Multistate_PT2(Timing, unittest.TestCase):
+    def load(self):
+        n_ord, _, _, lewis = load_hamiltonian("f2_631g.FCIDUMP", "f2_631g.10det.wf")
+        E, psi_coef = Powerplant_manager(lewis.comm, lewis, n_states=2).E_and_psi_coef
+        return n_ord, lewis, E, psi_coef
+
+    def test_f2_631g_10det(self):
+        n_ord, lewis, E, psi_coef = self.load()
+        self.assertEqual(psi_coef.shape, (10, 2))
+        PP_manager = Powerplant_manager(lewis.comm, lewis)
+        # All states at once, same as state by state
+        np.testing.assert_allclose(PP_manager.E(psi_coef), E)
+        E_pt2 = PP_manager.E_pt2(psi_coef)
+        for s in range(2):
+            self.assertAlmostEqual(E_pt2[s], PP_manager.E_pt2(psi_coef[:, s]), places=10)
+
+    def test_f2_631g_10det_selection(self):
+        n_ord, lewis, E, psi_coef = self.load()
+        for state_selection in ("average", "max"):
+            E_selection, psi_coef_selection, psi_det = selection_step(
+                lewis.comm,
+                lewis,
+                n_ord,
+                psi_coef,
+                lewis.psi_internal,
+                10,
+                state_selection=state_selection,
+            )
+            self.assertEqual(psi_coef_selection.shape, (20, 2))
+            self.assertTrue(np.all(E_selection < E))
+
+    def test_unknown_state_selection(self):
+        n_ord, lewis, _, psi_coef = self.load()
+        # Rejected whatever the number of states
+        for coef in (psi_coef, psi_coef[:, 0]):
+            with self.assertRaises(ValueError):
+                selection_step(
+                    lewis.comm, lewis, n_ord, coef, lewis.psi_internal, 10, state_selection="min"
+                )
+
+
+class Test_Internal_Filter(Timing, unittest.TestCase):
+    def load(self):
+        _, _, psi_det, lewis = load_hamiltonian("f2_631g.FCIDUMP", "f2_631g.30det.wf")
+        return psi_det, Powerplant_manager(lewis.comm, lewis)
+
+    def test_buckets(self):
+        psi_det, PP_manager = self.load()
+        buckets = PP_manager.psi_internal_by_constraint
+        self.assertEqual(sum(map(len, buckets.values())), len(psi_det))
+        for C, psi in buckets.items():
+            for det in psi:
+                self.assertEqual(tuple(det.alpha[-3:]), C)
+
+    def test_bloom_filter(self):
+        psi_det, PP_manager = self.load()
+        bloom = PP_manager.psi_internal_bloom_filter
+        if bloom is None:
+            self.skipTest("Compiled integral-driven kernels are not built")
+        self.assertTrue(bloom.may_contain(PP_manager.psi_internal_packed).all())
+        n_orb = PP_manager.N_orb
+        psi_connected = DetArray.from_psi_det(
+            [det_J for det_I in psi_det for det_J in det_I.gen_all_connected_det(n_orb)], n_orb
+        )
+        external = PP_manager.psi_internal_packed.index(psi_connected) < 0
+        # No false negatives, and few false positives
+        may_contain = bloom.may_contain(psi_connected)
+        self.assertTrue(may_contain[~external].all())
+        self.assertLess(may_contain[external].mean(), 0.01)
+
+
+class Test_Constrained_Excitations(Timing, unittest.TestCase):
+    @unittest.skipIf(det_lib is None, "Compiled determinant kernels are not built")
+    def test_f2_631g_10det(self):
+        self.check_excitations(triplet_constrained_excitations)
+
+    def test_f2_631g_10det_masks(self):
+        self.check_excitations(triplet_constrained_excitations_masks)
+
+    def check_excitations(self, triplet_constrained_excitations):
+        n_orb, _, _, _ = load_integrals("data/f2_631g.FCIDUMP")
+        _, psi_det = load_wf("data/f2_631g.10det.wf")
+        psi = DetArray.from_psi_det(psi_det, n_orb)
+        # Same excitations as the Python generators, for every constraint
+        for C in generate_all_constraints(len(psi_det[0].alpha), n_orb):
+            ref = []
+            for I, det_I in enumerate(psi_det):
+                for det_J in det_I.triplet_constrained_single_excitations_from_det(C, n_orb):
+                    ref.append((I, det_J, 1))
+                for det_J in det_I.triplet_constrained_double_excitations_from_det(C, n_orb):
+                    ref.append((I, det_J, 2))
+            psi_J, parents, degrees = triplet_constrained_excitations(psi, C)
+            excitations = zip(parents.tolist(), psi_J.to_psi_det(), degrees.tolist())
+            self.assertEqual(len(psi_J), len(ref))
+            self.assertEqual(set(excitations), set(ref))
+            # Exactly as many as counted by the work estimate (nothing is rejected)
+            self.assertEqual(len(psi_J), constraint_connections(C, psi, n_orb).sum())
+            # Singles only
+            psi_J, parents, degrees = triplet_constrained_excitations(psi, C, max_degree=1)
+            excitations = zip(parents.tolist(), psi_J.to_psi_det(), degrees.tolist())
+            self.assertEqual(set(excitations), {x for x in ref if x[2] == 1})
+            self.assertEqual(len(psi_J), constraint_connections(C, psi, n_orb, 1).sum())
+            # Internal determinants are rejected
+            psi_J, _, _ = triplet_constrained_excitations(psi, C, psi)
+            self.assertFalse((psi.index(psi_J) >= 0).any())
+
+
+class Test_External_Space_Accumulator(Timing, unittest.TestCase):
+    @unittest.skipIf(es_lib is None, "Compiled external space accumulator is not built")
+    def test_random(self):
+        rng = np.random.default_rng(0)
+        n_orb = 70  # Two words per spin determinant
+        unique = rng.integers(0, 2**63, size=(1000, 2, 2), dtype=np.uint64)
+        psi = DetArray(unique[rng.integers(0, len(unique), size=20000)], n_orb)
+        values = rng.random(len(psi))
+        # Same sums as `sort and accumulate', in order of first insertion, in two batches
+        accumulator = External_space_accumulator(n_orb)
+        accumulator.add(psi[:5000], values[:5000], np.arange(5000))
+        accumulator.add(psi[5000:], values[5000:], np.arange(5000, len(psi)))
+        psi_unique, sums, parents = accumulator.result()
+        ref_unique, ref_sums, first = psi.accumulate(values, return_index=True)
+        order = np.argsort(first)
+        np.testing.assert_array_equal(psi_unique.words, ref_unique.words[order])
+        np.testing.assert_allclose(sums, ref_sums[order])
+        np.testing.assert_array_equal(parents, first[order])
+        accumulator.clear()
+        self.assertEqual(len(accumulator), 0)
+
+
+class Test_Dispatch_Constraints(Timing, unittest.TestCase):
+    def test_f2_631g_30det(self):
+        n_ord, _, _, _ = load_integrals("data/f2_631g.FCIDUMP")
+        _, psi_det = load_wf("data/f2_631g.30det.wf")
+        comm = MPI.COMM_WORLD
+        C_loc, H = dispatch_local_constraints(comm, psi_det, n_ord)
+        # Constraints are distributed once, and exactly those with some work
+        C_all = list(chain.from_iterable(comm.allgather(C_loc)))
+        self.assertEqual(len(C_all), len(set(C_all)))
+        work = {
+            C: constraint_connections(C, psi_det, n_ord).sum()
+            for C in generate_all_constraints(len(psi_det[0].alpha), n_ord)
+        }
+        self.assertEqual(set(C_all), {C for C, h in work.items() if h})
+        self.assertEqual(H, [work[C] for C in C_loc])
+
+    def test_f2_631g_30det_screen(self):
+        n_ord, _, _, _ = load_integrals("data/f2_631g.FCIDUMP")
+        _, psi_det = load_wf("data/f2_631g.30det.wf")
+        comm = MPI.COMM_WORLD
+        C_loc, _ = dispatch_local_constraints(comm, psi_det, n_ord)
+        C_all = set(chain.from_iterable(comm.allgather(C_loc)))
+        # Screened constraints are dropped before the load balancing; each one is tested once
+        tested = []
+
+        def screen(C):
+            tested.append(C)
+            return C[0] % 2 == 0
+
+        C_loc, _ = dispatch_local_constraints(comm, psi_det, n_ord, screen=screen)
+        tested = list(chain.from_iterable(comm.allgather(tested)))
+        self.assertEqual(sorted(tested), sorted(C_all))
+        self.assertEqual(
+            set(chain.from_iterable(comm.allgather(C_loc))), {C for C in C_all if C[0] % 2}
+        )
+
+    def test_f2_631g_30det_runtimes(self):
+        n_ord, psi_coef, psi_det, lewis = load_hamiltonian("f2_631g.FCIDUMP", "f2_631g.30det.wf")
+        comm = lewis.comm
+        # Runtimes of every processed constraint are recorded, on every rank
+        runtimes = {}
+        E = Powerplant_manager(comm, lewis, constraint_runtimes=runtimes).E_pt2(psi_coef)
+        C_loc, _ = dispatch_local_constraints(comm, psi_det, n_ord)
+        C_all = set(chain.from_iterable(comm.allgather(C_loc)))
+        self.assertEqual(set(runtimes), C_all)
+        # Scheduling with the measured runtimes distributes the same constraints, and gives the same E_pt2
+        C_loc, _ = dispatch_local_constraints(comm, psi_det, n_ord, runtimes)
+        self.assertEqual(set(chain.from_iterable(comm.allgather(C_loc))), C_all)
+        E_rescheduled = Powerplant_manager(comm, lewis, constraint_runtimes=runtimes).E_pt2(psi_coef)
+        self.assertAlmostEqual(E, E_rescheduled, places=10)
+
+
 class Test_Selection(Timing, unittest.TestCase):
     def load(self, fcidump_path, wf_path):
         # Load integrals
@@ -1041,6 +1669,42 @@ class Test_Selection(Timing, unittest.TestCase):
 
         self.assertAlmostEqual(E_ref, E, places=6)
 
+    def test_f2_631g_1p_pt2_fraction(self):
+        # Select just enough determinants to capture 30% of E_pt2
+        fcidump_path = "f2_631g.FCIDUMP"
+        wf_path = "f2_631g.1det.wf"
+
+        n_ord, psi_coef, psi_det, lewis = self.load(fcidump_path, wf_path)
+        E_var = Powerplant_manager(lewis.comm, lewis).E(psi_coef)
+        E, _, psi_det = selection_step(
+            lewis.comm, lewis, n_ord, psi_coef, psi_det, 1000, pt2_fraction=0.3
+        )
+        self.assertEqual(len(psi_det), 15)
+        self.assertLess(E, E_var)
+
+    def test_global_sort_unique(self):
+        # Duplicates, tombstones and internal determinants are never selected
+        comm = MPI.COMM_WORLD
+        psi_internal = DetArray.from_psi_det([Determinant((0, 1), (0, 1))], 4)
+        local_best_dets = DetArray.from_psi_det(
+            [
+                Determinant((0, 1), (0, 1)),
+                Determinant((0, 2), (0, 1)),
+                Determinant((0, 2), (0, 1)),
+                Determinant((0, 3), (0, 1)),
+                Determinant((), ()),
+            ],
+            4,
+        )
+        local_best_energies = np.array([-0.4, -0.3, -0.3, -0.1, 1.0])
+        global_best_dets = global_sort_pt2_energies(
+            comm, local_best_dets, local_best_energies, 5, psi_internal
+        )
+        self.assertEqual(len(global_best_dets), 2)
+        self.assertEqual(
+            set(global_best_dets), {Determinant((0, 2), (0, 1)), Determinant((0, 3), (0, 1))}
+        )
+
 
 if __name__ == "__main__":
     try: